@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+Created on 2026-10-20 (Tue) 01:46:33
+
+Chunked, compressed h5ad output for simulated bulk tables.
+
+SimBulkWriter appends blocks of pseudo-bulks (samples x genes) to a resizable, gzip-compressed
+h5py dataset as the simulators generate them, and writes obs (cell-type proportions + 'ds'),
+var and uns['cell_types'] on close. The result is a regular h5ad, so prep4benchmark reads it
+lazily with backed=True (only the sampled rows are decompressed).
+
+    with SimBulkWriter('sim.h5ad', cell_types=summary_df.columns) as w:
+        sim.create_sim_bulk(mode='train', writer=w, ds='TSCA_train')
+        sim.create_sim_bulk(mode='test', writer=w, ds='TSCA_test')
+
+@author: I.Azuma
+"""
+import os
+import h5py
+import numpy as np
+import pandas as pd
+
+try:
+    from anndata.io import write_elem
+except ImportError:
+    from anndata.experimental import write_elem
+
+class SimBulkWriter:
+    """
+    Append-only h5ad writer (X: samples x genes float32, row chunks of chunk_rows).
+    """
+    def __init__(self, path, cell_types, chunk_rows=256, compression='gzip', compression_opts=4, dtype=np.float32):
+        self.path = path
+        self.cell_types = [str(c) for c in cell_types]
+        self.chunk_rows = chunk_rows
+        self.compression = compression
+        self.compression_opts = compression_opts
+        self.dtype = np.dtype(dtype)
+        self.genes = None
+        self.obs = []
+        self.n_rows = 0
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.tmp_path = path + '.tmp'
+        self.f = h5py.File(self.tmp_path, 'w')
+        self.X = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:  # NOTE: incomplete output is not left behind as a valid h5ad
+            self.f.close()
+            os.remove(self.tmp_path)
+
+    def append(self, X, props, ds, genes):
+        """
+        X: (n, n_genes) pseudo-bulks; props: (n, n_types) proportions (DataFrame or array) of the same samples.
+        """
+        X = np.asarray(X, dtype=self.dtype)
+        genes = [str(g) for g in genes]
+        if self.X is None:
+            self.genes = genes
+            self.X = self.f.create_dataset('X', shape=(0, len(genes)), maxshape=(None, len(genes)), dtype=self.dtype,
+                                           chunks=(self.chunk_rows, len(genes)), compression=self.compression,
+                                           compression_opts=self.compression_opts)
+            self.X.attrs['encoding-type'] = 'array'
+            self.X.attrs['encoding-version'] = '0.2.0'
+        elif genes != self.genes:
+            raise ValueError("Genes of the appended block do not match the previous blocks.")
+        if X.shape[0] != len(props):
+            raise ValueError("X and props must have the same number of samples.")
+
+        start = self.n_rows
+        self.X.resize(start + X.shape[0], axis=0)
+        self.X[start:start + X.shape[0]] = X
+        self.n_rows += X.shape[0]
+
+        obs = pd.DataFrame(np.asarray(props, dtype=np.float64), columns=self.cell_types,
+                           index=[f'{ds}_{i}' for i in range(start, start + X.shape[0])])
+        obs['ds'] = ds
+        self.obs.append(obs)
+
+    def close(self):
+        if self.X is None:
+            self.X = self.f.create_dataset('X', shape=(0, 0), dtype=self.dtype)
+            self.X.attrs['encoding-type'] = 'array'
+            self.X.attrs['encoding-version'] = '0.2.0'
+        obs = pd.concat(self.obs) if self.obs else pd.DataFrame(columns=self.cell_types + ['ds'])
+        obs['ds'] = obs['ds'].astype('category')
+        self.f.attrs['encoding-type'] = 'anndata'
+        self.f.attrs['encoding-version'] = '0.1.0'
+        write_elem(self.f, 'obs', obs)
+        write_elem(self.f, 'var', pd.DataFrame(index=self.genes if self.genes is not None else []))
+        write_elem(self.f, 'uns', {'cell_types': np.array(self.cell_types, dtype=object)})
+        for k in ['obsm', 'varm', 'layers', 'obsp', 'varp']:
+            write_elem(self.f, k, {})
+        self.f.close()
+        os.replace(self.tmp_path, self.path)
+        print(f"Simulated bulk written to {self.path} ({self.n_rows} samples)")
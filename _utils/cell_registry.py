@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+Created on 2026-10-20 (Tue) 01:12:05
+
+Cell-type index registry for the simulators.
+
+Positional indices of every cell type are derived in one groupby over the labels (instead of a
+list.index lookup per cell), split into train / test with the same seeded random.sample shuffle as
+before, and persisted together in a single .npz file.
+
+@author: I.Azuma
+"""
+import os
+import random
+import numpy as np
+import pandas as pd
+
+def cell_positions(labels, cell_types=None):
+    """
+    {cell type: ascending positional indices (int64)} in one pass over labels.
+    """
+    labels = pd.Series(np.asarray(labels))
+    groups = {k: np.asarray(v, dtype=np.int64) for k, v in labels.groupby(labels.values, sort=False).indices.items()}
+    if cell_types is None:
+        return groups
+    return {c: groups.get(c, np.zeros(0, dtype=np.int64)) for c in cell_types}
+
+def seeded_split(idx, train_ratio=0.7, seed=42):
+    """
+    Same split as random.seed(seed); random.sample(idx, len(idx)) followed by a train_ratio cut.
+    """
+    shuffle_idx = random.Random(seed).sample(list(idx), len(idx))
+    n_train = int(len(idx) * train_ratio)
+    return np.asarray(shuffle_idx[:n_train], dtype=np.int64), np.asarray(shuffle_idx[n_train:], dtype=np.int64)
+
+class CellIndexRegistry:
+    """
+    {cell type: {'train': indices, 'test': indices}} with single-file persistence.
+    """
+    def __init__(self, cell_idx):
+        self.cell_idx = cell_idx
+
+    @classmethod
+    def from_positions(cls, positions, train_ratio=0.7, seed=42):
+        cell_idx = {}
+        for cell, idx in positions.items():
+            train_idx, test_idx = seeded_split(idx, train_ratio=train_ratio, seed=seed)
+            cell_idx[cell] = {'train': train_idx, 'test': test_idx}
+            print("{}: {} cells are detected".format(cell, len(idx)))
+        return cls(cell_idx)
+
+    @classmethod
+    def from_labels(cls, labels, cell_types=None, train_ratio=0.7, seed=42):
+        return cls.from_positions(cell_positions(labels, cell_types), train_ratio=train_ratio, seed=seed)
+
+    def to_dict(self):
+        return self.cell_idx
+
+    def save(self, path):
+        cell_types = list(self.cell_idx)
+        arrays = {}
+        for i, cell in enumerate(cell_types):
+            arrays[f'{i}_train'] = self.cell_idx[cell]['train']
+            arrays[f'{i}_test'] = self.cell_idx[cell]['test']
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        np.savez_compressed(path, cell_types=np.array(cell_types, dtype=str), **arrays)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            cell_types = f['cell_types'].tolist()
+            return cls({cell: {'train': f[f'{i}_train'], 'test': f[f'{i}_test']} for i, cell in enumerate(cell_types)})
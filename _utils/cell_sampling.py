@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+Created on 2026-10-19 (Mon) 23:52:30
+
+Cell sampling and pseudo-bulk primitives shared by the simulators (simulation.py), the sharded
+runner (sim_runner.py) and the online training loader (online_sim.py).
+
+@author: I.Azuma
+"""
+import numpy as np
+from scipy.sparse import csr_matrix, issparse
+
+def selection_matrix(pooled_idx, n_cells):
+    """
+    Sparse (n_samples x n_cells) count matrix from per-sample cell indices.
+    A cell drawn k times (with replacement) gets the count k.
+    """
+    indptr = np.zeros(len(pooled_idx) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum([len(i) for i in pooled_idx])
+    indices = np.concatenate(pooled_idx).astype(np.int64) if indptr[-1] > 0 else np.zeros(0, dtype=np.int64)
+    return count_matrix(indptr, indices, n_cells)
+
+def count_matrix(indptr, indices, n_cells):
+    """
+    Selection-count matrix from flat (indptr, cell indices), duplicates summed.
+    """
+    S = csr_matrix((np.ones(len(indices), dtype=np.float64), indices, indptr), shape=(len(indptr) - 1, n_cells))
+    S.sum_duplicates()
+    return S
+
+def pseudo_bulk(X, S, chunk_size=1000):
+    """
+    S @ X in row chunks of S, without densifying X (cells x genes, sparse or dense).
+    For floating X the sums are accumulated in the dtype of X (float32 for the simulators), as
+    X[idx].sum(axis=0) did; integer X is summed in float64 and returned as X.sum(axis=0) would be.
+    """
+    out_dtype = np.sum(np.zeros(1, dtype=X.dtype)).dtype
+    if np.issubdtype(X.dtype, np.floating):
+        S = S.astype(X.dtype)
+    out = np.empty((S.shape[0], X.shape[1]), dtype=out_dtype)
+    for start in range(0, S.shape[0], chunk_size):
+        # NOTE: the summation order differs from X[idx].sum(axis=0), so non-integer float32 values match to rounding only
+        res = S[start:start + chunk_size] @ X
+        out[start:start + chunk_size] = res.toarray() if issparse(res) else res
+    return out
+
+class CellSampler:
+    """
+    Batched per-sample cell sampling with counter-based Philox streams.
+    Sample s draws from Generator(Philox(key=[seed, s])), so its cells do not depend on the block
+    it is drawn in or on the number of workers. Within a cell type, cells are drawn without
+    replacement when enough candidates exist (the first k distinct of the uniform draws, i.e.
+    sequential rejection) and with replacement otherwise, as in the RandomState loops.
+    """
+    def __init__(self, candi_list, pool_size=500, seed=42, oversample=8):
+        self.candi_list = [np.asarray(c, dtype=np.int64) for c in candi_list]
+        self.n_candi = np.array([len(c) for c in self.candi_list], dtype=np.int64)
+        self.offsets = np.concatenate([[0], np.cumsum(self.n_candi)[:-1]])
+        self.all_candi = np.concatenate(self.candi_list) if self.n_candi.sum() > 0 else np.zeros(0, dtype=np.int64)
+        self.pool_size = pool_size
+        self.seed = seed
+        self.oversample = oversample
+
+    def counts(self, props):
+        # same as int(pool_size * p) per cell type
+        return (self.pool_size * np.asarray(props, dtype=np.float64)).astype(np.int64)
+
+    def _stream(self, sample_id):
+        return np.random.Generator(np.random.Philox(key=[self.seed, int(sample_id)]))
+
+    def sample_block(self, props, sample_ids):
+        """
+        Draw cells for a block of samples. props: (n_block, n_types) proportions.
+        Returns indptr (n_block + 1), cells (candidate cell indices) and types (cell type position),
+        ordered by sample, then cell type, then draw order.
+        """
+        counts = self.counts(props)
+        n_block, n_types = counts.shape
+        m = np.broadcast_to(self.n_candi, counts.shape)
+        if ((counts > 0) & (m == 0)).any():
+            raise ValueError("No candidate cells for a cell type with a non-zero proportion.")
+
+        # draw budget per (sample, type): the expected number of repeats for k out of m is ~k^2 / 2m
+        replace = m < counts
+        extra = np.minimum(m - counts, 2 * counts * counts // np.maximum(m, 1) + self.oversample)
+        budget = np.where(replace | (counts == 0), counts, counts + extra)
+
+        u = np.concatenate([self._stream(s).random(int(budget[i].sum())) for i, s in enumerate(sample_ids)])
+        seg = np.repeat(np.arange(n_block * n_types), budget.ravel())  # segments ordered by (sample, type)
+        pos = (u * self.n_candi[seg % n_types]).astype(np.int64)
+
+        # without replacement: keep the first occurrence of each cell within a segment
+        keep = np.ones(len(pos), dtype=bool)
+        norep = ~replace.ravel()[seg]
+        if norep.any():
+            key = seg[norep] * (self.n_candi.max() + 1) + pos[norep]
+            first = np.zeros(norep.sum(), dtype=bool)
+            first[np.unique(key, return_index=True)[1]] = True
+            keep[norep] = first
+        kept_seg = seg[keep]
+        rank = np.arange(len(kept_seg)) - np.searchsorted(kept_seg, kept_seg)
+        take = rank < counts.ravel()[kept_seg]
+        sel_seg, sel_pos = kept_seg[take], pos[keep][take]
+
+        # rare short segments (k close to m): exact draw from a second per-sample stream
+        short = np.where(np.bincount(sel_seg, minlength=n_block * n_types) < counts.ravel())[0]
+        if len(short) > 0:
+            drop = np.isin(sel_seg, short)
+            fix_seg, fix_pos = [sel_seg[~drop]], [sel_pos[~drop]]
+            for i in np.unique(short // n_types):
+                rng = np.random.Generator(np.random.Philox(key=[self.seed, int(sample_ids[i])]).jumped())
+                for sg in short[short // n_types == i]:
+                    k = counts.ravel()[sg]
+                    fix_seg.append(np.full(k, sg))
+                    fix_pos.append(rng.choice(self.n_candi[sg % n_types], size=k, replace=False))
+            sel_seg, sel_pos = np.concatenate(fix_seg), np.concatenate(fix_pos)
+            order = np.argsort(sel_seg, kind='stable')
+            sel_seg, sel_pos = sel_seg[order], sel_pos[order]
+
+        types = sel_seg % n_types
+        cells = self.all_candi[self.offsets[types] + sel_pos]
+        indptr = np.concatenate([[0], np.cumsum(counts.sum(axis=1))])
+        return indptr, cells, types
+
+def legacy_sample_block(props, candi_list, pool_size, sample_ids, legacy_seed):
+    """
+    Same output layout as CellSampler.sample_block, drawn with RandomState(legacy_seed(idx, j))
+    per (sample, cell type) as the original loops (reproduces previously simulated data).
+    """
+    indptr, cells, types = [0], [], []
+    for i, idx in enumerate(sample_ids):
+        for j, p in enumerate(props[i]):
+            tmp_size = int(pool_size * p)  # number of cells to be selected
+            candi_idx = candi_list[j]
+            rng = np.random.RandomState(legacy_seed(idx, j))
+            if len(candi_idx) < tmp_size:
+                select_idx = rng.choice(candi_idx, size=tmp_size, replace=True)
+            else:
+                select_idx = rng.choice(candi_idx, size=tmp_size, replace=False)
+            cells.append(np.asarray(select_idx, dtype=np.int64))
+            types.append(np.full(tmp_size, j))
+        indptr.append(indptr[-1] + sum(len(c) for c in cells[-len(props[i]):]))
+    cells = np.concatenate(cells) if cells else np.zeros(0, dtype=np.int64)
+    types = np.concatenate(types) if types else np.zeros(0, dtype=np.int64)
+    return np.array(indptr), cells, types
+
+def iter_cell_blocks(summary_df, candi_list, pool_size=500, sampler='philox', seed=42, chunk_size=1000, legacy_seed=None):
+    """
+    Yield (start, end, indptr, cells, types) over blocks of summary_df rows.
+    sampler='philox' uses CellSampler; sampler='legacy' reproduces the per-(sample, type) RandomState draws.
+    """
+    if sampler not in ['philox', 'legacy']:
+        raise ValueError("sampler must be 'philox' or 'legacy'.")
+    props = summary_df.values
+    n_types = props.shape[1]
+    if legacy_seed is None:
+        legacy_seed = lambda idx, j: 42 + idx * n_types + j
+    cell_sampler = CellSampler(candi_list, pool_size=pool_size, seed=seed)
+    for start in range(0, len(props), chunk_size):
+        end = min(start + chunk_size, len(props))
+        if sampler == 'philox':
+            indptr, cells, types = cell_sampler.sample_block(props[start:end], np.arange(start, end))
+        else:
+            indptr, cells, types = legacy_sample_block(props[start:end], candi_list, pool_size, range(start, end), legacy_seed)
+        yield start, end, indptr, cells, types
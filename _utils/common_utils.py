@@ -17,7 +17,7 @@ import seaborn as sns
 from tqdm import tqdm
 from scipy import stats
 import matplotlib.pyplot as plt
-from scipy.sparse import csr_matrix
+from scipy.sparse import csr_matrix, issparse
 from matplotlib import colors as mcolors
 from sklearn.preprocessing import MinMaxScaler
 
@@ -30,6 +30,7 @@ from torch.nn import functional as F
 sys.path.append(BASE_DIR+'/github/GLDADec')
 from _utils import gldadec_processing
 from _utils import plot_utils as pu
+from _utils.sparse_input import csr_to_torch
 
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
@@ -108,15 +109,19 @@ def calc_deconv_loss(theta_tensor, prop_tensor):
 
     return {'mse':mse, 'rmse':rmse, 'cel':cel, 'cos_sim':cos_sim}
 
-def get_batches(train_data, batch_size=300, rand=True, device="cuda:0"):
+def get_batches(train_data, batch_size=300, rand=True, device="cuda:0", sparse=False):
     """
     (
         train_data,
         train_label,
         train_text,
     ) = reader.get_sparse_matrix("train+valid", mode="count")
+
+    sparse=True yields csr_matrix batches as torch sparse CSR tensors instead of densifying them.
     """
     n, d = train_data.shape
+    if issparse(train_data):
+        train_data = csr_matrix(train_data)
 
     batchs = n // batch_size
     while True:
@@ -135,8 +140,9 @@ def get_batches(train_data, batch_size=300, rand=True, device="cuda:0"):
             idx = idxs[beg:end]
             # data format
             if isinstance(train_data, csr_matrix):
-                data = train_data[idx].toarray()  # csr_matrix
+                batch = train_data[idx]  # row slicing keeps CSR
+                data = csr_to_torch(batch) if sparse else torch.from_numpy(batch.toarray())
             else:
-                data = train_data[idx]  # NumPy
-            data = torch.from_numpy(data).to(device)
+                data = torch.from_numpy(train_data[idx])  # NumPy
+            data = data.to(device)
             yield idx, data  # update 240915s
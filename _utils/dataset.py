@@ -11,6 +11,7 @@ import os
 os.chdir(BASE_DIR)
 
 import gc
+import time
 import random
 import anndata
 import numpy as np
@@ -19,7 +20,8 @@ import scanpy as sc
 
 from anndata import AnnData
 from anndata import read_h5ad
-from scipy.sparse import vstack, issparse
+from concurrent.futures import ThreadPoolExecutor
+from scipy.sparse import vstack, issparse, csr_matrix
 from sklearn.preprocessing import MinMaxScaler
 
 import torch
@@ -27,42 +29,82 @@ import torch.nn as nn
 import torch.utils.data as Data
 import torch.backends.cudnn as cudnn
 
+from _utils.prep_cache import PrepCache, make_key
+from _utils.target_io import GeneAlignmentIndex, read_aligned_target
+
 
 def prep4benchmark(h5ad_path, source_list=['data6k'], target='sdy67', priority_genes=[], 
                    target_cells=['Monocytes', 'Unknown', 'CD4Tcells', 'Bcells', 'NK', 'CD8Tcells'], 
-                   n_samples=None, n_vtop=None, mm_scale=False, seed=42, vtop_mode='train'):
+                   n_samples=None, n_vtop=None, mm_scale=False, seed=42, vtop_mode='train',
+                   cache_dir=None, cache_max_gb=20.0, cache_checksum=False, backed=False, sparse_input=False, n_jobs=1):
     print(f"Source domain: {source_list}")
     print(f"Target domain: {target}")
-
-    pbmc = sc.read_h5ad(h5ad_path)
+    log_conv = (target != 'GSE65133')
+
+    # Preprocessing cache (skips h5ad parsing on a hit)
+    if cache_dir is not None:
+        params = dict(fn='prep4benchmark', source_list=source_list, target=target, target_cells=target_cells,
+                      priority_genes=priority_genes, n_samples=n_samples, n_vtop=n_vtop, vtop_mode=vtop_mode,
+                      seed=seed, log_conv=log_conv, mm_scale=mm_scale, sparse_input=sparse_input)
+        cache = PrepCache(cache_dir, max_gb=cache_max_gb)
+        key = make_key([h5ad_path], params, checksum=cache_checksum)
+        hit = cache.get(key)
+        if hit is not None:
+            train_data, test_data, gene_names = hit
+            return train_data, test_data, train_data.obs[target_cells], test_data.obs[target_cells], gene_names
+
+    if backed:
+        # NOTE: sources are sampled while reading, in the same order as extract_variable_sources
+        pbmc = read_h5ad_subset(h5ad_path, source_list, target, n_samples=n_samples, seed=seed)
+        n_samples = None
+    else:
+        pbmc = sc.read_h5ad(h5ad_path)
     test = pbmc[pbmc.obs['ds'] == target]
 
     train, label_idx = extract_variable_sources(pbmc, source_list, target, n_samples=n_samples, n_vtop=n_vtop, seed=seed, vtop_mode=vtop_mode)
-    train_data, test_data, train_y, gene_names = finalize_data(train, test, label_idx, target_cells, priority_genes, log_conv=(target != 'GSE65133'), mm_scale=mm_scale)
+    train_data, test_data, train_y, gene_names = finalize_data(train, test, label_idx, target_cells, priority_genes, log_conv=log_conv, mm_scale=mm_scale, n_jobs=n_jobs, sparse=sparse_input)
     test_y = test.obs[target_cells]
 
+    if cache_dir is not None:
+        cache.put(key, train_data, test_data, gene_names, params=params)
+        train_data, test_data, gene_names = cache.get(key)  # NOTE: same (memory-mapped) outputs as a hit
+
     return train_data, test_data, train_y, test_y, gene_names
 
 def prep4inference(h5ad_path, target_path, source_list=['data6k'], target='TSCA_Lung', priority_genes=[], 
              target_cells=['Monocytes', 'Unknown', 'CD4Tcells', 'Bcells', 'NK', 'CD8Tcells'], 
-             n_samples=None, n_vtop=None, target_log_conv=True, mm_scale=False, seed=42, vtop_mode='train'):
-
-    source_adata = sc.read_h5ad(h5ad_path)
-    target_df = pd.read_csv(target_path, index_col=0)
-
-    # Match gene names
-    target_df.index = target_df.index.str.upper()
-    target_genes = target_df.index
-    source_adata.var_names = source_adata.var_names.str.upper()
-    source_genes = source_adata.var_names
-    common_genes = target_genes.intersection(source_genes)
-    target_df_filtered = target_df.loc[common_genes]
-    if len(common_genes) < 100:
-        print(f"Warning: Only {len(common_genes)} common genes found between source and target datasets. This may affect model performance.")
-
-    target_adata = AnnData(X=target_df_filtered.T.values)
-    target_adata.var_names = target_df_filtered.index
-    target_adata.obs_names = target_df_filtered.columns
+             n_samples=None, n_vtop=None, target_log_conv=True, mm_scale=False, seed=42, vtop_mode='train',
+             cache_dir=None, cache_max_gb=20.0, cache_checksum=False, backed=False, target_chunksize=5000, sparse_input=False, n_jobs=1):
+
+    # Preprocessing cache (skips h5ad/target parsing on a hit)
+    if cache_dir is not None:
+        params = dict(fn='prep4inference', source_list=source_list, target=target, target_cells=target_cells,
+                      priority_genes=priority_genes, n_samples=n_samples, n_vtop=n_vtop, vtop_mode=vtop_mode,
+                      seed=seed, log_conv=target_log_conv, mm_scale=mm_scale, sparse_input=sparse_input)
+        cache = PrepCache(cache_dir, max_gb=cache_max_gb)
+        key = make_key([h5ad_path, target_path], params, checksum=cache_checksum)
+        hit = cache.get(key)
+        if hit is not None:
+            train_data, test_data, gene_names = hit
+            return train_data, test_data, train_data.obs[target_cells], gene_names
+
+    # Align target genes to the source atlas (persistent index, chunked multi-format reader)
+    gene_index = GeneAlignmentIndex.from_h5ad(h5ad_path, cache_dir=cache_dir)
+    target_X, common_cols, sample_names = read_aligned_target(target_path, gene_index, chunksize=target_chunksize)
+    if len(common_cols) < 100:
+        print(f"Warning: Only {len(common_cols)} common genes found between source and target datasets. This may affect model performance.")
+
+    if backed:
+        # NOTE: only the sampled source rows and the genes shared with the target are read
+        source_adata = read_h5ad_subset(h5ad_path, source_list, None, n_samples=n_samples, seed=seed, var_idx=common_cols)
+        source_adata.var_names = source_adata.var_names.str.upper()
+        n_samples = None
+    else:
+        source_adata = sc.read_h5ad(h5ad_path)
+        source_adata.var_names = source_adata.var_names.str.upper()
+        source_adata = source_adata[:, common_cols]  # NOTE: view; rows are gathered once in extract_variable_sources
+
+    target_adata = AnnData(X=target_X, obs=pd.DataFrame(index=sample_names), var=source_adata.var.copy())
     target_adata.obs['ds'] = target
 
     print("Target data shape: ", target_adata.X.shape)
@@ -73,49 +115,95 @@ def prep4inference(h5ad_path, target_path, source_list=['data6k'], target='TSCA_
     for col in source_adata.obs.columns:
         if col not in target_adata.obs:
             target_adata.obs[col] = target if col == "ds" else (2 if col == "batch" else np.nan)
-    
-    combined_adata = sc.concat([source_adata, target_adata], join='inner', merge='first')
-    test = combined_adata[combined_adata.obs['ds'] == target]
+    test = target_adata
+
+    train, label_idx = extract_variable_sources(source_adata, source_list, target, n_samples=n_samples, n_vtop=n_vtop, seed=seed, vtop_mode=vtop_mode, test=test)
+    train_data, test_data, train_y, gene_names = finalize_data(train, test, label_idx, target_cells, priority_genes, log_conv=target_log_conv, mm_scale=mm_scale, n_jobs=n_jobs, sparse=sparse_input)
 
-    train, label_idx = extract_variable_sources(combined_adata, source_list, target, n_samples=n_samples, n_vtop=n_vtop, seed=seed, vtop_mode=vtop_mode)
-    train_data, test_data, train_y, gene_names = finalize_data(train, test, label_idx, target_cells, priority_genes, log_conv=target_log_conv, mm_scale=mm_scale)
+    if cache_dir is not None:
+        cache.put(key, train_data, test_data, gene_names, params=params)
+        train_data, test_data, gene_names = cache.get(key)  # NOTE: same (memory-mapped) outputs as a hit
 
     return train_data, test_data, train_y, gene_names
 
-def extract_variable_sources(pbmc, source_list, target, n_samples=None, n_vtop=None, seed=42, vtop_mode='train'):
-    # 1. Concatenate data from specified sources
-    train = None
-    
-    # Calculate samples per source if n_samples is specified
+def select_source_rows(ds, source_list, target=None, n_samples=None, seed=42):
+    """
+    Row positions of the (sampled) sources followed by the target rows.
+    Positions per domain are grouped once; each source is sampled with RandomState(seed + i),
+    which draws the same rows as np.random.seed(seed + i) + np.random.choice.
+    """
+    ds = np.asarray(ds)
+    groups = pd.Series(np.arange(ds.shape[0])).groupby(ds, sort=False).indices
+    empty = np.array([], dtype=np.int64)
     if n_samples is not None:
         samples_per_source = n_samples // len(source_list)
         remainder = n_samples % len(source_list)
-    
+
+    rows = []
     for i, s_name in enumerate(source_list):
-        data = pbmc[pbmc.obs['ds'] == s_name]
+        start = time.perf_counter()
+        s_rows = groups.get(s_name, empty)
         if n_samples is not None:
-            # Calculate number of samples for this source
             current_n_samples = samples_per_source + (1 if i < remainder else 0)
-            
-            np.random.seed(seed + i)  # Different seed for each source to ensure reproducibility
-            idx = np.random.choice(data.shape[0], current_n_samples, replace=False)
-            data = data[idx]
-            print(f"Source '{s_name}': {current_n_samples} samples selected from {pbmc[pbmc.obs['ds'] == s_name].shape[0]} available")
+            idx = np.random.RandomState(seed + i).choice(s_rows.shape[0], current_n_samples, replace=False)
+            rows.append(s_rows[idx])
+            print(f"Source '{s_name}': {current_n_samples} samples selected from {s_rows.shape[0]} available ({time.perf_counter() - start:.3f} s)")
         else:
-            print(f"Source '{s_name}': {data.shape[0]} samples (all available)")
-        train = data if train is None else anndata.concat([train, data])
-    
-    test = pbmc[pbmc.obs['ds'] == target]
+            rows.append(s_rows)
+            print(f"Source '{s_name}': {s_rows.shape[0]} samples (all available) ({time.perf_counter() - start:.3f} s)")
+    if target is not None:
+        rows.append(groups.get(target, empty))
+
+    return np.concatenate(rows)
+
+def read_h5ad_subset(h5ad_path, source_list, target=None, n_samples=None, seed=42, var_names=None,
+                     upper_var=False, var_idx=None, chunk_size=5000):
+    """
+    Read only the requested domains (and genes) from an h5ad file opened with backed='r'.
+    obs is read first, rows are materialised in chunks and sliced to the requested genes,
+    so peak memory scales with the selected subset instead of the full atlas.
+    """
+    adata_b = read_h5ad(h5ad_path, backed='r')
+    rows = select_source_rows(adata_b.obs['ds'].values, source_list, target, n_samples=n_samples, seed=seed)
+    uniq_rows, inverse = np.unique(rows, return_inverse=True)  # NOTE: h5py requires increasing indices
+
+    if var_idx is not None:
+        col_idx = np.asarray(var_idx)
+    elif var_names is not None:
+        names = adata_b.var_names.str.upper() if upper_var else adata_b.var_names
+        col_idx = np.where(names.isin(var_names))[0]
+    else:
+        col_idx = np.arange(adata_b.shape[1])
+
+    X_list = []
+    for start in range(0, uniq_rows.shape[0], chunk_size):
+        part = adata_b[uniq_rows[start:start + chunk_size]].to_memory().X
+        X_list.append(part[:, col_idx])
+    if len(X_list) == 0:
+        X = np.zeros((0, col_idx.shape[0]), dtype=np.float32)
+    elif issparse(X_list[0]):
+        X = csr_matrix(vstack(X_list))
+    else:
+        X = np.vstack(X_list)
+    X = X[inverse]
 
-    # 2. Calculate highly variable genes
-    def get_var_indices(X, top_n):
-        # Handle sparse matrix
-        if issparse(X):
-            X = X.toarray()
-        if top_n is None:
-            return np.where(X.var(axis=0) > 0.1)[0]
-        return np.argsort(-X.var(axis=0))[:top_n]
+    sub = AnnData(X=X, obs=adata_b.obs.iloc[rows].copy(), var=adata_b.var.iloc[col_idx].copy(), uns=dict(adata_b.uns))
+    print(f"Read {sub.shape[0]} x {sub.shape[1]} subset from {adata_b.shape[0]} x {adata_b.shape[1]} (backed)")
+    adata_b.file.close()
+
+    return sub
 
+def extract_variable_sources(pbmc, source_list, target, n_samples=None, n_vtop=None, seed=42, vtop_mode='train', test=None):
+    # 1. Gather data from specified sources (row indices per source, one indexing operation)
+    start = time.perf_counter()
+    rows = select_source_rows(pbmc.obs['ds'].values, source_list, n_samples=n_samples, seed=seed)
+    train = pbmc[rows].copy()
+    print(f"Gathered {train.shape[0]} source samples ({time.perf_counter() - start:.3f} s)")
+
+    if test is None:
+        test = pbmc[pbmc.obs['ds'] == target]
+
+    # 2. Calculate highly variable genes
     if vtop_mode == 'train':
         label_idx = get_var_indices(train.X, n_vtop)
 
@@ -145,47 +233,190 @@ def calc_vtop(train, test=None, n_vtop=1000, mode='train'):
         raise ValueError("test data must be provided when mode is 'test' or 'both'")
 
     if mode == 'train':
-        X = train.X
+        stats = column_stats(train.X)
     elif mode == 'test':
-        X = test.X
+        stats = column_stats(test.X)
     elif mode == 'both':
-        X = vstack([train.X, test.X]) if issparse(train.X) else np.vstack([train.X, test.X])
-
-    # Convert sparse to dense if needed
-    if issparse(X):
-        X = X.toarray()
-
-    if n_vtop is None:
-        label = X.var(axis=0) > 0.1
-        label_idx = np.where(label)[0]
-    else:
-        label_idx = np.argsort(-X.var(axis=0))[:n_vtop]
-
-    return label_idx
-
-
-def finalize_data(train, test, label_idx, target_cells, priority_genes=[], log_conv=True, mm_scale=False):
+        # NOTE: merge the per-matrix statistics instead of stacking train and test
+        stats = merge_column_stats(column_stats(train.X), column_stats(test.X))
+
+    n, _, m2 = stats
+    return select_var_indices(m2 / n, n_vtop)
+
+
+def column_stats(X, chunk_size=10000, chunk_bytes=256 << 20):
+    """
+    Streaming per-column (n, mean, M2) over row chunks without densifying the whole matrix.
+    Works on dense/CSR/CSC arrays and on backed datasets that support row slicing.
+    Chunks are merged with Chan's parallel (Welford) update.
+    Dense chunks are also limited to chunk_bytes of float64 (one buffer, updated in place).
+    """
+    stats = None
+    n_rows = X.shape[0]
+    if not issparse(X):
+        chunk_size = min(chunk_size, max(1, chunk_bytes // (8 * max(X.shape[1], 1))))
+    for start in range(0, n_rows, chunk_size):
+        chunk = X[start:min(start + chunk_size, n_rows)]
+        n_c = chunk.shape[0]
+        if issparse(chunk):
+            chunk = chunk.tocoo()
+            mean = np.bincount(chunk.col, weights=chunk.data, minlength=chunk.shape[1]) / n_c
+            # two-pass M2 over non-zeros; the implicit zeros contribute mean^2 each
+            d = chunk.data - mean[chunk.col]
+            nnz = np.bincount(chunk.col, minlength=chunk.shape[1])
+            m2 = np.bincount(chunk.col, weights=d * d, minlength=chunk.shape[1]) + (n_c - nnz) * mean ** 2
+        else:
+            chunk = np.array(chunk, dtype=np.float64)  # NOTE: always a copy, X is not modified
+            mean = chunk.mean(axis=0)
+            chunk -= mean
+            np.square(chunk, out=chunk)
+            m2 = chunk.sum(axis=0)
+        chunk_stats = (n_c, mean, m2)
+        stats = chunk_stats if stats is None else merge_column_stats(stats, chunk_stats)
+    return stats
+
+def merge_column_stats(a, b):
+    n_a, mean_a, m2_a = a
+    n_b, mean_b, m2_b = b
+    n = n_a + n_b
+    delta = mean_b - mean_a
+    mean = mean_a + delta * (n_b / n)
+    m2 = m2_a + m2_b + delta ** 2 * (n_a * n_b / n)
+    return n, mean, m2
+
+def column_variance(X, chunk_size=10000, chunk_bytes=256 << 20):
+    """
+    Population variance per column (same as X.var(axis=0)) computed by column_stats.
+    """
+    n, _, m2 = column_stats(X, chunk_size=chunk_size, chunk_bytes=chunk_bytes)
+    return m2 / n
+
+def select_var_indices(var, top_n=None, thresh=0.1):
+    """
+    Indices of the top_n most variable columns (or var > thresh if top_n is None).
+    Same result as np.argsort(-var, kind='stable')[:top_n]: equal variances are ordered by column
+    index, also at the top_n cut-off. (The old np.argsort(-X.var(axis=0)) used an unstable sort on
+    float32 variances, so the order of exact or rounding-level ties was not defined.)
+    """
+    if top_n is None:
+        return np.where(var > thresh)[0]
+    if top_n >= var.shape[0]:
+        return np.argsort(-var, kind='stable')
+    kth = -np.partition(-var, top_n - 1)[top_n - 1]  # top_n-th largest variance
+    above = np.where(var > kth)[0]
+    ties = np.where(var == kth)[0][:top_n - len(above)]  # lowest column indices win the cut-off
+    idx = np.concatenate([above, ties])
+    return idx[np.argsort(-var[idx], kind='stable')]
+
+def get_var_indices(X, top_n, chunk_size=10000):
+    return select_var_indices(column_variance(X, chunk_size=chunk_size), top_n)
+
+class TransformPipeline:
+    """
+    Column gather + log2(x + 1) + per-sample min-max scaling in one preallocated buffer.
+    Rows are processed in chunks (optionally across threads) and every step is applied in place,
+    so peak memory is about one copy of the selected matrix. The parameters are recorded in
+    `params` so that inference can replay the same transform.
+    sparse=True keeps a sparse input as CSR (log2(x + 1) maps 0 to 0, so only non-zeros are touched).
+    """
+    def __init__(self, label_idx, gene_names=None, log_conv=True, mm_scale=False, dtype=np.float32, chunk_size=4096, n_jobs=1, sparse=False):
+        if sparse and mm_scale:
+            raise ValueError("mm_scale is not supported with sparse=True (the row minimum shift densifies X).")
+        self.label_idx = np.asarray(label_idx)
+        self.gene_names = None if gene_names is None else [str(g) for g in gene_names]
+        self.log_conv = log_conv
+        self.mm_scale = mm_scale
+        self.dtype = np.dtype(dtype)
+        self.chunk_size = chunk_size
+        self.n_jobs = n_jobs
+        self.sparse = sparse
+
+    @property
+    def params(self):
+        return {
+            'gene_names': self.gene_names,
+            'log_conv': bool(self.log_conv),  # log2(x + 1)
+            'mm_scale': bool(self.mm_scale),  # per-sample min-max to [0, 1]
+            'dtype': self.dtype.name,
+        }
+
+    @classmethod
+    def from_params(cls, params, var_names, **kwargs):
+        """
+        Rebuild the pipeline for a new matrix by matching the recorded gene names to var_names.
+        Names are matched exactly, or else case-insensitively (prep4inference records upper-cased
+        symbols) with the first occurrence winning, as in GeneAlignmentIndex.
+        """
+        label_idx = pd.Index(var_names).get_indexer(params['gene_names'])
+        if (label_idx < 0).any():
+            label_idx = GeneAlignmentIndex(var_names).map(params['gene_names'])
+        if (label_idx < 0).any():
+            raise ValueError(f"{(label_idx < 0).sum()} recorded genes are missing from the input")
+        return cls(label_idx, gene_names=params['gene_names'], log_conv=params['log_conv'],
+                   mm_scale=params['mm_scale'], dtype=params['dtype'], **kwargs)
+
+    def transform(self, X):
+        if self.sparse and issparse(X):
+            return self._transform_sparse(X)
+        n = X.shape[0]
+        out = np.empty((n, self.label_idx.shape[0]), dtype=self.dtype)
+
+        def run_chunk(start):
+            end = min(start + self.chunk_size, n)
+            chunk = X[start:end][:, self.label_idx]
+            v = out[start:end]
+            v[...] = chunk.toarray() if issparse(chunk) else chunk
+            if self.log_conv:
+                np.add(v, 1, out=v)
+                np.log2(v, out=v)
+            if self.mm_scale:
+                # same as MinMaxScaler().fit_transform(v.T).T (constant rows map to 0)
+                v_min = v.min(axis=1, keepdims=True)
+                v_range = v.max(axis=1, keepdims=True) - v_min
+                v_range[v_range == 0] = 1
+                v -= v_min
+                v /= v_range
+
+        starts = range(0, n, self.chunk_size)
+        if self.n_jobs > 1:
+            with ThreadPoolExecutor(max_workers=self.n_jobs) as ex:
+                list(ex.map(run_chunk, starts))
+        else:
+            for start in starts:
+                run_chunk(start)
+
+        return out
+
+    def _transform_sparse(self, X):
+        chunks = []
+        for start in range(0, X.shape[0], self.chunk_size):
+            chunk = csr_matrix(X[start:start + self.chunk_size][:, self.label_idx], dtype=self.dtype)
+            if self.log_conv:
+                np.add(chunk.data, 1, out=chunk.data)
+                np.log2(chunk.data, out=chunk.data)
+            chunks.append(chunk)
+        return vstack(chunks, format='csr') if len(chunks) > 1 else chunks[0]
+
+def finalize_data(train, test, label_idx, target_cells, priority_genes=[], log_conv=True, mm_scale=False, n_jobs=1, sparse=False):
     priority_label = np.array([gene in priority_genes for gene in train.var_names])
     priority_idx = np.where(priority_label)[0]
     print(f"Priority genes: {np.sum(priority_label)}/{len(priority_genes)} genes")
 
-    label_idx = np.unique(np.concatenate([label_idx, priority_idx]))
+    label_idx = np.unique(np.concatenate([label_idx, priority_idx])).astype(int)
     gene_names = train.var_names[label_idx]
 
-    train_data = train[:, label_idx].copy()
-    train_data.X = np.log2(train_data.X + 1)
-
-    test_data = test[:, label_idx].copy()
+    # NOTE: only the source side is kept sparse; the bulk target is dense
+    train_tf = TransformPipeline(label_idx, gene_names=gene_names, log_conv=True, mm_scale=mm_scale, n_jobs=n_jobs, sparse=sparse)
+    test_tf = TransformPipeline(label_idx, gene_names=gene_names, log_conv=log_conv, mm_scale=mm_scale, n_jobs=n_jobs)
     if log_conv:
         print("Applying log2 transformation...")
-        test_data.X = np.log2(test_data.X + 1)
-    
-    # min-max scaling
     if mm_scale:
         print("Applying Min-Max scaling...")
-        mms = MinMaxScaler()
-        train_data.X = mms.fit_transform(train_data.X.T).T
-        test_data.X = mms.fit_transform(test_data.X.T).T
+
+    train_data = AnnData(X=train_tf.transform(train.X), obs=train.obs.copy(), var=train.var.iloc[label_idx].copy(), uns=dict(train.uns))
+    train_data.uns['transform'] = train_tf.params
+    test_data = AnnData(X=test_tf.transform(test.X), obs=test.obs.copy(), var=test.var.iloc[label_idx].copy(), uns=dict(test.uns))
+    test_data.uns['transform'] = test_tf.params
 
     print("Train data shape: ", train_data.X.shape)
     print("Test data shape: ", test_data.X.shape)
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+Created on 2026-10-19 (Mon) 21:05:18
+
+Preprocessed-feature store shared by TRIAD (prep4benchmark / prep4inference), the baseline
+prep functions (prep4pbmc / prep4tissue) and the route3-7 preprocess functions (store_dir keyword).
+
+An entry holds the outputs of one preprocessing call, keyed by a hash of FORMAT_VERSION, the
+input file fingerprints and the call arguments. Arrays and AnnData X are written as .npy and read back
+with mmap_mode='r' (zero-copy, read-only) in their original dtype; sparse X is stored as .npz and DataFrames and other
+small objects are pickled. meta.json is written last, so partially written entries are ignored.
+The total size can be bounded with LRU eviction (access time is tracked by touching meta.json).
+
+@author: I.Azuma
+"""
+import os
+import json
+import shutil
+import hashlib
+import inspect
+import functools
+import numpy as np
+import pandas as pd
+from scipy.sparse import issparse, save_npz, load_npz
+
+from anndata import AnnData
+
+def file_fingerprint(path, checksum=False):
+    """
+    (path, size, mtime) of a file, plus the sha256 of its content if checksum=True.
+    """
+    st = os.stat(path)
+    fp = {'path': os.path.abspath(path), 'size': st.st_size, 'mtime': st.st_mtime}
+    if checksum:
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 24), b''):
+                h.update(chunk)
+        fp['sha256'] = h.hexdigest()
+    return fp
+
+# NOTE: bump when stored outputs change for the same inputs, so that older entries become misses
+# 2: stable tie-break of the top-n variable genes (select_var_indices) and dtype-preserving storage
+FORMAT_VERSION = 2
+
+def make_key(file_paths, params, checksum=False):
+    """
+    Hash of the store format version, input file fingerprints and preprocessing parameters.
+    """
+    payload = {
+        'format_version': FORMAT_VERSION,
+        'files': [file_fingerprint(p, checksum=checksum) for p in file_paths],
+        'params': params,
+    }
+    payload = json.dumps(payload, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()[:32]
+
+def _save_matrix(path, X):
+    if issparse(X):
+        save_npz(path + '.npz', X.tocsr(), compressed=False)
+    else:
+        np.save(path + '.npy', np.asarray(X))
+
+def _load_matrix(path):
+    if os.path.exists(path + '.npz'):
+        return load_npz(path + '.npz').tocsr()
+    return np.load(path + '.npy', mmap_mode='r')
+
+class FeatureStore:
+    """
+    Size-bounded store of preprocessing outputs (a tuple of arrays, AnnData and small objects).
+    """
+    def __init__(self, store_dir, max_gb=None):
+        self.store_dir = store_dir
+        self.max_bytes = None if max_gb is None else int(max_gb * 1e9)
+        os.makedirs(store_dir, exist_ok=True)
+
+    def _entry_dir(self, key):
+        return os.path.join(self.store_dir, key)
+
+    def get(self, key):
+        """
+        Outputs stored under key (arrays memory-mapped), or None.
+        """
+        entry_dir = self._entry_dir(key)
+        meta_path = os.path.join(entry_dir, 'meta.json')
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if 'kinds' not in meta:  # NOTE: entry written by an older layout
+            return None
+        os.utime(meta_path)  # LRU access time
+
+        outputs = tuple(self._load_item(entry_dir, i, kind) for i, kind in enumerate(meta['kinds']))
+        print(f"Loaded preprocessed features from store: {entry_dir}")
+        return outputs
+
+    def put(self, key, outputs, params=None):
+        entry_dir = self._entry_dir(key)
+        tmp_dir = entry_dir + '.tmp'
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+
+        kinds = [self._save_item(tmp_dir, i, item) for i, item in enumerate(outputs)]
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+            json.dump({'kinds': kinds, 'params': params}, f, default=str)
+
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        os.replace(tmp_dir, entry_dir)
+        self.evict(keep=key)
+
+    def get_or_build(self, key, build_fn, params=None):
+        """
+        Stored outputs for key; on a miss, run build_fn(), store its outputs and return them memory-mapped.
+        """
+        outputs = self.get(key)
+        if outputs is None:
+            self.put(key, build_fn(), params=params)
+            outputs = self.get(key)
+        return outputs
+
+    def evict(self, keep=None):
+        """
+        Remove least recently used entries until the store fits in max_bytes.
+        """
+        if self.max_bytes is None:
+            return
+        entries = []
+        for key in os.listdir(self.store_dir):
+            meta_path = os.path.join(self._entry_dir(key), 'meta.json')
+            if not os.path.exists(meta_path):
+                continue
+            size = sum(e.stat().st_size for e in os.scandir(self._entry_dir(key)) if e.is_file())
+            entries.append((os.path.getmtime(meta_path), key, size))
+
+        total = sum(e[2] for e in entries)
+        for _, key, size in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+            total -= size
+            print(f"Evicted store entry: {key} ({size / 1e9:.2f} GB)")
+
+    def _save_item(self, entry_dir, i, item):
+        path = os.path.join(entry_dir, f'{i}')
+        if isinstance(item, AnnData):
+            _save_matrix(path + '_X', item.X)  # NOTE: dtype kept, so a hit matches the built outputs
+            pd.to_pickle({'obs': item.obs, 'var': item.var, 'uns': dict(item.uns)}, path + '_meta.pkl')
+            return 'adata'
+        if (isinstance(item, np.ndarray) and item.dtype != object) or issparse(item):
+            _save_matrix(path, item)
+            return 'array'
+        pd.to_pickle(item, path + '.pkl')
+        return 'pickle'
+
+    def _load_item(self, entry_dir, i, kind):
+        path = os.path.join(entry_dir, f'{i}')
+        if kind == 'adata':
+            meta = pd.read_pickle(path + '_meta.pkl')
+            return AnnData(X=_load_matrix(path + '_X'), obs=meta['obs'], var=meta['var'], uns=meta['uns'])
+        if kind == 'array':
+            return _load_matrix(path)
+        return pd.read_pickle(path + '.pkl')
+
+def stored(path_args, seed_args=()):
+    """
+    Decorator adding store_dir / store_max_gb keywords to a preprocessing function that returns a tuple.
+    With store_dir set, the outputs are materialised once per (input files, arguments) key and
+    read back memory-mapped (read-only) on later calls, including the call that built them.
+    path_args names the input file arguments; seed_args names random-state arguments, and a call
+    with any of them left as None is not stored (its outputs differ from run to run).
+    """
+    def decorator(fn):
+        sig = inspect.signature(fn)
+        fn_name = f"{os.path.basename(fn.__code__.co_filename)}:{fn.__qualname__}"
+
+        @functools.wraps(fn)
+        def wrapper(*args, store_dir=None, store_max_gb=None, **kwargs):
+            if store_dir is None:
+                return fn(*args, **kwargs)
+            bound = sig.bind(*args, **kwargs)
+            bound.apply_defaults()
+            params = dict(bound.arguments, fn=fn_name)
+            unseeded = [a for a in seed_args if params.get(a) is None]
+            if len(unseeded) > 0:
+                print(f"Warning: {fn_name} is not stored because {unseeded} is None (unseeded split).")
+                return fn(*args, **kwargs)
+            file_paths = [params[a] for a in path_args if params.get(a) is not None]
+            key = make_key(file_paths, params)
+
+            store = FeatureStore(store_dir, max_gb=store_max_gb)
+            return store.get_or_build(key, lambda: tuple(fn(*args, **kwargs)), params=params)
+        return wrapper
+    return decorator
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+Created on 2026-10-19 (Mon) 17:45:26
+
+Memory-mapped (out-of-core) source dataset for TRIAD training.
+
+The source matrix is stored as float32 .npy files (X.npy, y.npy) and opened with
+mmap_mode='r'. MemmapSourceLoader shuffles the block order, then the rows within each
+block, so reads stay mostly sequential, and a background thread prefetches the next blocks.
+No full in-memory copy of X is made.
+
+@author: I.Azuma
+"""
+import os
+import json
+import queue
+import hashlib
+import threading
+import numpy as np
+
+import torch
+
+def source_fingerprint(source_data, target_cells):
+    """
+    Identity of the source matrix written to the memmap: shape, genes, target cells, transform and a hash of the rows (obs_names).
+    """
+    h = hashlib.sha256('\n'.join(str(o) for o in source_data.obs_names).encode()).hexdigest()
+    return {
+        'shape': [int(source_data.shape[0]), int(source_data.shape[1])],
+        'gene_names': [str(g) for g in source_data.var_names],
+        'target_cells': [str(c) for c in target_cells],
+        'transform': json.loads(json.dumps(source_data.uns.get('transform'), default=str)),
+        'obs_hash': h,
+    }
+
+def memmap_matches(out_dir, fingerprint):
+    """
+    True if out_dir holds a complete memmap of the source with this fingerprint.
+    """
+    meta_path = os.path.join(out_dir, 'meta.json')
+    if not os.path.exists(meta_path):
+        return False
+    with open(meta_path) as f:
+        meta = json.load(f)
+    return all(meta.get(k) == v for k, v in fingerprint.items())
+
+def write_source_memmap(source_data, target_cells, out_dir, chunk_size=10000):
+    """
+    Write AnnData (in-memory or backed) X and target_cells proportions to out_dir in row chunks.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    meta_path = os.path.join(out_dir, 'meta.json')
+    if os.path.exists(meta_path):
+        os.remove(meta_path)  # NOTE: meta.json is written last, so a partial rewrite is never reused
+    n, d = source_data.shape
+    X_mm = np.lib.format.open_memmap(os.path.join(out_dir, 'X.npy'), mode='w+', dtype=np.float32, shape=(n, d))
+    for start in range(0, n, chunk_size):
+        chunk = source_data.X[start:start + chunk_size]
+        X_mm[start:start + chunk.shape[0]] = chunk.toarray() if hasattr(chunk, 'toarray') else chunk
+    X_mm.flush()
+    del X_mm
+
+    y = np.array([source_data.obs[ctype] for ctype in target_cells], dtype=np.float32).transpose()
+    np.save(os.path.join(out_dir, 'y.npy'), y)
+    with open(meta_path, 'w') as f:
+        json.dump(source_fingerprint(source_data, target_cells), f)
+    print(f"Source memmap written to {out_dir} ({n} x {d})")
+
+class MemmapSourceLoader:
+    """
+    Block-shuffled mini-batch loader over X.npy / y.npy memory maps.
+    Iterating yields (x, y) float32 tensors like a DataLoader over a TensorDataset.
+    With world_size > 1, the shuffled row stream is split by rows, so every rank yields exactly
+    num_samples rows (the same number of batches) even when there are fewer blocks than ranks.
+    """
+    def __init__(self, data_dir, batch_size, block_size=8192, prefetch=2, seed=42, rank=0, world_size=1):
+        self.X = np.load(os.path.join(data_dir, 'X.npy'), mmap_mode='r')
+        self.y = np.load(os.path.join(data_dir, 'y.npy'), mmap_mode='r')
+        with open(os.path.join(data_dir, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.batch_size = batch_size
+        self.block_size = block_size
+        self.prefetch = prefetch
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self.epoch = 0
+
+        n = self.X.shape[0]
+        self.n_blocks = int(np.ceil(n / block_size))
+        self.num_samples = int(np.ceil(n / world_size))
+
+    def __len__(self):
+        return int(np.ceil(self.num_samples / self.batch_size))
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _block_order(self):
+        # NOTE: the same on every rank, so the ranks split one shuffled row stream
+        return np.random.default_rng([self.seed, self.epoch]).permutation(self.n_blocks)
+
+    def _block_perm(self, b, n_rows):
+        # in-block shuffle keyed by the block, so a block shared by two ranks is shuffled identically
+        return np.random.default_rng([self.seed, self.epoch, int(b)]).permutation(n_rows)
+
+    def _segments(self):
+        """
+        (block, offset, end) pieces of this rank's rows. The shuffled blocks form one stream of n rows,
+        padded by cycling to num_samples * world_size (as DistributedSampler); rank r takes the r-th slice.
+        """
+        n = self.X.shape[0]
+        order = self._block_order()
+        lengths = np.array([min((b + 1) * self.block_size, n) - b * self.block_size for b in order])
+        cum = np.concatenate([[0], np.cumsum(lengths)])
+        p, stop = self.rank * self.num_samples, (self.rank + 1) * self.num_samples
+        segments = []
+        while p < stop and n > 0:
+            q = p % n
+            k = np.searchsorted(cum, q, side='right') - 1
+            offset = q - cum[k]
+            take = min(lengths[k] - offset, stop - p)
+            segments.append((order[k], offset, offset + take))
+            p += take
+        return segments
+
+    def _read_blocks(self, q, stop):
+        for b, offset, end in self._segments():
+            if stop.is_set():
+                break
+            start = b * self.block_size
+            block_end = min(start + self.block_size, self.X.shape[0])
+            perm = self._block_perm(b, block_end - start)[offset:end]
+            x = np.asarray(self.X[start:block_end])[perm]  # sequential read, then in-memory shuffle
+            y = np.asarray(self.y[start:block_end])[perm]
+            q.put((x, y))
+        q.put(None)
+
+    def __iter__(self):
+        q = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        worker = threading.Thread(target=self._read_blocks, args=(q, stop), daemon=True)
+        worker.start()
+
+        buf_x, buf_y, n_buf = [], [], 0
+        remaining = self.num_samples
+        try:
+            while remaining > 0:
+                item = q.get()
+                if item is None:
+                    break
+                buf_x.append(item[0])
+                buf_y.append(item[1])
+                n_buf += item[0].shape[0]
+                while n_buf >= self.batch_size or (n_buf > 0 and n_buf >= remaining):
+                    x = np.concatenate(buf_x) if len(buf_x) > 1 else buf_x[0]
+                    y = np.concatenate(buf_y) if len(buf_y) > 1 else buf_y[0]
+                    k = min(self.batch_size, remaining)
+                    yield torch.from_numpy(x[:k]), torch.from_numpy(y[:k])
+                    buf_x, buf_y = [x[k:]], [y[k:]]
+                    n_buf -= k
+                    remaining -= k
+                    if remaining == 0:
+                        break
+        finally:
+            stop.set()
+            # drain so that the worker is not blocked on a full queue
+            while worker.is_alive():
+                try:
+                    q.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+        self.epoch += 1
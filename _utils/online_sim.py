@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+Created on 2026-10-20 (Tue) 00:07:41
+
+Online pseudo-bulk simulation for TRIAD training.
+
+OnlineBulkLoader keeps the single-cell atlas (raw counts, restricted to the target cell types and
+the genes selected by finalize_data) as a CSR matrix and generates fresh pseudo-bulks for every
+batch: Dirichlet or sparse-uniform proportions, cells drawn with CellSampler, S @ X, then the same
+log2(x + 1) / min-max transform as the source side of finalize_data. Iterating yields (x, y)
+float32 tensors like MemmapSourceLoader, so it plugs into PairPrefetcher and BaseTrainer as is.
+Every batch is seeded by (seed, rank, epoch, batch), so runs are reproducible.
+
+@author: I.Azuma
+"""
+import numpy as np
+from scipy.sparse import csr_matrix, issparse
+
+import torch
+from anndata import read_h5ad
+
+from _utils.cell_sampling import CellSampler, count_matrix, pseudo_bulk
+from _utils.dataset import TransformPipeline
+
+class OnlineBulkLoader:
+    """
+    Pseudo-bulk mini-batches simulated on the fly from per-cell-type expression blocks.
+    method: 'dirichlet' (Dirichlet(alpha) over target_cells) or 'uniform_sparse' (random subset of cell types, uniform weights)
+    """
+    def __init__(self, X, cell_labels, target_cells, label_idx, batch_size, n_batches, pool_size=500,
+                 method='dirichlet', alpha=1.0, log_conv=True, mm_scale=False, seed=42, rank=0, world_size=1):
+        if method not in ['dirichlet', 'uniform_sparse']:
+            raise ValueError(f"Invalid method: {method}")
+        labels = np.asarray(cell_labels).astype(str)
+        keep = np.where(np.isin(labels, list(target_cells)))[0]
+        X = csr_matrix(X) if issparse(X) else np.asarray(X)
+        self.X = X[keep][:, np.asarray(label_idx)]  # only the target cells and the selected genes
+        labels = labels[keep]
+
+        candi_list = [np.where(labels == c)[0] for c in target_cells]
+        missing = [c for c, idx in zip(target_cells, candi_list) if len(idx) == 0]
+        if len(missing) > 0:
+            raise ValueError(f"No cells in the atlas for: {missing}")
+        self.sampler = CellSampler(candi_list, pool_size=pool_size, seed=seed)
+        self.transform = TransformPipeline(np.arange(self.X.shape[1]), log_conv=log_conv, mm_scale=mm_scale)
+
+        self.target_cells = list(target_cells)
+        self.batch_size = batch_size
+        self.n_batches = n_batches
+        self.method = method
+        self.alpha = alpha
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self.epoch = 0
+
+    @classmethod
+    def from_h5ad(cls, h5ad_path, transform_params, target_cells, celltype_key='celltype', **kwargs):
+        """
+        Atlas h5ad (raw counts) aligned to the genes recorded by finalize_data (source_data.uns['transform']).
+        """
+        adata = read_h5ad(h5ad_path)
+        tf = TransformPipeline.from_params(transform_params, adata.var_names)
+        return cls(adata.X, adata.obs[celltype_key], target_cells, tf.label_idx,
+                   log_conv=tf.log_conv, mm_scale=tf.mm_scale, **kwargs)
+
+    def __len__(self):
+        return self.n_batches
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def proportions(self, rng, n):
+        n_types = len(self.target_cells)
+        if self.method == 'dirichlet':
+            return rng.dirichlet(np.full(n_types, self.alpha), size=n)
+        w = rng.random((n, n_types))
+        present = rng.random((n, n_types)) < 0.5
+        present[np.arange(n), w.argmax(axis=1)] = True  # at least one cell type per sample
+        w = w * present
+        return w / w.sum(axis=1, keepdims=True)
+
+    def __iter__(self):
+        for b in range(self.n_batches):
+            rng = np.random.default_rng([self.seed, self.rank, self.epoch, b])
+            props = self.proportions(rng, self.batch_size)
+            # NOTE: sample ids are unique over (epoch, rank, batch), so every sample has its own Philox stream
+            first = ((self.epoch * self.world_size + self.rank) * self.n_batches + b) * self.batch_size
+            indptr, cells, _ = self.sampler.sample_block(props, np.arange(first, first + self.batch_size))
+            S = count_matrix(indptr, cells, self.X.shape[0])
+            x = self.transform.transform(pseudo_bulk(self.X, S))
+            yield torch.from_numpy(x), torch.from_numpy(props.astype(np.float32))
+        self.epoch += 1
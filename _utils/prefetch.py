@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+Created on 2026-10-19 (Mon) 19:02:47
+
+Background batch prefetcher shared by the trainers.
+
+PairPrefetcher prepares the next K (source_x, source_y, target_x) batches on a worker thread
+(row gather, float32 conversion, optional Gaussian noise on source_x, pinned copy), and the
+training loop only issues non-blocking device copies.
+All random draws (source shuffle, target batches) are taken on the calling thread when the
+epoch starts, so results do not depend on thread timing.
+
+@author: I.Azuma
+"""
+import queue
+import threading
+import numpy as np
+
+import torch
+import torch.utils.data as Data
+
+def _batch_indices(loader):
+    # index batches of a map-style DataLoader (None if the loader has to be iterated)
+    if not isinstance(loader, Data.DataLoader) or isinstance(loader.dataset, Data.IterableDataset):
+        return None
+    if loader.batch_sampler is not None:
+        return loader.batch_sampler
+    if isinstance(loader.sampler, Data.BatchSampler):  # csr_loader
+        return loader.sampler
+    return None
+
+def _iter_batches(loader, sampler):
+    # NOTE: iter(DataLoader) draws a base seed from loader.generator (or the global RNG) before
+    # sampling; drawing it here keeps the seeded batch order identical to iterating the loader
+    torch.empty((), dtype=torch.int64).random_(generator=loader.generator)
+    return iter(sampler)
+
+def _gather(dataset, idx):
+    """
+    Rows idx of a dataset without per-item __getitem__ calls.
+    """
+    if hasattr(dataset, 'gather'):  # CSRDataset
+        return dataset.gather(idx)
+    if isinstance(dataset, Data.TensorDataset):
+        idx = torch.as_tensor(idx)
+        return tuple(t[idx] for t in dataset.tensors)
+    if hasattr(dataset, 'X') and hasattr(dataset, 'Y'):  # simdatset (baselines)
+        return torch.from_numpy(np.asarray(dataset.X[idx])), torch.from_numpy(np.asarray(dataset.Y[idx]))
+    return Data.default_collate([dataset[i] for i in idx])
+
+class PairPrefetcher:
+    """
+    Iterate (source_x, source_y, target_x) device tensors prepared depth batches ahead.
+    target_mode: 'resample' draws a fresh shuffled batch every step (as next(iter(target_loader)))
+                 'cycle' walks through the target loader and restarts it when exhausted
+    target_x is None when target_loader is None. depth=0 prepares batches synchronously.
+    """
+    def __init__(self, source_loader, target_loader=None, device='cpu', depth=2, target_mode='resample',
+                 noise_std=0.0, seed=42, pin_memory=None):
+        if target_mode not in ['resample', 'cycle']:
+            raise ValueError(f"Invalid target_mode: {target_mode}")
+        self.source_loader = source_loader
+        self.target_loader = target_loader
+        self.device = torch.device(device)
+        self.depth = depth
+        self.target_mode = target_mode
+        self.noise_std = noise_std
+        self.seed = seed
+        self.pin_memory = (self.device.type == 'cuda') if pin_memory is None else pin_memory
+        self.epoch = 0
+
+    def __len__(self):
+        return len(self.source_loader)
+
+    def _target_indices(self, n_batches):
+        sampler = _batch_indices(self.target_loader)
+        if sampler is None:
+            raise ValueError("target_loader must be a map-style DataLoader.")
+        if self.target_mode == 'resample':
+            return [list(next(_iter_batches(self.target_loader, sampler))) for _ in range(n_batches)]
+        target_idx, it = [], _iter_batches(self.target_loader, sampler)
+        while len(target_idx) < n_batches:
+            try:
+                target_idx.append(list(next(it)))
+            except StopIteration:
+                it = _iter_batches(self.target_loader, sampler)
+        return target_idx
+
+    def _plan(self):
+        """
+        Draw the epoch's batch indices on the calling thread.
+        """
+        source_sampler = _batch_indices(self.source_loader)
+        if source_sampler is not None:
+            source_idx = [list(b) for b in _iter_batches(self.source_loader, source_sampler)]
+            source_iter = None
+        else:
+            source_idx = None
+            source_iter = iter(self.source_loader)
+        target_idx = None
+        if self.target_loader is not None:
+            target_idx = self._target_indices(len(self.source_loader))
+        return source_idx, source_iter, target_idx
+
+    def _prepare(self, i, source_idx, source_iter, target_idx, rng):
+        if source_idx is not None:
+            source_x, source_y = _gather(self.source_loader.dataset, source_idx[i])[:2]
+        else:
+            source_x, source_y = next(source_iter)[:2]
+        if source_x.dtype != torch.float32:
+            source_x = source_x.float()
+        source_y = source_y.float()
+        if self.noise_std > 0:
+            if source_x.layout != torch.strided:
+                raise ValueError("noise_std > 0 requires dense source batches.")
+            noise = rng.standard_normal(source_x.shape, dtype=np.float32) * self.noise_std
+            source_x = source_x + torch.from_numpy(noise)
+
+        target_x = None
+        if target_idx is not None:
+            target_x = _gather(self.target_loader.dataset, target_idx[i])[0].float()
+
+        batch = (source_x, source_y, target_x)
+        if self.pin_memory:
+            # NOTE: sparse batches are copied from pageable memory
+            batch = tuple(t.pin_memory() if t is not None and t.layout == torch.strided else t for t in batch)
+        return batch
+
+    def _produce(self, q, stop, plan, rng, n_batches):
+        try:
+            for i in range(n_batches):
+                if stop.is_set():
+                    break
+                q.put(self._prepare(i, *plan, rng))
+        except StopIteration:
+            pass
+        except Exception as e:  # NOTE: re-raised on the training thread
+            q.put(e)
+        q.put(None)
+
+    def _to_device(self, batch):
+        return tuple(t.to(self.device, non_blocking=self.pin_memory and t.layout == torch.strided) if t is not None else None for t in batch)
+
+    def __iter__(self):
+        plan = self._plan()
+        n_batches = len(self.source_loader) if plan[0] is None else len(plan[0])
+        rng = np.random.default_rng([self.seed, self.epoch])
+        self.epoch += 1
+
+        if self.depth <= 0:
+            for i in range(n_batches):
+                try:
+                    yield self._to_device(self._prepare(i, *plan, rng))
+                except StopIteration:
+                    return
+            return
+
+        q = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        worker = threading.Thread(target=self._produce, args=(q, stop, plan, rng, n_batches), daemon=True)
+        worker.start()
+        try:
+            while True:
+                item = q.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield self._to_device(item)
+        finally:
+            stop.set()
+            # drain so that the worker is not blocked on a full queue
+            while worker.is_alive():
+                try:
+                    q.get(timeout=0.1)
+                except queue.Empty:
+                    pass
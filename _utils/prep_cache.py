@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+"""
+Created on 2026-10-19 (Mon) 15:10:44
+
+Content-addressed cache of prep4benchmark / prep4inference outputs.
+
+Each entry is keyed by a hash of the store format version, the input file fingerprints and the
+preprocessing arguments, and stores train/test X as .npy in their own dtype (float32 unless
+finalize_data was given another; loaded with mmap_mode='r'), or .npz for a sparse (CSR) X,
+plus obs/var/uns metadata. The total size is bounded with LRU eviction
+(access time is tracked by touching meta.json). A warm hit never opens the h5ad file.
+Entries use the shared FeatureStore layout, so one directory can also serve the baselines.
+
+@author: I.Azuma
+"""
+from _utils.feature_store import FeatureStore, file_fingerprint, make_key
+
+class PrepCache(FeatureStore):
+    """
+    Size-bounded LRU cache of preprocessed (train_data, test_data, gene_names).
+    """
+    def __init__(self, cache_dir, max_gb=20.0):
+        super().__init__(cache_dir, max_gb=max_gb)  # NOTE: the directory is self.store_dir
+
+    def put(self, key, train_data, test_data, gene_names, params=None):
+        super().put(key, (train_data, test_data, gene_names), params=params)
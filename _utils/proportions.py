@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+Created on 2026-10-20 (Tue) 00:41:16
+
+Vectorised cell-type proportion generators for the simulators.
+
+Every row consumes a fixed number of uniforms from a Philox stream whose counter is positioned at
+the row index, so row i is the same whichever block it is generated in (no global seeding).
+Dirichlet draws use the inverse gamma CDF (one uniform per entry) to keep the consumption fixed.
+- 'uniform': uniform weights over all cell types, normalised
+- 'uniform_sparse': random support size (1..n_types) and random cell types, uniform weights
+- 'dirichlet': Dirichlet(alpha) with a scalar or per-cell-type alpha
+groups (e.g. [immune_cells, non_immune_cells]) generate each block separately and combine them
+with equal weights (as GSE139107_Simulator.assign) or Dirichlet(group_alpha) weights.
+
+@author: I.Azuma
+"""
+import numpy as np
+import pandas as pd
+from scipy.special import gammaincinv
+
+def row_uniforms(seed, start, end, k, stream=0):
+    """
+    (end - start, k) uniforms; row i only depends on (seed, stream, i).
+    """
+    c = int(np.ceil(k / 4))  # Philox yields 4 x 64 bits per counter step
+    rng = np.random.Generator(np.random.Philox(key=[seed, stream], counter=start * c))
+    return rng.random((end - start, 4 * c))[:, :k]
+
+def _normalize(w, u):
+    s = w.sum(axis=1, keepdims=True)
+    bad = (s[:, 0] == 0)
+    if bad.any():  # NOTE: all gammas underflowed (tiny alpha); put the row on its largest uniform
+        w[bad] = (u[bad] == u[bad].max(axis=1, keepdims=True)).astype(float)
+        s[bad] = w[bad].sum(axis=1, keepdims=True)
+    return w / s
+
+def uniform_block(u, sparse=False):
+    """
+    Rows from 2 * n_types + 1 (sparse) or n_types uniforms per row.
+    """
+    n, k = u.shape
+    n_types = k // 2 if sparse else k
+    w = u[:, :n_types].copy()
+    if sparse:
+        size = np.minimum((u[:, -1] * n_types).astype(int) + 1, n_types)  # support size 1..n_types
+        rank = np.argsort(np.argsort(u[:, n_types:2 * n_types], axis=1), axis=1)  # random order of cell types
+        w[rank >= size[:, None]] = 0
+    return _normalize(w, u[:, :n_types])
+
+def dirichlet_block(u, alpha):
+    alpha = np.broadcast_to(np.asarray(alpha, dtype=np.float64), (u.shape[1],))
+    return _normalize(gammaincinv(alpha[None, :], u), u)
+
+class ProportionGenerator:
+    """
+    Reproducible per-row proportions over cell_types, generated in blocks.
+    """
+    def __init__(self, cell_types, method='dirichlet', alpha=1.0, groups=None, group_alpha=None, seed=42):
+        if method not in ['uniform', 'uniform_sparse', 'dirichlet']:
+            raise ValueError("Method not supported. Choose 'uniform_sparse', 'uniform', or 'dirichlet'.")
+        self.cell_types = list(cell_types)
+        self.method = method
+        self.groups = [self.cell_types] if groups is None else [list(g) for g in groups]
+        if sorted(c for g in self.groups for c in g) != sorted(self.cell_types):
+            raise ValueError("groups must partition cell_types.")
+        alpha = np.broadcast_to(np.asarray(alpha, dtype=np.float64), (len(self.cell_types),))
+        self.alpha = dict(zip(self.cell_types, alpha))
+        self.group_alpha = group_alpha
+        self.seed = seed
+
+    def _group_block(self, g, start, end):
+        cells = self.groups[g]
+        if self.method == 'dirichlet':
+            u = row_uniforms(self.seed, start, end, len(cells), stream=g + 1)
+            return dirichlet_block(u, [self.alpha[c] for c in cells])
+        sparse = self.method == 'uniform_sparse'
+        u = row_uniforms(self.seed, start, end, 2 * len(cells) + 1 if sparse else len(cells), stream=g + 1)
+        return uniform_block(u, sparse=sparse)
+
+    def block(self, start, end):
+        """
+        (end - start, n_types) proportions of rows start..end-1, columns ordered as cell_types.
+        """
+        n_groups = len(self.groups)
+        if self.group_alpha is None:
+            gw = np.full((end - start, n_groups), 1.0 / n_groups)
+        else:
+            gw = dirichlet_block(row_uniforms(self.seed, start, end, n_groups, stream=0), self.group_alpha)
+        out = np.empty((end - start, len(self.cell_types)))
+        pos = {c: i for i, c in enumerate(self.cell_types)}
+        for g, cells in enumerate(self.groups):
+            out[:, [pos[c] for c in cells]] = self._group_block(g, start, end) * gw[:, [g]]
+        return out
+
+    def iter_blocks(self, n, block_size=100000):
+        for start in range(0, n, block_size):
+            end = min(start + block_size, n)
+            yield start, end, self.block(start, end)
+
+    def generate(self, n, block_size=100000):
+        props = np.empty((n, len(self.cell_types)))
+        for start, end, p in self.iter_blocks(n, block_size=block_size):
+            props[start:end] = p
+        return pd.DataFrame(props, columns=self.cell_types)
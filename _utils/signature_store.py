@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+Created on 2026-10-19 (Mon) 22:41:09
+
+Binary store for per-cell-type signature matrices (GSE139107 *_filtered_matrix.txt).
+
+Each genes x cells text matrix is converted once into a cells x genes CSR matrix saved as
+data.npy / indices.npy / indptr.npy plus meta.json (gene index, cell names, source fingerprint).
+The arrays are opened with mmap_mode='r', so a pseudo-bulk S @ X only pages in the rows of the
+selected cells instead of re-parsing the text file.
+convert_raw_umi fills the store for all cell types in one parallel pass over the raw UMI matrix.
+
+@author: I.Azuma
+"""
+import io
+import os
+import json
+import time
+import hashlib
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from scipy.sparse import csr_matrix, hstack
+
+from tqdm import tqdm
+
+def _fingerprint(path):
+    st = os.stat(path)
+    return {'path': os.path.abspath(path), 'size': st.st_size, 'mtime': st.st_mtime}
+
+def adata_fingerprint(adata):
+    """
+    Identity of an in-memory AnnData stored as a whole atlas: shape, nnz and hashes of var_names / obs_names.
+    """
+    X = adata.X
+    nnz = int(X.nnz) if hasattr(X, 'nnz') else int(np.count_nonzero(X))
+    names = lambda idx: hashlib.sha256('\n'.join(str(v) for v in idx).encode()).hexdigest()
+    return {'shape': [int(adata.shape[0]), int(adata.shape[1])], 'nnz': nnz,
+            'var_hash': names(adata.var_names), 'obs_hash': names(adata.obs_names)}
+
+def _save_entry(out_dir, X, genes, cells, source):
+    os.makedirs(out_dir, exist_ok=True)
+    for name in ['data', 'indices', 'indptr']:
+        np.save(os.path.join(out_dir, f'{name}.npy'), getattr(X, name))
+    # NOTE: meta.json is written last, so an interrupted conversion is redone
+    with open(os.path.join(out_dir, 'meta.json'), 'w') as f:
+        json.dump({'shape': list(X.shape), 'genes': genes, 'cells': cells, 'source': source}, f)
+
+def convert_signature(txt_path, out_dir, chunksize=2000):
+    """
+    genes x cells text matrix --> cells x genes CSR arrays in out_dir (read in gene-row chunks).
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    blocks, genes, cells = [], [], None
+    for df in pd.read_table(txt_path, index_col=0, chunksize=chunksize):
+        if cells is None:
+            cells = [str(c) for c in df.columns]
+        genes.extend(df.index.astype(str))
+        blocks.append(csr_matrix(df.values.astype(np.float32).T))  # cells x genes chunk
+    if cells is None:
+        raise ValueError(f"Empty signature matrix: {txt_path}")
+    X = hstack(blocks, format='csr', dtype=np.float32)
+    X.sort_indices()
+
+    _save_entry(out_dir, X, genes, cells, _fingerprint(txt_path))
+    print(f"Signature converted: {txt_path} --> {out_dir} ({X.shape[0]} cells x {X.shape[1]} genes, nnz={X.nnz})")
+
+def _byte_ranges(path, data_start, chunk_bytes):
+    # [start, end) ranges of whole lines after the header
+    size = os.path.getsize(path)
+    bounds = [data_start]
+    with open(path, 'rb') as f:
+        while bounds[-1] < size:
+            f.seek(min(bounds[-1] + chunk_bytes, size))
+            f.readline()  # move to the next line start
+            bounds.append(min(f.tell(), size))
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def _parse_range(args):
+    """
+    Parse the lines in a byte range and return (genes, [genes x cells csr per type], n_bytes).
+    """
+    path, start, end, usecols, type_cols = args
+    with open(path, 'rb') as f:
+        f.seek(start)
+        buf = f.read(end - start)
+    dtype = {c: np.float32 for c in usecols}
+    dtype[0] = str
+    df = pd.read_csv(io.BytesIO(buf), sep='\t', header=None, usecols=[0] + usecols, dtype=dtype, engine='c')
+    values = df[usecols].values
+    return df[0].tolist(), [csr_matrix(values[:, cols]) for cols in type_cols], end - start
+
+def convert_raw_umi(raw_path, type_samples, store_dir, n_workers=None, chunk_bytes=64 << 20):
+    """
+    Split a genes x cells raw UMI text matrix into per-cell-type entries of the signature store in one pass.
+    type_samples: {cellname: cell barcodes}. Byte-range chunks are parsed in a process pool.
+    """
+    with open(raw_path, 'rb') as f:
+        header_line = f.readline()
+    header = header_line.decode().rstrip('\r\n').split('\t')
+
+    type_idx = {}
+    for cellname, samples in type_samples.items():
+        samples = set(samples)
+        type_idx[cellname] = [i for i in range(1, len(header)) if header[i] in samples]  # header order as filter_exp
+        print("{}: {} cells are detected".format(cellname, len(type_idx[cellname])))
+    usecols = sorted(set(i for idx in type_idx.values() for i in idx))
+    if len(usecols) == 0:
+        raise ValueError("No target cells found in the raw matrix header.")
+    pos = {c: k for k, c in enumerate(usecols)}
+    type_cols = [np.array([pos[i] for i in idx], dtype=np.int64) for idx in type_idx.values()]
+
+    ranges = _byte_ranges(raw_path, len(header_line), chunk_bytes)
+    tasks = [(raw_path, a, b, usecols, type_cols) for a, b in ranges]
+
+    genes, parts = [], [[] for _ in type_idx]
+    n_bytes, t0 = 0, time.time()
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        pbar = tqdm(total=ranges[-1][1] - ranges[0][0] if ranges else 0, unit='B', unit_scale=True)
+        for g, mats, nb in executor.map(_parse_range, tasks):  # NOTE: results come back in file order
+            genes.extend(g)
+            for k, m in enumerate(mats):
+                parts[k].append(m)
+            n_bytes += nb
+            pbar.update(nb)
+        pbar.close()
+    elapsed = time.time() - t0
+    print(f"Parsed {len(genes)} genes, {n_bytes / 1e6:.1f} MB in {elapsed:.1f} s ({n_bytes / 1e6 / max(elapsed, 1e-9):.1f} MB/s)")
+
+    source = _fingerprint(raw_path)
+    for k, (cellname, idx) in enumerate(type_idx.items()):
+        X = csr_matrix(hstack([p.T for p in parts[k]], format='csr', dtype=np.float32)) if parts[k] else csr_matrix((len(idx), 0), dtype=np.float32)
+        X.sort_indices()
+        _save_entry(os.path.join(store_dir, cellname), X, genes, [header[i] for i in idx], source)
+        print(f"{cellname}: {X.shape[0]} cells x {X.shape[1]} genes, nnz={X.nnz}")
+
+class SignatureStore:
+    """
+    Memory-mapped per-cell-type signature matrices under store_dir/{cellname}.
+    """
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+
+    def _entry_dir(self, cellname):
+        return os.path.join(self.store_dir, cellname)
+
+    def meta(self, cellname):
+        meta_path = os.path.join(self._entry_dir(cellname), 'meta.json')
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path) as f:
+            return json.load(f)
+
+    def is_current(self, cellname, txt_path):
+        """
+        True if the entry exists and was not converted from an older version of txt_path.
+        Entries filled from another source (convert_raw_umi, put) are never replaced from txt_path.
+        """
+        meta = self.meta(cellname)
+        if meta is None:
+            return False
+        source = meta.get('source')
+        if not isinstance(source, dict) or source.get('path') != os.path.abspath(txt_path):
+            return True
+        return not os.path.exists(txt_path) or source == _fingerprint(txt_path)
+
+    def convert(self, cellname, txt_path, chunksize=2000, overwrite=False):
+        if not overwrite and self.is_current(cellname, txt_path):
+            return
+        convert_signature(txt_path, self._entry_dir(cellname), chunksize=chunksize)
+
+    def put(self, cellname, X, genes, cells, source=None):
+        """
+        Store a cells x genes matrix (e.g. a whole atlas) under cellname.
+        """
+        X = csr_matrix(X, dtype=np.float32)
+        X.sort_indices()
+        _save_entry(self._entry_dir(cellname), X, [str(g) for g in genes], [str(c) for c in cells], source)
+
+    def load(self, cellname):
+        """
+        (cells x genes csr_matrix on memory-mapped arrays, gene index)
+        """
+        meta = self.meta(cellname)
+        if meta is None:
+            raise ValueError(f"Signature '{cellname}' is not converted in {self.store_dir}.")
+        entry_dir = self._entry_dir(cellname)
+        data, indices, indptr = [np.load(os.path.join(entry_dir, f'{name}.npy'), mmap_mode='r')
+                                 for name in ['data', 'indices', 'indptr']]
+        X = csr_matrix((data, indices, indptr), shape=tuple(meta['shape']), copy=False)
+        return X, pd.Index(meta['genes'])
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+Created on 2026-10-19 (Mon) 23:18:52
+
+Process-pool sharded pseudo-bulk simulation.
+
+The rows of summary_df are split into shards and every shard runs in a worker process that
+attaches to the atlas through the memory-mapped SignatureStore layout (no copy per worker).
+Each worker writes its rows straight into out_dir/bulk.npy (samples x genes, opened with
+mmap_mode='r+') and drops a {start}_{end}.done marker, so an interrupted run resumes with the
+missing shards. meta.json records hashes of the proportions and candidate cells, so an out_dir is
+never reused for a different simulation.
+Cells are drawn with CellSampler (one Philox stream per sample), and every row of S @ X depends
+only on its own sample, so bulk.npy is byte-identical for any shard size or number of workers.
+
+@author: I.Azuma
+"""
+import os
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+from tqdm import tqdm
+
+from _utils.cell_sampling import CellSampler, count_matrix, pseudo_bulk
+from _utils.signature_store import SignatureStore
+
+def _simulate_shard(args):
+    store_dir, atlas_name, out_dir, props, start, candi_list, pool_size, seed, chunk_size = args
+    X, _ = SignatureStore(store_dir).load(atlas_name)
+    bulk = np.load(os.path.join(out_dir, 'bulk.npy'), mmap_mode='r+')
+    cell_sampler = CellSampler(candi_list, pool_size=pool_size, seed=seed)
+    for s in range(0, len(props), chunk_size):
+        e = min(s + chunk_size, len(props))
+        indptr, cells, _ = cell_sampler.sample_block(props[s:e], np.arange(start + s, start + e))
+        S = count_matrix(indptr, cells, X.shape[0])
+        bulk[start + s:start + e] = pseudo_bulk(X, S, chunk_size=chunk_size)
+    bulk.flush()
+    del bulk
+    open(os.path.join(out_dir, 'shards', f'{start}_{start + len(props)}.done'), 'w').close()
+    return start, len(props)
+
+def _hash_arrays(arrays):
+    h = hashlib.sha256()
+    for a in arrays:
+        a = np.ascontiguousarray(a)
+        h.update(str((a.dtype.str, a.shape)).encode())
+        h.update(a.tobytes())
+    return h.hexdigest()
+
+def run_sharded(store_dir, atlas_name, summary_df, candi_list, out_dir, pool_size=500, seed=42,
+                shard_size=2000, chunk_size=500, n_workers=None):
+    """
+    Simulate one pseudo-bulk per summary_df row into out_dir/bulk.npy (samples x genes).
+    Samples without selected cells are kept as zero rows, so rows stay aligned with summary_df.
+    """
+    X, genes = SignatureStore(store_dir).load(atlas_name)
+    props = np.asarray(summary_df.values, dtype=np.float64)
+    n = len(props)
+    out_dtype = np.sum(np.zeros(1, dtype=X.dtype)).dtype
+    os.makedirs(os.path.join(out_dir, 'shards'), exist_ok=True)
+
+    candi_list = [np.asarray(c, dtype=np.int64) for c in candi_list]
+    meta = {'shape': [n, len(genes)], 'dtype': str(out_dtype), 'pool_size': pool_size, 'seed': seed,
+            'atlas': os.path.join(os.path.abspath(store_dir), atlas_name),
+            'atlas_source': SignatureStore(store_dir).meta(atlas_name).get('source'),
+            'props_hash': _hash_arrays([props]), 'candi_hash': _hash_arrays(candi_list), 'shard_size': shard_size}
+    meta_path = os.path.join(out_dir, 'meta.json')
+    bulk_path = os.path.join(out_dir, 'bulk.npy')
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            old = json.load(f)
+        if {k: old.get(k) for k in meta} != meta:
+            raise ValueError(f"{out_dir} holds a different simulation (proportions, cells, atlas or shard_size differ). Please use another out_dir.")
+    else:
+        for name in os.listdir(os.path.join(out_dir, 'shards')):  # NOTE: markers of an incomplete earlier setup
+            os.remove(os.path.join(out_dir, 'shards', name))
+        np.lib.format.open_memmap(bulk_path, mode='w+', dtype=out_dtype, shape=(n, len(genes))).flush()
+        with open(meta_path, 'w') as f:
+            json.dump(dict(meta, genes=list(genes), samples=[str(s) for s in summary_df.index]), f)
+
+    tasks = []
+    for start in range(0, n, shard_size):
+        end = min(start + shard_size, n)
+        if os.path.exists(os.path.join(out_dir, 'shards', f'{start}_{end}.done')):
+            continue
+        tasks.append((store_dir, atlas_name, out_dir, props[start:end], start, candi_list, pool_size, seed, chunk_size))
+    print(f"{len(tasks)} / {int(np.ceil(n / shard_size))} shards to simulate")
+
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        for _ in tqdm(executor.map(_simulate_shard, tasks), total=len(tasks)):
+            pass
+    return load_sharded(out_dir)
+
+def load_sharded(out_dir):
+    """
+    Memory-mapped bulk.npy (samples x genes) and its meta (genes, samples).
+    """
+    with open(os.path.join(out_dir, 'meta.json')) as f:
+        meta = json.load(f)
+    return np.load(os.path.join(out_dir, 'bulk.npy'), mmap_mode='r'), meta
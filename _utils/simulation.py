@@ -12,11 +12,19 @@ import random
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
+from scipy.sparse import csr_matrix, issparse
 
 from tqdm import tqdm
 
 import sys
 
+from _utils.cell_sampling import selection_matrix, count_matrix, pseudo_bulk, CellSampler, legacy_sample_block, iter_cell_blocks
+from _utils.cell_registry import CellIndexRegistry, cell_positions
+from _utils.deconv_qc import group_stats, batched_nnls, eval_props
+from _utils.proportions import ProportionGenerator
+from _utils.signature_store import SignatureStore, convert_raw_umi, adata_fingerprint
+from _utils.sim_runner import run_sharded
+
 sys.path.append(BASE_DIR+'/github/LiverDeconv')
 import liver_deconv as ld
 
@@ -33,7 +41,52 @@ class BaseSimulator():
         self.cell_idx = cell_idx
         self.adata = adata
     
-    def assign_uniform(self, cell_types:list, sparse=True):
+    def assign(self, generator='legacy', seed=42, block_size=100000):
+        """
+        Proportions over immune_cells + non_immune_cells (each block normalised, then both weighted equally).
+        generator='legacy' (default) reproduces the np.random.seed based assign_uniform / assign_dirichlet rows;
+        generator='philox' opts in to ProportionGenerator (per-row streams keyed by seed).
+        """
+        assert self.method in ['uniform_sparse', 'uniform', 'dirichlet'], "Method not supported. Choose 'uniform_sparse', 'uniform', or 'dirichlet'."
+        if generator == 'philox':
+            pg = ProportionGenerator(self.immune_cells + self.non_immune_cells, method=self.method, alpha=1.0,
+                                     groups=[self.immune_cells, self.non_immune_cells], seed=seed)
+            self.summary_df = pg.generate(self.sample_size, block_size=block_size)
+            im_summary = self.summary_df[self.immune_cells]
+            non_im_summary = self.summary_df[self.non_immune_cells]
+            self.im_summary = im_summary.div(im_summary.sum(axis=1), axis=0)
+            self.non_im_summary = non_im_summary.div(non_im_summary.sum(axis=1), axis=0)
+            return
+        if generator != 'legacy':
+            raise ValueError("generator must be 'philox' or 'legacy'.")
+
+        if self.method == 'uniform_sparse':
+            # assign uniform distribution
+            im_summary = self.assign_uniform(cell_types=self.immune_cells, sparse=True, generator='legacy')
+            non_im_summary = self.assign_uniform(cell_types=self.non_immune_cells, sparse=True, generator='legacy')
+        elif self.method == 'uniform':
+            # assign uniform distribution
+            im_summary = self.assign_uniform(cell_types=self.immune_cells, sparse=False, generator='legacy')
+            non_im_summary = self.assign_uniform(cell_types=self.non_immune_cells, sparse=False, generator='legacy')
+        elif self.method == 'dirichlet':
+            im_summary = self.assign_dirichlet(a=1.0, cell_types=self.immune_cells, generator='legacy')
+            non_im_summary = self.assign_dirichlet(a=1.0, cell_types=self.non_immune_cells, generator='legacy')
+        else:
+            raise ValueError("Method not supported. Choose 'uniform_sparse', 'uniform', or 'dirichlet'.")
+
+        # normalize (sum to 1)
+        self.im_summary = im_summary.div(im_summary.sum(axis=1), axis=0)
+        self.non_im_summary = non_im_summary.div(non_im_summary.sum(axis=1), axis=0)
+
+        summary_df = pd.concat([self.im_summary, self.non_im_summary], axis=1)
+        self.summary_df = summary_df.div(summary_df.sum(axis=1), axis=0)  # normalize to sum to 1
+
+    def assign_uniform(self, cell_types:list, sparse=True, generator='legacy', seed=42, block_size=100000):
+        if generator == 'philox':
+            pg = ProportionGenerator(cell_types, method='uniform_sparse' if sparse else 'uniform', seed=seed)
+            return pg.generate(self.sample_size, block_size=block_size)
+
+        # legacy: global reseeding per row
         final_res = []
         for idx in range(self.sample_size):
             if sparse:
@@ -58,11 +111,16 @@ class BaseSimulator():
 
         return summary_df
     
-    def assign_dirichlet(self, cell_types:list, a=1.0, do_viz=False):
-        alpha = [a]*len(cell_types)
-
-        np.random.seed(seed=42)
-        data = np.random.dirichlet(alpha, size=self.sample_size)
+    def assign_dirichlet(self, cell_types:list, a=1.0, do_viz=False, generator='legacy', seed=42, block_size=100000):
+        """
+        a: scalar or per-cell-type concentration.
+        """
+        if generator == 'philox':
+            pg = ProportionGenerator(cell_types, method='dirichlet', alpha=a, seed=seed)
+            data = pg.generate(self.sample_size, block_size=block_size).values
+        else:
+            alpha = np.broadcast_to(a, (len(cell_types),))
+            data = np.random.RandomState(42).dirichlet(alpha, size=self.sample_size)  # same rows as np.random.seed(42)
 
         if do_viz:
             # visualization
@@ -77,25 +135,46 @@ class BaseSimulator():
 
         return summary_df
 
-    def create_ref(self):
-        if hasattr(self.adata.X, 'todense'):
-            raw_exp = np.array(self.adata.X.todense())
-        else:
-            raw_exp = np.array(self.adata.X)
-            
-        pooled_exp = []
-        for i,k in enumerate(self.cell_idx_dict):
-            c_idx = self.cell_idx_dict[k]['train']
-            tmp_mean = raw_exp[c_idx].mean(axis=0)
-            pooled_exp.append(tmp_mean)
-
-        ref_df = pd.DataFrame(pooled_exp).T
-        ref_df.index = self.adata.var_names  # gene names
-        ref_df.columns = self.cell_idx_dict.keys()  # cell types
-
-        return ref_df
-
-    def bulk_ref_qc(self, bulk_df, ref_df, summary_df):
+    def create_ref(self, mode='train', return_var=False):
+        """
+        Per-cell-type mean expression (genes x cell types) of the mode cells in cell_idx_dict, as a
+        sparse indicator-matrix product (adata.X is not densified). return_var=True also returns variances.
+        """
+        cell_types = list(self.cell_idx_dict.keys())
+        groups = [self.cell_idx_dict[k][mode] for k in cell_types]
+        X = self.adata.X if issparse(self.adata.X) else np.asarray(self.adata.X)
+        stats = group_stats(X, groups, return_var=return_var)
+        to_df = lambda m: pd.DataFrame(m.T, index=self.adata.var_names, columns=cell_types)  # gene names x cell types
+        if return_var:
+            return to_df(stats[0]), to_df(stats[1])
+        return to_df(stats)
+
+    def bulk_ref_qc(self, bulk_df, ref_df, summary_df, chunk_size=2000, n_jobs=4):
+        """
+        Batched NNLS deconvolution of the simulated bulks (genes x samples) with ref_df (genes x cell types)
+        on the shared genes (case-insensitive, linear scale). Returns per-cell-type R / CCC against
+        summary_df and the estimated proportions.
+        """
+        if bulk_df.shape[1] != len(summary_df):
+            raise ValueError("bulk_df columns must correspond to the rows of summary_df.")
+        bulk_genes = pd.Index([str(t).upper() for t in bulk_df.index])
+        ref_genes = pd.Index([str(t).upper() for t in ref_df.index])
+        common = bulk_genes[bulk_genes.isin(ref_genes) & ~bulk_genes.duplicated()]
+        if len(common) == 0:
+            raise ValueError("No common genes between bulk_df and ref_df.")
+        B = bulk_df.values[bulk_genes.get_indexer(common)].T
+        R = ref_df.values[ref_genes.get_indexer(common)]
+
+        P = batched_nnls(B, R, chunk_size=chunk_size, n_jobs=n_jobs)
+        s = P.sum(axis=1, keepdims=True)
+        s[s == 0] = 1
+        norm_res = pd.DataFrame(P / s, index=summary_df.index, columns=ref_df.columns)  # normalize to sum to 1
+
+        metrics = eval_props(norm_res, summary_df)
+        print(metrics)
+        return metrics, norm_res
+
+    def bulk_ref_qc_legacy(self, bulk_df, ref_df, summary_df):
         # preprocessing
         bulk_df.index = [t.upper() for t in bulk_df.index] 
         ref_df.index = [t.upper() for t in ref_df.index]
@@ -119,9 +198,12 @@ class BaseSimulator():
             res = ev.eval_deconv(dec_name_list=[[target_cell]], val_name_list=[[target_cell]], deconv_df=norm_res, y_df=summary_df, do_plot=True)
 
 class GSE139107_Simulator(BaseSimulator):
-    def __init__(self, sample_size=8000, method='dirichlet'):
+    def __init__(self, sample_size=8000, method='dirichlet', signature_dir=None, store_dir=None):
         self.sample_size = sample_size
         self.method = method
+        # *_filtered_matrix.txt written by filter_exp, and their binary copies (see prepare_signatures)
+        self.signature_dir = BASE_DIR+'/datasource/Simulated_Data/GSE139107/signature' if signature_dir is None else signature_dir
+        self.store_dir = os.path.join(self.signature_dir, 'store') if store_dir is None else store_dir
         self.immune_cells = ['NK','T_CD4','T_CD8_CytT','Monocyte','Mast_cells']
         self.non_immune_cells = ['Fibroblast','Ciliated','Alveolar_Type1','Alveolar_Type2']
 
@@ -139,150 +221,124 @@ class GSE139107_Simulator(BaseSimulator):
             'Alveolar_Type1': 'AT1',
             'Alveolar_Type2': 'AT2'
         }
+        # Cell_subtype(s) of GSE131907 pooled into each signature
+        self.subtype_dict = {
+            'NK': ['NK'],
+            'CD4': ['CD4+ Th', 'Naive CD4+ T'],
+            'CD8': ['Cytotoxic CD8+ T', 'Naive CD8+ T'],
+            'Monocyte': ['Monocytes'],
+            'MAST': ['MAST'],
+            'Fibrosis': ['Myofibroblasts'],
+            'Ciliated': ['Ciliated'],
+            'AT1': ['AT1'],
+            'AT2': ['AT2']
+        }
+
+    def signature_path(self, cellname):
+        return os.path.join(self.signature_dir, f'{cellname}_filtered_matrix.txt')
+
+    def prepare_signatures(self, chunksize=2000, overwrite=False):
+        """
+        Convert each per-cell-type text matrix once into the memory-mapped binary store.
+        Entries extracted from the raw UMI matrix by filter_exp are kept as they are.
+        """
+        store = SignatureStore(self.store_dir)
+        for cell in self.immune_cells + self.non_immune_cells:
+            cellname = self.filter_dict[cell]
+            store.convert(cellname, self.signature_path(cellname), chunksize=chunksize, overwrite=overwrite)
     
-    def filter_exp(self):
+    def filter_exp(self, raw_path=None, info_path=None, n_workers=None, chunk_bytes=64 << 20):
         """
-        #target_cells = ['NK']
-        #target_cells = ['Monocytes']
-        #target_cells = ['CD4+ Th', 'Naive CD4+ T', ]
-        #target_cells = ['Cytotoxic CD8+ T', 'Naive CD8+ T']
-        #target_cells = ['MAST']
-        #target_cells = ['Myofibroblasts']
-        #target_cells = ['Ciliated']
-        #target_cells = ['AT1']
-        #target_cells = ['AT2']
+        Extract the cells of every configured subtype (subtype_dict) from the raw UMI matrix into the
+        signature store in one parallel pass (see signature_store.convert_raw_umi).
         """
-        info_df = pd.read_table(BASE_DIR+'/datasource/scRNASeq/GSE131907/GSE131907_Lung_Cancer_cell_annotation.txt')
+        if info_path is None:
+            info_path = BASE_DIR+'/datasource/scRNASeq/GSE131907/GSE131907_Lung_Cancer_cell_annotation.txt'
+        if raw_path is None:
+            raw_path = BASE_DIR+'/datasource/scRNASeq/GSE131907/GSE131907_Lung_Cancer_raw_UMI_matrix.txt'
+        info_df = pd.read_table(info_path)
         lung_info = info_df[info_df['Sample_Origin'].isin(['nLung', 'tLung'])]
-        cell_types = lung_info['Cell_type'].unique().tolist()
-        sub_types = sorted(lung_info['Cell_subtype'].dropna().unique().tolist())
-
-        target_cells = ['NK']
-        target_samples = lung_info[lung_info['Cell_subtype'].isin(target_cells)]['Index'].tolist()
-        input_file = BASE_DIR+'/datasource/scRNASeq/GSE131907/GSE131907_Lung_Cancer_raw_UMI_matrix.txt'
-        output_file = BASE_DIR+'/datasource/Simulated_Data/GSE139107/signature/NK_filtered_matrix.txt'
-        with open(input_file, 'r') as fin:
-            header = fin.readline().rstrip('\n').split('\t')
-            
-            # target columns ('Gene' + selected samples)
-            selected_idx = [0] + [i for i, col in enumerate(header) if col in target_samples]
-            
-            # write
-            with open(output_file, 'w') as fout:
-                fout.write('\t'.join([header[i] for i in selected_idx]) + '\n')
-                for line in fin:
-                    values = line.rstrip('\n').split('\t')
-                    selected_values = [values[i] for i in selected_idx]
-                    fout.write('\t'.join(selected_values) + '\n')
-    
-    def assign(self):
-        assert self.method in ['uniform_sparse', 'uniform', 'dirichlet'], "Method not supported. Choose 'uniform_sparse', 'uniform', or 'dirichlet'."
-        if self.method == 'uniform_sparse':
-            # assign uniform distribution
-            im_summary = self.assign_uniform(cell_types=self.immune_cells, sparse=True)
-            non_im_summary = self.assign_uniform(cell_types=self.non_immune_cells, sparse=True)
-        elif self.method == 'uniform':
-            # assign uniform distribution
-            im_summary = self.assign_uniform(cell_types=self.immune_cells, sparse=False)
-            non_im_summary = self.assign_uniform(cell_types=self.non_immune_cells, sparse=False)
-        elif self.method == 'dirichlet':
-            im_summary = self.assign_dirichlet(a=1.0, cell_types=self.immune_cells)
-            non_im_summary = self.assign_dirichlet(a=1.0, cell_types=self.non_immune_cells)
-        else:
-            raise ValueError("Method not supported. Choose 'uniform_sparse', 'uniform', or 'dirichlet'.")
-
-        # normalize (sum to 1)
-        self.im_summary = im_summary.div(im_summary.sum(axis=1), axis=0)
-        self.non_im_summary = non_im_summary.div(non_im_summary.sum(axis=1), axis=0)
 
-        summary_df = pd.concat([self.im_summary, self.non_im_summary], axis=1)
-        self.summary_df = summary_df.div(summary_df.sum(axis=1), axis=0)  # normalize to sum to 1
+        type_samples = {}
+        for cell in self.immune_cells + self.non_immune_cells:
+            cellname = self.filter_dict[cell]
+            target_cells = self.subtype_dict[cellname]
+            type_samples[cellname] = lung_info[lung_info['Cell_subtype'].isin(target_cells)]['Index'].tolist()
+        convert_raw_umi(raw_path, type_samples, self.store_dir, n_workers=n_workers, chunk_bytes=chunk_bytes)
     
     def set_data(self, summary_df=None, cell_idx_dict=None):
         if summary_df is not None:
             self.summary_df = summary_df
+        if isinstance(cell_idx_dict, str):  # cell_idx.npz written by split_cell_idx
+            cell_idx_dict = CellIndexRegistry.load(cell_idx_dict).to_dict()
         if cell_idx_dict is not None:
             self.cell_idx_dict = cell_idx_dict
     
-    def split_cell_idx(self, save_dir='./data/cell_idx', train_ratio=0.7):
-        # Extract info
-        cell_types = self.immune_cells + self.non_immune_cells
-        cell_idx_dict = {}
-        for cell in cell_types:
+    def split_cell_idx(self, save_dir='./data/cell_idx', train_ratio=0.7, seed=42):
+        """
+        Seeded train / test split of every signature's cells, saved to save_dir/cell_idx.npz.
+        """
+        positions = {}
+        for cell in self.immune_cells + self.non_immune_cells:
             cellname = self.filter_dict[cell]
-            df = pd.read_table(BASE_DIR+f'/datasource/Simulated_Data/GSE139107/signature/{cellname}_filtered_matrix.txt', index_col=0)
-            target_idx = [i for i in range(df.shape[1])]
-            cell_size = len(target_idx)
-            print("{}: {} cells are detected".format(cell, cell_size))
-            # Train / Test Split
-            random.seed(42)
-            shuffle_idx = random.sample(target_idx, cell_size)
-            train_idx = shuffle_idx[0:int(cell_size * train_ratio)]
-            test_idx = shuffle_idx[int(cell_size * train_ratio):]
-            cell_idx_dict[cell] = {'train': train_idx, 'test': test_idx}
-
-            if save_dir is not None:
-                os.makedirs(save_dir, exist_ok=True)
-            pd.to_pickle(train_idx, os.path.join(save_dir, f'{cell}_train_idx.pkl'))
-            pd.to_pickle(test_idx, os.path.join(save_dir, f'{cell}_test_idx.pkl'))
-        
-        self.cell_idx_dict = cell_idx_dict
+            meta = SignatureStore(self.store_dir).meta(cellname)
+            if meta is not None:
+                n_cells = meta['shape'][0]
+            else:
+                n_cells = pd.read_table(self.signature_path(cellname), index_col=0, nrows=0).shape[1]  # header only
+            positions[cell] = np.arange(n_cells)
+        registry = CellIndexRegistry.from_positions(positions, train_ratio=train_ratio, seed=seed)
+        if save_dir is not None:
+            registry.save(os.path.join(save_dir, 'cell_idx.npz'))
+        self.cell_idx_dict = registry.to_dict()
     
-    def create_sim_bulk(self, pool_size=500, mode='train'):
+    def create_sim_bulk(self, pool_size=500, mode='train', sampler='legacy', seed=42, chunk_size=1000, writer=None, ds=None):
+        """
+        Pseudo-bulk counts (genes x samples) from the memory-mapped signature store (prepare_signatures
+        is run first if needed). For each cell type, the selected cells of a block of samples are
+        gathered at once as S_j @ X_j, where S_j is the (samples x cells of type j) selection-count matrix.
+        sampler='legacy' (default) keeps the RandomState(42 + idx * n_types + j) draws; sampler='philox' opts
+        in to CellSampler (per-sample Philox streams keyed by seed).
+        Each cell type is summed in float32 (the dtype of the store) and the types are added in float64.
+        Samples without selected cells are kept as all-zero columns, as in the per-sample loop (a sum over
+        no columns was a zero vector, not skipped); TSCA_Simulator drops them as before.
+        With writer (SimBulkWriter), blocks are streamed to disk under domain ds and None is returned.
+        """
         summary_df = self.summary_df
         cell_idx_dict = self.cell_idx_dict
         tototal_cells = summary_df.columns.tolist()
+        candi_list = [np.asarray(cell_idx_dict[cell][mode]) for cell in tototal_cells]
+
+        self.prepare_signatures()
+        store = SignatureStore(self.store_dir)
+        mats, genes = [], None
+        for cell in tototal_cells:
+            X, g = store.load(self.filter_dict[cell])
+            if genes is None:
+                genes = g
+            elif not genes.equals(g):
+                raise ValueError(f"Gene index of {cell} does not match the other signature matrices.")
+            mats.append(X)
 
         pooled_exp = []
-        np.random.seed(42)  # Set seed once outside the loop
-        
-        for idx in tqdm(range(len(summary_df))):
-            p_list = summary_df.iloc[idx].values
-            bulk_single = None
-            bulk_size = 0
-            for j, p in enumerate(p_list):
-                cell = tototal_cells[j]
-                tmp_size = int(pool_size * p)
-                candi_idx = cell_idx_dict[cell][mode]
-                cellname = self.filter_dict[cell]
+        blocks = iter_cell_blocks(summary_df, candi_list, pool_size=pool_size, sampler=sampler, seed=seed, chunk_size=chunk_size)
+        for start, end, indptr, cells, types in tqdm(blocks, total=int(np.ceil(len(summary_df) / chunk_size))):
+            rows = np.repeat(np.arange(end - start), np.diff(indptr))
+            bulk = np.zeros((end - start, len(genes)), dtype=np.float64)
+            for j, X in enumerate(mats):
+                sel = types == j
+                S = csr_matrix((np.ones(sel.sum()), (rows[sel], cells[sel])), shape=(end - start, X.shape[0]))
+                bulk += pseudo_bulk(X, S, chunk_size=chunk_size)
+            if writer is not None:
+                writer.append(bulk, summary_df.values[start:end], ds=ds, genes=genes)
+            else:
+                pooled_exp.append(bulk)
+        if writer is not None:
+            return None
 
-                # Use different random state for each sample to maintain reproducibility
-                rng = np.random.RandomState(42 + idx * len(tototal_cells) + j)
-                if len(candi_idx) < tmp_size:
-                    select_idx = rng.choice(candi_idx, size=tmp_size, replace=True)
-                else:
-                    select_idx = rng.choice(candi_idx, size=tmp_size, replace=False)
-                select_idx = [i + 1 for i in select_idx]  # Adjust index to match the file format
-                
-                unique_cols = list(dict.fromkeys(select_idx))
-                df = pd.read_table(
-                    f'D:/datasource/Deconvolution/GSE131907/signature/{cellname}_filtered_matrix.txt',
-                    index_col=0,
-                    usecols=[0] + unique_cols
-                )
-                col_pos_map = {val: i for i, val in enumerate(unique_cols)}  # e.g., {2:0, 3:1, 4:2, 5:3}
-                col_map = [col_pos_map[i] for i in select_idx]               # e.g., [0,1,2,2,3]
-                bulk_size += len(col_map)
-                # repeatedly select columns based on col_map
-                df_repeated = df.iloc[:, col_map]
-                tmp_sum = df_repeated.sum(axis=1).values
-
-                if tmp_sum is None or tmp_sum.size == 0:
-                    continue
-
-                # add to bulk_single
-                if bulk_single is None:
-                    bulk_single = tmp_sum
-                else:
-                    bulk_single = bulk_single + tmp_sum
-            if bulk_single is not None:
-                pooled_exp.append(bulk_single.flatten())
-            #print(f"Sample {idx+1}/{len(summary_df)}: {bulk_size} cells pooled.")
-        
-        # Convert to DataFrame more efficiently
-        pooled_exp = np.array(pooled_exp)
+        pooled_exp = np.concatenate(pooled_exp) if pooled_exp else np.zeros((0, len(genes)))
         bulk_df = pd.DataFrame(pooled_exp.T)
-        bulk_df.index = df.index  # gene names
+        bulk_df.index = genes  # gene names
 
         return bulk_df
         
@@ -298,105 +354,83 @@ class TSCA_Simulator(BaseSimulator):
         self.summary_df = None
         self.cell_idx_dict = None
     
-    def assign(self):
-        assert self.method in ['uniform_sparse', 'uniform', 'dirichlet'], "Method not supported. Choose 'uniform_sparse', 'uniform', or 'dirichlet'."
-        if self.method == 'uniform_sparse':
-            # assign uniform distribution
-            im_summary = self.assign_uniform(cell_types=self.immune_cells, sparse=True)
-            non_im_summary = self.assign_uniform(cell_types=self.non_immune_cells, sparse=True)
-        elif self.method == 'uniform':
-            # assign uniform distribution
-            im_summary = self.assign_uniform(cell_types=self.immune_cells, sparse=False)
-            non_im_summary = self.assign_uniform(cell_types=self.non_immune_cells, sparse=False)
-        elif self.method == 'dirichlet':
-            im_summary = self.assign_dirichlet(a=1.0, cell_types=self.immune_cells)
-            non_im_summary = self.assign_dirichlet(a=1.0, cell_types=self.non_immune_cells)
-        else:
-            raise ValueError("Method not supported. Choose 'uniform_sparse', 'uniform', or 'dirichlet'.")
-
-        # normalize (sum to 1)
-        self.im_summary = im_summary.div(im_summary.sum(axis=1), axis=0)
-        self.non_im_summary = non_im_summary.div(non_im_summary.sum(axis=1), axis=0)
-
-        summary_df = pd.concat([self.im_summary, self.non_im_summary], axis=1)
-        self.summary_df = summary_df.div(summary_df.sum(axis=1), axis=0)  # normalize to sum to 1
-    
     def set_data(self, summary_df=None, cell_idx_dict=None):
         if summary_df is not None:
             self.summary_df = summary_df
+        if isinstance(cell_idx_dict, str):  # cell_idx.npz written by split_cell_idx
+            cell_idx_dict = CellIndexRegistry.load(cell_idx_dict).to_dict()
         if cell_idx_dict is not None:
             self.cell_idx_dict = cell_idx_dict
     
-    def split_cell_idx(self, info_df=None, save_dir='./data/cell_idx'):
+    def split_cell_idx(self, info_df=None, save_dir='./data/cell_idx', label_key='Celltypes_updated_July_2020', train_ratio=0.7, seed=42):
+        """
+        Seeded train / test split of the atlas positions of every cell type, saved to save_dir/cell_idx.npz.
+        """
         if info_df is None:
             # adata = sc.read_h5ad("../Tissue_Stability_Cell_Atlas/lung.cellxgene.h5ad")
             info_df = self.adata.obs
-        # Extract info
-        cell_types = self.immune_cells + self.non_immune_cells
-        cell_idx_dict = {}
-        for cell in cell_types:
-            target_cell = info_df[info_df['Celltypes_updated_July_2020'] == cell]
-            target_idx = [info_df.index.tolist().index(t) for t in target_cell.index.tolist()]
-            cell_size = len(target_idx)
-            print("{}: {} cells are detected".format(cell, cell_size))
-            # Train / Test Split
-            random.seed(42)
-            shuffle_idx = random.sample(target_idx, cell_size)
-            train_idx = shuffle_idx[0:int(cell_size * 0.7)]
-            test_idx = shuffle_idx[int(cell_size * 0.7):]
-            cell_idx_dict[cell] = {'train': train_idx, 'test': test_idx}
-
-            if save_dir is not None:
-                os.makedirs(save_dir, exist_ok=True)
-            pd.to_pickle(train_idx, os.path.join(save_dir, f'{cell}_train_idx.pkl'))
-            pd.to_pickle(test_idx, os.path.join(save_dir, f'{cell}_test_idx.pkl'))
-        
-        self.cell_idx_dict = cell_idx_dict
+        registry = CellIndexRegistry.from_labels(info_df[label_key], self.immune_cells + self.non_immune_cells,
+                                                 train_ratio=train_ratio, seed=seed)
+        if save_dir is not None:
+            registry.save(os.path.join(save_dir, 'cell_idx.npz'))
+        self.cell_idx_dict = registry.to_dict()
 
-    def create_sim_bulk(self, pool_size=500, mode='train'):
+    def create_sim_bulk(self, pool_size=500, mode='train', chunk_size=1000, sampler='legacy', seed=42, writer=None, ds=None):
+        """
+        Pseudo-bulk counts (genes x samples) as S @ X on the (sparse) atlas, where S is the
+        (samples x cells) selection-count matrix. Samples are processed in chunks of chunk_size,
+        so X is never densified and peak memory is bounded by one chunk of S and its output.
+        sampler='legacy' (default) reproduces the RandomState(42 + idx * n_types + j) draws;
+        sampler='philox' opts in to CellSampler (per-sample Philox streams keyed by seed).
+        With writer (SimBulkWriter), blocks are streamed to disk under domain ds and None is returned.
+        """
         summary_df = self.summary_df
         cell_idx_dict = self.cell_idx_dict
         tototal_cells = summary_df.columns.tolist()
 
-        # Pre-convert sparse matrix to dense array once
-        if hasattr(self.adata.X, 'todense'):
-            raw_exp = np.array(self.adata.X.todense())
-        else:
-            raw_exp = np.array(self.adata.X)
+        X = csr_matrix(self.adata.X) if issparse(self.adata.X) else np.asarray(self.adata.X)
+        candi_list = [np.asarray(cell_idx_dict[cell][mode]) for cell in tototal_cells]
 
         pooled_exp = []
-        np.random.seed(42)  # Set seed once outside the loop
-        
-        for idx in tqdm(range(len(summary_df))):
-            p_list = summary_df.iloc[idx].values  # Use .values instead of .tolist() for speed
-            final_idx = []
-            
-            for j, p in enumerate(p_list):
-                cell = tototal_cells[j]
-                tmp_size = int(pool_size * p)  # number of cells to be selected
+        blocks = iter_cell_blocks(summary_df, candi_list, pool_size=pool_size, sampler=sampler, seed=seed, chunk_size=chunk_size)
+        for start, end, indptr, cells, _ in tqdm(blocks, total=int(np.ceil(len(summary_df) / chunk_size))):
+            keep = np.diff(indptr) > 0  # samples without selected cells are skipped
+            S = count_matrix(indptr, cells, X.shape[0])[keep]
+            if S.shape[0] == 0:
+                continue
+            bulk = pseudo_bulk(X, S, chunk_size=chunk_size)
+            if writer is not None:
+                writer.append(bulk, summary_df.values[start:end][keep], ds=ds, genes=self.adata.var_names)
+            else:
+                pooled_exp.append(bulk)
+        if writer is not None:
+            return None
 
-                candi_idx = cell_idx_dict[cell][mode]
-                
-                # Use different random state for each sample to maintain reproducibility
-                rng = np.random.RandomState(42 + idx * len(tototal_cells) + j)
-                if len(candi_idx) < tmp_size:
-                    select_idx = rng.choice(candi_idx, size=tmp_size, replace=True)
-                else:
-                    select_idx = rng.choice(candi_idx, size=tmp_size, replace=False)
-                final_idx.extend(select_idx)
-            
-            if final_idx:  # Only process if there are selected indices
-                # Direct sum operation on selected rows
-                tmp_sum = raw_exp[final_idx, :].sum(axis=0)
-                pooled_exp.append(tmp_sum.flatten())  # Ensure 1D array
-        
-        # Convert to DataFrame more efficiently
-        pooled_exp = np.array(pooled_exp)
+        pooled_exp = np.concatenate(pooled_exp) if pooled_exp else np.zeros((0, X.shape[1]))
         bulk_df = pd.DataFrame(pooled_exp.T)
         bulk_df.index = self.adata.var_names  # gene names
 
         return bulk_df
     
+    def create_sim_bulk_sharded(self, out_dir, pool_size=500, mode='train', seed=42, shard_size=2000,
+                                chunk_size=500, n_workers=None, store_dir=None):
+        """
+        create_sim_bulk over a process pool (see sim_runner.run_sharded). The atlas is written once to
+        store_dir (default: out_dir/../atlas_store) and memory-mapped by the workers. Returns the
+        memory-mapped (samples x genes) bulk and its meta; rows follow summary_df.
+        """
+        if store_dir is None:
+            store_dir = os.path.join(os.path.dirname(os.path.abspath(out_dir)), 'atlas_store')
+        store = SignatureStore(store_dir)
+        fingerprint = adata_fingerprint(self.adata)
+        meta = store.meta('atlas')
+        if meta is None or meta.get('source') != fingerprint:
+            # NOTE: an atlas stored from a different AnnData is replaced
+            store.put('atlas', self.adata.X, self.adata.var_names, self.adata.obs_names, source=fingerprint)
+        candi_list = [self.cell_idx_dict[cell][mode] for cell in self.summary_df.columns]
+        return run_sharded(store_dir, 'atlas', self.summary_df, candi_list, out_dir, pool_size=pool_size, seed=seed,
+                           shard_size=shard_size, chunk_size=chunk_size, n_workers=n_workers)
+
     def create_sim_bulk_legacy(self, summary_df=None, pool_size=500, mode='train'):
         if summary_df is None:
             summary_df = self.summary
@@ -444,47 +478,43 @@ class MyPBMC_Simulator():
         if cell_idx_dict is not None:
             self.cell_idx_dict = cell_idx_dict
         else:
-            raw_idx = self.adata.obs.index.tolist()
-            cell_idx = {}
-            for c in self.cell_types:
-                tmp_idx = self.adata.obs[self.adata.obs['celltype']==c].index.tolist()
-                n_idx = [raw_idx.index(i) for i in tmp_idx]
-                cell_idx[c] = n_idx
-            self.cell_idx_dict = cell_idx
+            self.cell_idx_dict = cell_positions(self.adata.obs['celltype'], self.cell_types)
     
-    def create_sim_bulk(self, summary_df=None, pool_size=500):
-        rs = 0
-        pooled_exp = []
+    def create_sim_bulk(self, summary_df=None, pool_size=500, sampler='legacy', seed=42, chunk_size=1000, writer=None, ds=None):
+        """
+        sampler='legacy' (default) reproduces the np.random.seed(0) draws of the original loop;
+        sampler='philox' opts in to CellSampler.
+        With writer (SimBulkWriter), blocks are streamed to disk under domain ds and None is returned.
+        """
         if summary_df is None:
             summary_df = self.summary_df
-        for idx in tqdm(range(len(summary_df))):
-            p_list = summary_df.iloc[idx].tolist()
-            final_idx = []
-            for j, p in enumerate(p_list):
-                cell = self.cell_types[j]
-                tmp_size = int(pool_size*p)  # number of cells to be selected
+        candi_list = [np.asarray(self.cell_idx_dict[cell]) for cell in self.cell_types]
+        X = self.adata_counts.X
 
-                candi_idx = self.cell_idx_dict[cell]
-                # select tmp_size from tmp_df at random
-                np.random.seed(seed=rs)
-                if len(candi_idx) < tmp_size:
-                    select_idx = np.random.choice(candi_idx, size=tmp_size, replace=True)
-                else:
-                    select_idx = np.random.choice(candi_idx, size=tmp_size, replace=False)
-            
-                assert len(self.adata.X[select_idx]) == tmp_size
-                final_idx.extend(select_idx)
-            
+        pooled_exp = []
+        blocks = iter_cell_blocks(summary_df, candi_list, pool_size=pool_size, sampler=sampler, seed=seed,
+                                  chunk_size=chunk_size, legacy_seed=lambda idx, j: 0)
+        for start, end, indptr, cells, _ in tqdm(blocks, total=int(np.ceil(len(summary_df) / chunk_size))):
             # QC
-            if len(final_idx) < (pool_size - len(self.cell_types)) or len(final_idx) > (pool_size + len(self.cell_types)):
-                print("Error: {} cells are selected".format(len(final_idx)))
+            n_selected = np.diff(indptr)
+            bad = np.where((n_selected < pool_size - len(self.cell_types)) | (n_selected > pool_size + len(self.cell_types)))[0]
+            n_ok = bad[0] if len(bad) > 0 else len(n_selected)
+            if n_ok > 0:
+                # sum up the expression (counts)
+                S = count_matrix(indptr[:n_ok + 1], cells[:indptr[n_ok]], X.shape[0])
+                bulk = pseudo_bulk(X, S, chunk_size=chunk_size)
+                if writer is not None:
+                    writer.append(bulk, summary_df.values[start:start + n_ok], ds=ds, genes=self.adata_counts.var_names)
+                else:
+                    pooled_exp.append(bulk)
+            if len(bad) > 0:
+                print("Error: {} cells are selected".format(n_selected[bad[0]]))
                 break
+        if writer is not None:
+            return None
 
-            # sum up the expression (counts)
-            tmp_sum = list(np.array(self.adata_counts.X[final_idx].sum(axis=0))[0])
-            pooled_exp.append(tmp_sum)
-
-        bulk_df = pd.DataFrame(pooled_exp).T
+        pooled_exp = np.concatenate(pooled_exp) if pooled_exp else np.zeros((0, X.shape[1]))
+        bulk_df = pd.DataFrame(pooled_exp.T)
         bulk_df.index = self.adata_counts.var_names
 
         return bulk_df
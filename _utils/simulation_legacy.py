@@ -18,6 +18,8 @@ import seaborn as sns
 import matplotlib.pyplot as plt
 from scipy.sparse import csr_matrix
 
+from _utils.cell_registry import cell_positions
+
 # %% Proportion Generator
 sample_size = 15000
 immune_cells = ['NK','T_CD4','T_CD8_CytT','Monocyte','Mast_cells']
@@ -52,10 +54,10 @@ info_df = raw_data.obs
 # Immune cell types
 immune_cells = ['NK','T_CD4','T_CD8_CytT','Monocyte','Mast_cells']
 immune_summary = pd.read_csv(BASE_DIR+'/datasource/Simulated_Data/Lung/sc_immune_proportion_df.csv',index_col=0)
+positions = cell_positions(info_df['Celltypes_updated_July_2020'], immune_cells)
 for cell in immune_cells:
     # Extract info
-    target_cell = info_df[info_df['Celltypes_updated_July_2020']==cell]
-    target_idx = [info_df.index.tolist().index(t) for t in target_cell.index.tolist()]
+    target_idx = positions[cell].tolist()
     cell_size = len(target_idx)
     print("{}: {} cells are detected".format(cell,cell_size))
 
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+Created on 2026-10-19 (Mon) 20:14:36
+
+Sparse (CSR) input path for training.
+
+The source matrix stays a scipy csr_matrix through batching. CSRDataset gathers batches by
+row slicing and either densifies them (models that need dense x, e.g. for a reconstruction loss)
+or returns torch sparse CSR tensors, which first-layer nn.Linear blocks consume with sparse_linear.
+Memory for the full matrix is then proportional to the number of non-zeros.
+
+@author: I.Azuma
+"""
+import numpy as np
+from scipy.sparse import csr_matrix, issparse
+
+import torch
+import torch.utils.data as Data
+
+def csr_to_torch(X):
+    """
+    scipy csr_matrix --> torch sparse CSR tensor (shares the data buffer when already float32).
+    """
+    X = csr_matrix(X)
+    return torch.sparse_csr_tensor(torch.from_numpy(X.indptr.astype(np.int64)),
+                                   torch.from_numpy(X.indices.astype(np.int64)),
+                                   torch.from_numpy(np.asarray(X.data, dtype=np.float32)),
+                                   size=X.shape)
+
+def is_sparse_tensor(x):
+    return torch.is_tensor(x) and x.layout in [torch.sparse_csr, torch.sparse_coo]
+
+def sparse_linear(x, linear):
+    """
+    nn.Linear on a sparse (batch_size, in_features) tensor with a sparse-dense matmul.
+    """
+    out = torch.sparse.mm(x, linear.weight.t())
+    if linear.bias is not None:
+        out = out + linear.bias
+    return out
+
+class CSRDataset(Data.Dataset):
+    """
+    Map-style dataset over a csr_matrix X and dense labels Y.
+    sparse=True returns torch sparse CSR batches from gather(), otherwise dense float32 batches.
+    """
+    def __init__(self, X, Y, sparse=False):
+        if not issparse(X):
+            raise ValueError("CSRDataset expects a scipy sparse matrix.")
+        self.X = csr_matrix(X, dtype=np.float32)
+        self.Y = np.asarray(Y, dtype=np.float32)
+        self.sparse = sparse
+
+    def __len__(self):
+        return self.X.shape[0]
+
+    def __getitem__(self, index):
+        if np.ndim(index) > 0:  # a batch of indices from csr_loader
+            return self.gather(index)
+        return torch.from_numpy(self.X[index].toarray()[0]), torch.from_numpy(self.Y[index])
+
+    def gather(self, idx):
+        """
+        Batch of rows idx (row slicing of the CSR matrix, densified per batch if sparse=False).
+        """
+        idx = np.asarray(idx)
+        x = self.X[idx]
+        x = csr_to_torch(x) if self.sparse else torch.from_numpy(x.toarray())
+        return x, torch.from_numpy(self.Y[idx])
+
+    @property
+    def nbytes(self):
+        return self.X.data.nbytes + self.X.indices.nbytes + self.X.indptr.nbytes
+
+def csr_loader(dataset, batch_size, shuffle=True, generator=None):
+    """
+    DataLoader over a CSRDataset that slices whole batches (no per-row collation).
+    """
+    sampler = Data.RandomSampler(dataset, generator=generator) if shuffle else Data.SequentialSampler(dataset)
+    return Data.DataLoader(dataset=dataset, sampler=Data.BatchSampler(sampler, batch_size, drop_last=False), batch_size=None)
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+Created on 2026-10-19 (Mon) 16:32:08
+
+Target (bulk) expression ingestion for prep4inference.
+
+- iter_target_chunks: genes x samples readers for CSV/TSV (chunked), parquet, feather and 10x MTX
+- GeneAlignmentIndex: upper-cased gene symbol --> source column, built once per source atlas
+  and optionally persisted in the preprocessing cache dir (keyed by the atlas path/size/mtime)
+- read_aligned_target: assembles the aligned float32 (samples x common genes) matrix directly
+
+@author: I.Azuma
+"""
+import os
+import gzip
+import hashlib
+import numpy as np
+import pandas as pd
+import scipy.io
+from scipy.sparse import csr_matrix
+
+from anndata import read_h5ad
+
+def _strip_gz(path):
+    return path[:-3] if path.endswith('.gz') else path
+
+def _target_format(target_path):
+    if os.path.isdir(target_path) or _strip_gz(target_path).endswith('.mtx'):
+        return 'mtx'
+    ext = os.path.splitext(_strip_gz(target_path))[1].lower()
+    if ext == '.csv':
+        return 'csv'
+    if ext in ['.tsv', '.txt']:
+        return 'tsv'
+    if ext in ['.parquet', '.pq']:
+        return 'parquet'
+    if ext in ['.feather', '.ftr']:
+        return 'feather'
+    raise ValueError(f"Unsupported target format: {target_path}")
+
+def _frame_to_chunk(df):
+    # NOTE: parquet/feather do not keep a named index, so the first column holds the gene symbols
+    if isinstance(df.index, pd.RangeIndex):
+        df = df.set_index(df.columns[0])
+    return df.index.astype(str), df.values.astype(np.float32), [str(c) for c in df.columns]
+
+def _read_mtx(target_path):
+    mtx_dir = target_path if os.path.isdir(target_path) else os.path.dirname(target_path)
+    def find(names):
+        for name in names:
+            for cand in [name, name + '.gz']:
+                if os.path.exists(os.path.join(mtx_dir, cand)):
+                    return os.path.join(mtx_dir, cand)
+        raise FileNotFoundError(f"{names} not found in {mtx_dir}")
+
+    mtx_path = target_path if not os.path.isdir(target_path) else find(['matrix.mtx'])
+    opener = gzip.open if mtx_path.endswith('.gz') else open
+    with opener(mtx_path, 'rb') as f:
+        X = csr_matrix(scipy.io.mmread(f), dtype=np.float32)  # genes x cells
+    features = pd.read_table(find(['features.tsv', 'genes.tsv']), header=None)
+    genes = features[1] if features.shape[1] > 1 else features[0]  # gene symbols if available
+    barcodes = pd.read_table(find(['barcodes.tsv']), header=None)[0]
+    return pd.Index(genes.astype(str)), X, [str(b) for b in barcodes]
+
+def iter_target_chunks(target_path, chunksize=5000):
+    """
+    Yield (genes, values (n_genes_chunk, n_samples) float32, sample_names) over gene-row chunks.
+    """
+    fmt = _target_format(target_path)
+    if fmt in ['csv', 'tsv']:
+        sep = ',' if fmt == 'csv' else '\t'
+        for df in pd.read_csv(target_path, index_col=0, sep=sep, chunksize=chunksize):
+            yield df.index.astype(str), df.values.astype(np.float32), [str(c) for c in df.columns]
+    elif fmt == 'parquet':
+        try:
+            import pyarrow.parquet as pq
+            for batch in pq.ParquetFile(target_path).iter_batches(batch_size=chunksize):
+                yield _frame_to_chunk(batch.to_pandas())
+        except ImportError:
+            yield _frame_to_chunk(pd.read_parquet(target_path))
+    elif fmt == 'feather':
+        yield _frame_to_chunk(pd.read_feather(target_path))
+    elif fmt == 'mtx':
+        genes, X, barcodes = _read_mtx(target_path)
+        for start in range(0, X.shape[0], chunksize):
+            yield genes[start:start + chunksize], X[start:start + chunksize].toarray(), barcodes
+
+class GeneAlignmentIndex:
+    """
+    Upper-cased gene symbol --> source column position (first occurrence wins).
+    """
+    def __init__(self, var_names, fingerprint=None, lookup=None, positions=None):
+        self.var_names = pd.Index(var_names).astype(str)
+        self.fingerprint = fingerprint
+        if lookup is None:
+            upper = self.var_names.str.upper()
+            keep = ~upper.duplicated()
+            lookup, positions = upper[keep], np.where(keep)[0]
+        self.lookup = pd.Index(lookup)
+        self.positions = np.asarray(positions)
+
+    def map(self, genes):
+        """
+        Source column for each gene symbol (-1 if absent).
+        """
+        idx = self.lookup.get_indexer(pd.Index(genes).astype(str).str.upper())
+        return np.where(idx >= 0, self.positions[np.maximum(idx, 0)], -1)
+
+    @classmethod
+    def from_h5ad(cls, h5ad_path, cache_dir=None):
+        """
+        Build the index from var_names (backed read). With cache_dir, the computed mapping is
+        persisted there (keyed by the atlas path/size/mtime) and reused on later calls.
+        """
+        st = os.stat(h5ad_path)
+        fingerprint = (os.path.abspath(h5ad_path), st.st_size, st.st_mtime)
+        index_path = None
+        if cache_dir is not None:
+            key = hashlib.sha256(repr(fingerprint).encode()).hexdigest()[:32]
+            index_path = os.path.join(cache_dir, f'gene_index_{key}.pkl')
+            if os.path.exists(index_path):
+                saved = pd.read_pickle(index_path)
+                if saved['fingerprint'] == fingerprint:
+                    return cls(saved['var_names'], fingerprint=fingerprint, lookup=saved['lookup'], positions=saved['positions'])
+
+        adata_b = read_h5ad(h5ad_path, backed='r')
+        var_names = adata_b.var_names.copy()
+        adata_b.file.close()
+        index = cls(var_names, fingerprint=fingerprint)
+        if index_path is not None:
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                pd.to_pickle({'fingerprint': fingerprint, 'var_names': index.var_names,
+                              'lookup': index.lookup, 'positions': index.positions}, index_path)
+            except OSError:
+                print(f"Warning: could not save gene alignment index to {index_path}")
+        return index
+
+def read_aligned_target(target_path, gene_index, chunksize=5000):
+    """
+    Read a genes x samples target and align it to the source columns.
+    Returns X (n_samples, n_common) float32, common_cols (ascending source positions), sample_names.
+    Only the matched gene rows of each chunk are kept; they are written once into the output.
+    """
+    parts, seen, sample_names = [], set(), None
+    for genes, values, samples in iter_target_chunks(target_path, chunksize=chunksize):
+        if sample_names is None:
+            sample_names = samples
+        cols = gene_index.map(genes)
+        hit = np.where(cols >= 0)[0]
+        # NOTE: duplicated target symbols keep their first occurrence
+        hit = hit[~pd.Index(cols[hit]).duplicated()]
+        hit = hit[[c not in seen for c in cols[hit]]]
+        seen.update(cols[hit].tolist())
+        parts.append((cols[hit], np.asarray(values[hit], dtype=np.float32)))
+
+    if sample_names is None:
+        raise ValueError("No genes found in target data. Please check the input data.")
+    common_cols = np.array(sorted(seen), dtype=np.int64)
+    X = np.empty((len(sample_names), len(common_cols)), dtype=np.float32)
+    for cols, values in parts:
+        X[:, np.searchsorted(common_cols, cols)] = values.T
+    return X, common_cols, sample_names
@@ -18,9 +18,16 @@ from sklearn.model_selection import train_test_split
 
 import torch
 
+from _utils.feature_store import stored
+
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-def prep4pbmc(h5ad_path, target='sdy67', test_ratio=0.2, target_path=None):
+@stored(path_args=['h5ad_path', 'target_path'], seed_args=['random_state'])
+def prep4pbmc(h5ad_path, target='sdy67', test_ratio=0.2, target_path=None, random_state=None):
+    """
+    Returns (train_x, val_x, test_x, train_y, val_y, test_y).
+    With store_dir set (and random_state given), the split is materialised once and read back memory-mapped.
+    """
     pbmc = read_h5ad(h5ad_path)
     pbmc1 = pbmc[pbmc.obs['ds']=='sdy67']
     microarray = pbmc[pbmc.obs['ds']=='GSE65133']
@@ -92,7 +99,7 @@ def prep4pbmc(h5ad_path, target='sdy67', test_ratio=0.2, target_path=None):
     
     train_x = np.log2(train_x + 1)
     test_x = np.log2(test_x + 1)
-    train_x, val_x, train_y, val_y = train_test_split(train_x, train_y, test_size=test_ratio)
+    train_x, val_x, train_y, val_y = train_test_split(train_x, train_y, test_size=test_ratio, random_state=random_state)
 
     print("Start scaling data...")
     mms = MinMaxScaler()
@@ -109,9 +116,14 @@ def prep4pbmc(h5ad_path, target='sdy67', test_ratio=0.2, target_path=None):
 
     return train_x, val_x, test_x, train_y, val_y, test_y
 
+@stored(path_args=['h5ad_path', 'target_path'], seed_args=['random_state'])
 def prep4tissue(h5ad_path, target_path, source_list=['GSE139107'], target='TSCA_Lung',
              target_cells=['NK', 'T_CD4', 'T_CD8_CytT', 'Monocyte', 'Mast_cells', 'Fibroblast',
-       'Ciliated', 'Alveolar_Type1', 'Alveolar_Type2'], test_ratio=0.2):
+       'Ciliated', 'Alveolar_Type1', 'Alveolar_Type2'], test_ratio=0.2, random_state=None):
+    """
+    Returns (train_x, val_x, test_x, train_y, val_y, test_y).
+    With store_dir set (and random_state given), the split is materialised once and read back memory-mapped.
+    """
     if target_path is None:
         raise ValueError("Please provide target_path for inference mode.")
     
@@ -166,7 +178,7 @@ def prep4tissue(h5ad_path, target_path, source_list=['GSE139107'], target='TSCA_
     
     train_x = np.log2(train_x + 1)
     test_x = np.log2(test_x + 1)
-    train_x, val_x, train_y, val_y = train_test_split(train_x, train_y, test_size=test_ratio)
+    train_x, val_x, train_y, val_y = train_test_split(train_x, train_y, test_size=test_ratio, random_state=random_state)
 
     print("Start scaling data...")
     mms = MinMaxScaler()
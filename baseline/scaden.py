@@ -13,6 +13,7 @@ import anndata
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
+from scipy.sparse import issparse
 
 from tqdm import tqdm
 from anndata import read_h5ad
@@ -31,6 +32,8 @@ BASE_DIR = '/workspace/mnt/cluster/HDD/azuma/TopicModel_Deconv'
 sys.path.append(BASE_DIR+'/github/TRIAD')
 from _utils.dataset import *
 from baseline.baseline_utils import prep4pbmc, prep4tissue
+from _utils.prefetch import PairPrefetcher
+from _utils.sparse_input import CSRDataset, csr_loader, is_sparse_tensor, sparse_linear
 
 
 class simdatset(Data.Dataset):
@@ -40,8 +43,9 @@ class simdatset(Data.Dataset):
     def __len__(self):
         return len(self.X)
     def __getitem__(self, index):
-        x = torch.from_numpy(self.X[index]).float().to(device)
-        y = torch.from_numpy(self.Y[index]).float().to(device)
+        # NOTE: stored splits are read-only memmaps, so rows are copied before torch.from_numpy
+        x = torch.from_numpy(np.array(self.X[index])).float().to(device)
+        y = torch.from_numpy(np.array(self.Y[index])).float().to(device)
         return x, y
 
 class MLP(nn.Module):
@@ -56,6 +60,8 @@ class MLP(nn.Module):
     def forward(self,x):
         # x: (n sample, m gene)
         # output: (n sample, k cell proportions)
+        if is_sparse_tensor(x):  # NOTE: first layer on CSR input (sparse-dense matmul)
+            return self.model[1:](sparse_linear(x, self.model[0]))
         return self.model(x)
 
     def _mlp(self):
@@ -103,27 +109,32 @@ class scaden():
         train_x, val_x, test_x, train_y, val_y, test_y = prep4pbmc(h5ad_path=self.cfg.paths.h5ad_path, 
                                                                      target=self.cfg.common.target_domain,
                                                                      test_ratio=self.cfg.scaden.test_ratio,
-                                                                     target_path=self.cfg.paths.target_path)
-        
-        self.train_source_loader = Data.DataLoader(simdatset(train_x, train_y), batch_size=self.batch_size, shuffle=True)
+                                                                     target_path=self.cfg.paths.target_path,
+                                                                     random_state=getattr(self.cfg.scaden, 'split_seed', None),
+                                                                     store_dir=getattr(self.cfg.paths, 'feature_store_dir', None))
+        self._build_loaders(train_x, val_x, test_x, train_y, val_y, test_y)
+    
+    def _build_loaders(self, train_x, val_x, test_x, train_y, val_y, test_y):
+        if issparse(train_x):
+            # NOTE: training X stays CSR and the first MLP layer consumes sparse batches
+            self.train_source_loader = csr_loader(CSRDataset(train_x, train_y, sparse=True), batch_size=self.batch_size)
+        else:
+            self.train_source_loader = Data.DataLoader(simdatset(train_x, train_y), batch_size=self.batch_size, shuffle=True)
+        val_x, test_x = [x.toarray() if issparse(x) else x for x in [val_x, test_x]]
         self.val_source_loader = Data.DataLoader(simdatset(val_x, val_y), batch_size=self.batch_size, shuffle=True)
         self.test_target_loader = Data.DataLoader(simdatset(test_x, test_y), batch_size=len(test_x), shuffle=False)
 
         self.inputdim = self.train_source_loader.dataset.X.shape[1]
         self.outputdim = self.train_source_loader.dataset.Y.shape[1]
-    
+
     def set4tissue_application(self):
         train_x, val_x, test_x, train_y, val_y, test_y = prep4tissue(h5ad_path=self.cfg.paths.h5ad_path, 
                                                                      target=self.cfg.common.target_domain,
                                                                      test_ratio=self.cfg.scaden.test_ratio,
-                                                                     target_path=self.cfg.paths.target_path)
-        
-        self.train_source_loader = Data.DataLoader(simdatset(train_x, train_y), batch_size=self.batch_size, shuffle=True)
-        self.val_source_loader = Data.DataLoader(simdatset(val_x, val_y), batch_size=self.batch_size, shuffle=True)
-        self.test_target_loader = Data.DataLoader(simdatset(test_x, test_y), batch_size=len(test_x), shuffle=False)
-
-        self.inputdim = self.train_source_loader.dataset.X.shape[1]
-        self.outputdim = self.train_source_loader.dataset.Y.shape[1]
+                                                                     target_path=self.cfg.paths.target_path,
+                                                                     random_state=getattr(self.cfg.scaden, 'split_seed', None),
+                                                                     store_dir=getattr(self.cfg.paths, 'feature_store_dir', None))
+        self._build_loaders(train_x, val_x, test_x, train_y, val_y, test_y)
     
     
     def set_data_benchmark(self):
@@ -151,11 +162,10 @@ class scaden():
         loss = []
         best_loss = 1e10
         num_iter = 0
+        prefetcher = PairPrefetcher(self.train_source_loader, device=device)
         for i in tqdm(range(self.epochs)):
             loss_epoch = 0
-            for data, label in self.train_source_loader:
-                data = data.to(device)
-                label = label.to(device)
+            for data, label, _ in prefetcher:
                 optimizer.zero_grad()
                 batch_loss = self._loss_func(model(data), label)
                 batch_loss.backward()
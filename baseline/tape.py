@@ -35,6 +35,7 @@ BASE_DIR = '/workspace/mnt/cluster/HDD/azuma/TopicModel_Deconv'
 sys.path.append(BASE_DIR+'/github/TRIAD')
 from _utils.dataset import *
 from baseline.baseline_utils import prep4pbmc, prep4tissue
+from _utils.prefetch import PairPrefetcher
 
 class simdatset(Dataset):
     def __init__(self, X, Y):
@@ -45,8 +46,9 @@ class simdatset(Dataset):
         return len(self.X)
 
     def __getitem__(self, index):
-        x = torch.from_numpy(self.X[index]).float().to(device)
-        y = torch.from_numpy(self.Y[index]).float().to(device)
+        # NOTE: stored splits are read-only memmaps, so rows are copied before torch.from_numpy
+        x = torch.from_numpy(np.array(self.X[index])).float().to(device)
+        y = torch.from_numpy(np.array(self.Y[index])).float().to(device)
         return x, y
     
 class AutoEncoder(nn.Module):
@@ -137,7 +139,9 @@ class tape():
         train_x, val_x, test_x, train_y, val_y, test_y = prep4pbmc(h5ad_path=self.cfg.paths.h5ad_path, 
                                                                    target=self.cfg.common.target_domain,
                                                                    test_ratio=self.cfg.tape.test_ratio,
-                                                                   target_path=self.cfg.paths.target_path)
+                                                                   target_path=self.cfg.paths.target_path,
+                                                                   random_state=getattr(self.cfg.tape, 'split_seed', None),
+                                                                   store_dir=getattr(self.cfg.paths, 'feature_store_dir', None))
         
         self.train_source_loader = Data.DataLoader(simdatset(train_x, train_y), batch_size=self.batch_size, shuffle=True)
         self.val_source_loader = Data.DataLoader(simdatset(val_x, val_y), batch_size=self.batch_size, shuffle=True)
@@ -150,7 +154,9 @@ class tape():
         train_x, val_x, test_x, train_y, val_y, test_y = prep4tissue(h5ad_path=self.cfg.paths.h5ad_path, 
                                                                      target=self.cfg.common.target_domain,
                                                                      test_ratio=self.cfg.scaden.test_ratio,
-                                                                     target_path=self.cfg.paths.target_path)
+                                                                     target_path=self.cfg.paths.target_path,
+                                                                     random_state=getattr(self.cfg.tape, 'split_seed', None),
+                                                                     store_dir=getattr(self.cfg.paths, 'feature_store_dir', None))
         
         self.train_source_loader = Data.DataLoader(simdatset(train_x, train_y), batch_size=self.batch_size, shuffle=True)
         self.val_source_loader = Data.DataLoader(simdatset(val_x, val_y), batch_size=self.batch_size, shuffle=True)
@@ -166,11 +172,10 @@ class tape():
         recon_loss = []
         best_loss = 1e10
         num_iter = 0
+        prefetcher = PairPrefetcher(self.train_source_loader, device=device)
         for i in tqdm(range(self.epochs)):
             loss_epoch = 0
-            for k, (data, label) in enumerate(self.train_source_loader):
-                data = data.to(device)
-                label = label.to(device)
+            for k, (data, label, _) in enumerate(prefetcher):
 
                 optimizer.zero_grad()
                 x_recon, cell_prop, sigm = model(data)
@@ -228,7 +233,7 @@ class tape():
         self.model.eval()
         self.model.state = 'test'
         test_x, test_y = self.test_target_loader.dataset.X, self.test_target_loader.dataset.Y
-        data = torch.from_numpy(test_x).float().to(device)
+        data = torch.from_numpy(np.array(test_x)).float().to(device)
         _, pred, _ = self.model(data)
         pred = pred.cpu().detach().numpy()
 
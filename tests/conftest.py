@@ -0,0 +1,20 @@
+import os
+import sys
+
+# NOTE: the modules import each other as `_utils.*` / `model.*`, so the repo root and triad/ go on sys.path
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'triad'))
+
+import pytest
+
+@pytest.fixture
+def dataset_module(monkeypatch):
+    """
+    _utils.dataset, imported without its chdir into the cluster BASE_DIR.
+    """
+    for mod in ['torch', 'scanpy', 'anndata', 'sklearn']:
+        pytest.importorskip(mod)
+    import importlib
+    monkeypatch.setattr(os, 'chdir', lambda path: None)
+    return importlib.import_module('_utils.dataset')
@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+
+def test_select_var_indices_breaks_ties_by_column_index(dataset_module):
+    var = np.array([1., 3., 2., 3., 2., 2., 0.5])
+    assert dataset_module.select_var_indices(var, 4).tolist() == [1, 3, 2, 4]  # the tie at 2.0 keeps columns 2 and 4
+    assert dataset_module.select_var_indices(var, 10).tolist() == [1, 3, 2, 4, 5, 0, 6]
+
+@pytest.mark.parametrize('top_n', [1, 5, 17, 50, 99])
+def test_select_var_indices_matches_stable_argsort(dataset_module, top_n):
+    var = np.random.default_rng(0).integers(0, 10, size=100).astype(np.float64)  # many exact ties
+    expected = np.argsort(-var, kind='stable')[:top_n]
+    np.testing.assert_array_equal(dataset_module.select_var_indices(var, top_n), expected)
+
+@pytest.mark.parametrize('sparse', [False, True])
+def test_get_var_indices_on_duplicated_columns(dataset_module, sparse):
+    from scipy.sparse import csr_matrix
+    rng = np.random.default_rng(1)
+    base = rng.poisson(2.0, size=(300, 1)) * np.array([1., 2., 3.])  # three distinct variances
+    order = rng.permutation(np.repeat([0, 1, 2], 4))  # every variance appears in four columns
+    X = base[:, order].astype(np.float32)
+    X = csr_matrix(X) if sparse else X
+    expected = sorted(range(len(order)), key=lambda j: (-order[j], j))
+    assert dataset_module.get_var_indices(X, 6, chunk_size=64).tolist() == expected[:6]
+
+def test_column_stats_bounds_dense_chunks(dataset_module):
+    X = np.random.default_rng(2).normal(size=(257, 16)).astype(np.float32)
+    X0 = X.copy()
+    var = dataset_module.column_variance(X, chunk_size=10000, chunk_bytes=8 * 16 * 10)  # 10 rows per chunk
+    np.testing.assert_allclose(var, X.astype(np.float64).var(axis=0), rtol=1e-10)
+    np.testing.assert_array_equal(X, X0)
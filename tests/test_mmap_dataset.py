@@ -0,0 +1,42 @@
+import json
+import numpy as np
+import pytest
+
+pytest.importorskip('torch')
+
+from _utils.mmap_dataset import MemmapSourceLoader
+
+def _write(tmp_path, n, d=3):
+    X = np.arange(n * d, dtype=np.float32).reshape(n, d)
+    y = np.arange(n, dtype=np.float32)[:, None]
+    np.save(tmp_path / 'X.npy', X)
+    np.save(tmp_path / 'y.npy', y)
+    with open(tmp_path / 'meta.json', 'w') as f:
+        json.dump({}, f)
+
+@pytest.mark.parametrize('n', [8000, 7999])
+def test_two_ranks_with_fewer_blocks_than_ranks(tmp_path, n):
+    # one block (n < block_size) shared by two ranks
+    _write(tmp_path, n)
+    seen = []
+    for rank in range(2):
+        loader = MemmapSourceLoader(str(tmp_path), batch_size=512, block_size=8192, prefetch=1, seed=0, rank=rank, world_size=2)
+        batches = list(loader)
+        assert len(batches) == len(loader)
+        x = np.concatenate([b[0].numpy() for b in batches])
+        y = np.concatenate([b[1].numpy() for b in batches])[:, 0]
+        assert len(y) == loader.num_samples
+        np.testing.assert_array_equal(x[:, 0], y * 3)  # rows stay paired
+        seen.append(y.astype(int))
+    assert set(np.concatenate(seen)) == set(range(n))
+
+def test_epochs_reshuffle_and_are_reproducible(tmp_path):
+    _write(tmp_path, 1000)
+    a = MemmapSourceLoader(str(tmp_path), batch_size=100, block_size=64, seed=1)
+    b = MemmapSourceLoader(str(tmp_path), batch_size=100, block_size=64, seed=1)
+    ya0 = np.concatenate([t[1].numpy() for t in a])
+    yb0 = np.concatenate([t[1].numpy() for t in b])
+    ya1 = np.concatenate([t[1].numpy() for t in a])
+    np.testing.assert_array_equal(ya0, yb0)
+    assert not np.array_equal(ya0, ya1)
+    assert sorted(ya0[:, 0].astype(int)) == list(range(1000))
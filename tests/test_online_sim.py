@@ -0,0 +1,37 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+def _write_inputs(tmp_path, n_cells=60, n_genes=40):
+    from anndata import AnnData
+    rng = np.random.default_rng(0)
+    X = rng.poisson(3.0, size=(n_cells, n_genes)).astype(np.float32)
+    genes = [f'Gene{i}a' for i in range(n_genes)]  # mixed case, upper-cased by prep4inference
+    celltype = np.array(['A', 'B'])[np.arange(n_cells) % 2]
+    obs = pd.DataFrame({'A': (celltype == 'A').astype(float), 'B': (celltype == 'B').astype(float),
+                        'celltype': celltype, 'ds': 'data6k'}, index=[f'c{i}' for i in range(n_cells)])
+    h5ad_path = str(tmp_path / 'atlas.h5ad')
+    AnnData(X=X, obs=obs, var=pd.DataFrame(index=genes)).write_h5ad(h5ad_path)
+
+    target = pd.DataFrame(rng.poisson(5.0, size=(n_genes, 3)), index=[g.upper() for g in genes], columns=['s0', 's1', 's2'])
+    target_path = str(tmp_path / 'target.csv')
+    target.to_csv(target_path)
+    return h5ad_path, target_path, X, genes
+
+def test_loader_from_prep4inference_output(tmp_path, dataset_module):
+    from _utils.online_sim import OnlineBulkLoader
+    h5ad_path, target_path, X, genes = _write_inputs(tmp_path)
+    train_data, _, _, _ = dataset_module.prep4inference(h5ad_path, target_path, source_list=['data6k'], target='T',
+                                                        target_cells=['A', 'B'])
+    params = train_data.uns['transform']
+    assert not set(params['gene_names']) & set(genes)  # recorded upper-cased, not as in the atlas
+
+    loader = OnlineBulkLoader.from_h5ad(h5ad_path, params, ['A', 'B'], batch_size=4, n_batches=2, pool_size=10)
+    col = [[g.upper() for g in genes].index(g) for g in params['gene_names']]
+    np.testing.assert_array_equal(np.asarray(loader.X), X[:, col])
+
+    batches = list(loader)
+    assert len(batches) == 2
+    x, y = batches[0]
+    assert tuple(x.shape) == (4, len(params['gene_names']))
+    np.testing.assert_allclose(y.numpy().sum(axis=1), 1, rtol=1e-5)
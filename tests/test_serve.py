@@ -0,0 +1,46 @@
+import json
+import threading
+import urllib.request
+import numpy as np
+
+OPTIONS = {'batch_size': 4, 'feature_num': 6, 'latent_dim': 4, 'hidden_dim': 2, 'hidden_layers': 1, 'celltype_num': 3,
+           'epochs': 1, 'learning_rate': 1e-3, 'early_stop': 1, 'SaveResultsDir': '.', 'pred_loss_type': 'custom',
+           'dag_w': 0.1, 'pred_w': 1.0, 'disc_w': 0.1}
+CELLS = ['A', 'B', 'C']
+
+def test_served_predictions_replay_the_recorded_transform(tmp_path, dataset_module):
+    import torch
+    from model.route9.triad_model import TRIAD
+    from model.route9.quantize import export_quantized, load_predictor
+    from model.route9.serve import build_server
+
+    model_path = str(tmp_path / 'best_model_0.pth')
+    torch.save(TRIAD(OPTIONS, seed=0).state_dict(), model_path)
+    genes = [f'GENE{i}' for i in range(OPTIONS['feature_num'])]
+    transform = dataset_module.TransformPipeline(np.arange(len(genes)), gene_names=genes, log_conv=True, mm_scale=True).params
+    artifact = export_quantized(OPTIONS, model_path, str(tmp_path / 'model.pt'), gene_names=genes, target_cells=CELLS,
+                                transform=transform, seed=0, quantize=False)
+
+    raw = np.random.default_rng(0).poisson(20, size=(len(genes), 3)).astype(np.float32)  # genes x samples
+    payload = {'model': 'm', 'genes': [g.lower() for g in genes[::-1]],  # other order and case than the model
+               'samples': {f's{j}': raw[::-1, j].tolist() for j in range(raw.shape[1])}}
+
+    server = build_server({'m': artifact}, port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        req = urllib.request.Request(f'http://127.0.0.1:{server.server_address[1]}/predict',
+                                     data=json.dumps(payload).encode(), headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(req) as r:
+            body = json.loads(r.read())
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    # log2(x + 1), then per-sample min-max, as recorded in the artifact
+    x = np.log2(raw.T + 1)
+    x = (x - x.min(axis=1, keepdims=True)) / (x.max(axis=1, keepdims=True) - x.min(axis=1, keepdims=True))
+    with torch.no_grad():
+        expected = load_predictor(OPTIONS, model_path, seed=0)(torch.from_numpy(x.astype(np.float32))).numpy()
+    served = np.array([[body['proportions'][f's{j}'][c] for c in CELLS] for j in range(raw.shape[1])])
+    assert body['matched_genes'] == len(genes)
+    np.testing.assert_allclose(served, expected, rtol=1e-4, atol=1e-6)
@@ -6,6 +6,7 @@ import torch.utils.data as Data
 import random
 import numpy as np
 import pandas as pd
+from scipy.sparse import issparse
 from collections import defaultdict
 import warnings
 warnings.filterwarnings('ignore')
@@ -16,6 +17,8 @@ import sys
 BASE_DIR = '/workspace/mnt/cluster/HDD/azuma/TopicModel_Deconv'
 sys.path.append(BASE_DIR+'/github/GSTMDec')
 from _utils import common_utils
+from _utils.prefetch import PairPrefetcher
+from _utils.sparse_input import CSRDataset, csr_loader, is_sparse_tensor, sparse_linear
 
 class EncoderBlock(nn.Module):
     def __init__(self, in_dim, out_dim, do_rates):
@@ -24,6 +27,8 @@ class EncoderBlock(nn.Module):
                                    nn.LeakyReLU(0.2, inplace=True),
                                    nn.Dropout(p=do_rates, inplace=False))
     def forward(self, x):
+        if is_sparse_tensor(x):  # NOTE: first layer on CSR input (sparse-dense matmul)
+            return self.layer[1:](sparse_linear(x, self.layer[0]))
         out = self.layer(x)
         return out
 
@@ -51,6 +56,7 @@ class DANN(object):
         self.labels = None
         self.used_features = None
         self.seed = seed
+        self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         self.outdir = option_list['SaveResultsDir']
 
         cudnn.deterministic = True
@@ -82,13 +88,18 @@ class DANN(object):
         ### Prepare data loader for training ###
         # Source dataset
         source_ratios = [source_data.obs[ctype] for ctype in source_data.uns['cell_types']]
-        self.source_data_x = source_data.X.astype(np.float32)
         self.source_data_y = np.array(source_ratios, dtype=np.float32).transpose()
-        
-        tr_data = torch.FloatTensor(self.source_data_x)
-        tr_labels = torch.FloatTensor(self.source_data_y)
-        source_dataset = Data.TensorDataset(tr_data, tr_labels)
-        self.train_source_loader = Data.DataLoader(dataset=source_dataset, batch_size=batch_size, shuffle=True)
+        if issparse(source_data.X):
+            # NOTE: X stays CSR and the first encoder layer consumes sparse batches
+            source_dataset = CSRDataset(source_data.X, self.source_data_y, sparse=True)
+            self.source_data_x = source_dataset.X
+            self.train_source_loader = csr_loader(source_dataset, batch_size)
+        else:
+            self.source_data_x = source_data.X.astype(np.float32)
+            tr_data = torch.FloatTensor(self.source_data_x)
+            tr_labels = torch.FloatTensor(self.source_data_y)
+            source_dataset = Data.TensorDataset(tr_data, tr_labels)
+            self.train_source_loader = Data.DataLoader(dataset=source_dataset, batch_size=batch_size, shuffle=True)
 
         # Extract celltype and feature info
         self.labels = source_data.uns['cell_types']
@@ -109,11 +120,14 @@ class DANN(object):
         self.train_target_loader = Data.DataLoader(dataset=target_dataset, batch_size=batch_size, shuffle=True)
         self.test_target_loader = Data.DataLoader(dataset=target_dataset, batch_size=batch_size, shuffle=False)
 
+        # NOTE: target batches cycle through the target loader within an epoch
+        self.train_prefetcher = PairPrefetcher(self.train_source_loader, self.train_target_loader, device=self.device, target_mode='cycle')
+
     def train(self, source_data, target_data):
 
         ### prepare model structure ###
         self.prepare_dataloader(source_data, target_data, self.batch_size)
-        self.model_da = self.DANN_model(self.celltype_num).cuda()
+        self.model_da = self.DANN_model(self.celltype_num).to(self.device)
 
         ### setup optimizer ###
         optimizer_da1 = torch.optim.Adam([{'params': self.encoder_da.parameters()},
@@ -122,9 +136,9 @@ class DANN(object):
         optimizer_da2 = torch.optim.Adam([{'params': self.encoder_da.parameters()},
                                           {'params': self.discriminator_da.parameters()}], lr=self.learning_rate)
         
-        criterion_da = nn.BCELoss().cuda()
-        source_label = torch.ones(self.batch_size).unsqueeze(1).cuda()   # define source domain label as 1
-        target_label = torch.zeros(self.batch_size).unsqueeze(1).cuda()  # define target domain label as 0
+        criterion_da = nn.BCELoss().to(self.device)
+        source_label = torch.ones(self.batch_size).unsqueeze(1).to(self.device)   # define source domain label as 1
+        target_label = torch.zeros(self.batch_size).unsqueeze(1).to(self.device)  # define target domain label as 0
         
         self.metric_logger = defaultdict(list) 
 
@@ -133,25 +147,17 @@ class DANN(object):
         for epoch in range(self.num_epochs):
             self.model_da.train()
 
-            train_target_iterator = iter(self.train_target_loader)
             pred_loss_epoch, disc_loss_epoch, disc_loss_DA_epoch = 0., 0., 0.
-            for batch_idx, (source_x, source_y) in enumerate(self.train_source_loader):
-                # get batch item of target
-                try:
-                    target_x, _ = next(train_target_iterator)
-                except StopIteration:
-                    train_target_iterator = iter(self.train_target_loader)
-                    target_x, _ = next(train_target_iterator)
-
-                embedding_source = self.encoder_da(source_x.cuda())
-                embedding_target = self.encoder_da(target_x.cuda())
+            for batch_idx, (source_x, source_y, target_x) in enumerate(self.train_prefetcher):
+                embedding_source = self.encoder_da(source_x.to(self.device))
+                embedding_target = self.encoder_da(target_x.to(self.device))
                 frac_pred = self.predictor_da(embedding_source)
                 domain_pred_source = self.discriminator_da(embedding_source)
                 domain_pred_target = self.discriminator_da(embedding_target)
 
                 # calculate loss 
                 if self.pred_loss_type == 'L1':
-                    pred_loss = L1_loss(frac_pred, source_y.cuda())
+                    pred_loss = L1_loss(frac_pred, source_y.to(self.device))
                 elif self.pred_loss_type == 'custom':
                     pred_loss = self.summarize_loss(frac_pred, source_y)
                 else:
@@ -166,8 +172,8 @@ class DANN(object):
                 loss.backward(retain_graph=True)
                 optimizer_da1.step()
 
-                embedding_source = self.encoder_da(source_x.cuda())
-                embedding_target = self.encoder_da(target_x.cuda())
+                embedding_source = self.encoder_da(source_x.to(self.device))
+                embedding_target = self.encoder_da(target_x.to(self.device))
                 domain_pred_source = self.discriminator_da(embedding_source)
                 domain_pred_target = self.discriminator_da(embedding_target)
 
@@ -216,15 +222,15 @@ class DANN(object):
         torch.save(self.model_da.state_dict(), os.path.join(self.outdir, 'last_model.pth'))
     
     def load_checkpoint(self, model_path):
-        self.model_da = self.DANN_model(self.celltype_num).cuda()
-        self.model_da.load_state_dict(torch.load(model_path))
+        self.model_da = self.DANN_model(self.celltype_num).to(self.device)
+        self.model_da.load_state_dict(torch.load(model_path, map_location=self.device))
         self.model_da.eval()
             
     def prediction(self):
         self.model_da.eval()
         preds, gt = None, None
         for batch_idx, (x, y) in enumerate(self.test_target_loader):
-            logits = self.predictor_da(self.encoder_da(x.cuda())).detach().cpu().numpy()
+            logits = self.predictor_da(self.encoder_da(x.to(self.device))).detach().cpu().numpy()
             frac = y.detach().cpu().numpy()
             preds = logits if preds is None else np.concatenate((preds, logits), axis=0)
             gt = frac if gt is None else np.concatenate((gt, frac), axis=0)
@@ -237,9 +243,9 @@ class DANN(object):
         # deconvolution loss
         # if prop_data is not tensor, convert it to tensor
         if type(prop_data) == torch.Tensor:
-            prop_tensor = prop_data.cuda()
+            prop_tensor = prop_data.to(self.device)
         else:
-            prop_tensor = torch.tensor(prop_data.values).cuda()
+            prop_tensor = torch.tensor(prop_data.values).to(self.device)
 
         assert theta_tensor.shape[0] == prop_tensor.shape[0], "Batch size is different"
         deconv_loss_dic = common_utils.calc_deconv_loss(theta_tensor, prop_tensor)
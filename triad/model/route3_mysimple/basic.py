@@ -11,6 +11,7 @@ import os
 import random
 import numpy as np
 import pandas as pd
+from scipy.sparse import issparse
 from tqdm import tqdm
 from collections import defaultdict
 
@@ -32,6 +33,9 @@ import sys
 BASE_DIR = '/workspace/mnt/cluster/HDD/azuma/TopicModel_Deconv'
 sys.path.append(BASE_DIR+'/github/GSTMDec')
 from _utils import common_utils
+from _utils.feature_store import stored
+from _utils.prefetch import PairPrefetcher
+from _utils.sparse_input import CSRDataset, csr_loader
 
 class LossFunctions:
     eps = 1e-8
@@ -81,6 +85,7 @@ class MultiTaskAutoEncoder(nn.Module):
     def __init__(self, option_list, seed=42):
         super(MultiTaskAutoEncoder, self).__init__()
         self.seed = seed
+        self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         self.batch_size = option_list['batch_size']
         self.feature_num = option_list['feature_num']
         self.latent_dim = option_list['latent_dim']
@@ -121,7 +126,7 @@ class MultiTaskAutoEncoder(nn.Module):
     def train(self, source_data, target_data):
         ### prepare model structure ###
         self.prepare_dataloader(source_data, target_data, self.batch_size)
-        self.model_da = self.MTAE_model().cuda()
+        self.model_da = self.MTAE_model().to(self.device)
 
         # setup optimizer
         optimizer = torch.optim.Adam([{'params': self.encoder.parameters()},
@@ -134,25 +139,22 @@ class MultiTaskAutoEncoder(nn.Module):
         update_flag = 0  
         for epoch in range(self.num_epochs):
             self.model_da.train()
-            train_target_iterator = iter(self.train_target_loader)
             rec_loss_epoch, pred_loss_epoch = 0., 0.
-            for batch_idx, (source_x, source_y) in enumerate(self.train_source_loader):
-                target_x = next(iter(self.test_target_loader))[0]  # NOTE: without shuffle
-                #target_x = next(iter(train_target_loader))[0]   # NOTE: with shuffle
+            for batch_idx, (source_x, source_y, target_x) in enumerate(self.train_prefetcher):  # NOTE: target without shuffle
 
-                source_emb = self.encoder(source_x.cuda())
-                target_emb = self.encoder(target_x.cuda())
+                source_emb = self.encoder(source_x.to(self.device))
+                target_emb = self.encoder(target_x.to(self.device))
                 source_pred = self.predictor(source_emb)
 
                 # calculate reconstruction loss
                 source_rec = self.decoder(source_emb)
                 target_rec = self.decoder(target_emb)
-                rec_loss = self.losses.reconstruction_loss(source_x.cuda(), source_rec, rec_type='mse') + self.losses.reconstruction_loss(target_x.cuda(), target_rec, rec_type='mse')
-                #rec_loss = F.mse_loss(source_rec, source_x.cuda()) + F.mse_loss(target_rec, target_x.cuda())
+                rec_loss = self.losses.reconstruction_loss(source_x.to(self.device), source_rec, rec_type='mse') + self.losses.reconstruction_loss(target_x.to(self.device), target_rec, rec_type='mse')
+                #rec_loss = F.mse_loss(source_rec, source_x.to(self.device)) + F.mse_loss(target_rec, target_x.to(self.device))
                 rec_loss_epoch += rec_loss.data.item()
 
                 # calculate prediction loss
-                pred_loss = self.losses.summarize_loss(source_pred, source_y.cuda())
+                pred_loss = self.losses.summarize_loss(source_pred, source_y.to(self.device))
                 pred_loss_epoch += pred_loss.data.item()
 
                 loss = (self.rec_w*rec_loss) + (self.pred_w*pred_loss)
@@ -187,8 +189,8 @@ class MultiTaskAutoEncoder(nn.Module):
                         break
 
     def load_checkpoint(self, model_path):
-        self.model_da = self.MTAE_model().cuda()
-        self.model_da.load_state_dict(torch.load(model_path))
+        self.model_da = self.MTAE_model().to(self.device)
+        self.model_da.load_state_dict(torch.load(model_path, map_location=self.device))
         self.model_da.eval()
 
     def prediction(self, test_target_loader=None):
@@ -198,7 +200,7 @@ class MultiTaskAutoEncoder(nn.Module):
         self.model_da.eval()
         preds, gt = None, None
         for batch_idx, (x, y) in enumerate(test_target_loader):
-            logits = self.predictor(self.encoder(x.cuda())).detach().cpu().numpy()
+            logits = self.predictor(self.encoder(x.to(self.device))).detach().cpu().numpy()
             frac = y.detach().cpu().numpy()
             preds = logits if preds is None else np.concatenate((preds, logits), axis=0)
             gt = frac if gt is None else np.concatenate((gt, frac), axis=0)
@@ -215,13 +217,18 @@ class MultiTaskAutoEncoder(nn.Module):
 
         # Source dataset
         source_ratios = [source_data.obs[ctype] for ctype in source_data.uns['cell_types']]
-        self.source_data_x = source_data.X.astype(np.float32)
         self.source_data_y = np.array(source_ratios, dtype=np.float32).transpose()
-        
-        tr_data = torch.FloatTensor(self.source_data_x)
-        tr_labels = torch.FloatTensor(self.source_data_y)
-        source_dataset = Data.TensorDataset(tr_data, tr_labels)
-        self.train_source_loader = Data.DataLoader(dataset=source_dataset, batch_size=batch_size, shuffle=True)
+        if issparse(source_data.X):
+            # NOTE: X stays CSR; batches are densified per step (the reconstruction loss needs dense x)
+            source_dataset = CSRDataset(source_data.X, self.source_data_y)
+            self.source_data_x = source_dataset.X
+            self.train_source_loader = csr_loader(source_dataset, batch_size)
+        else:
+            self.source_data_x = source_data.X.astype(np.float32)
+            tr_data = torch.FloatTensor(self.source_data_x)
+            tr_labels = torch.FloatTensor(self.source_data_y)
+            source_dataset = Data.TensorDataset(tr_data, tr_labels)
+            self.train_source_loader = Data.DataLoader(dataset=source_dataset, batch_size=batch_size, shuffle=True)
 
         # Extract celltype and feature info
         self.labels = source_data.uns['cell_types']
@@ -238,6 +245,10 @@ class MultiTaskAutoEncoder(nn.Module):
         self.train_target_loader = DataLoader(dataset=target_dataset, batch_size=batch_size, shuffle=True, worker_init_fn=seed_worker, generator=g)
         self.test_target_loader = Data.DataLoader(dataset=target_dataset, batch_size=batch_size, shuffle=False)
 
+        # NOTE: resample mode on the unshuffled loader repeats its first batch, as next(iter(self.test_target_loader)) did
+        self.train_prefetcher = PairPrefetcher(self.train_source_loader, self.test_target_loader, device=self.device, seed=self.seed)
+
+@stored(path_args=['trainingdatapath'])
 def preprocess(trainingdatapath, source='data6k', target='sdy67', n_samples=None, n_vtop=None):
     assert target in ['sdy67', 'GSE65133', 'donorA', 'donorC', 'data6k', 'data8k']
     pbmc = sc.read_h5ad(trainingdatapath)
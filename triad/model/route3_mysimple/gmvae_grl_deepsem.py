@@ -38,6 +38,7 @@ import sys
 BASE_DIR = '/workspace/mnt/cluster/HDD/azuma/TopicModel_Deconv'
 sys.path.append(BASE_DIR+'/github/GSTMDec')
 from _utils import common_utils
+from _utils.feature_store import stored
 
 class LossFunctions:
     eps = 1e-8
@@ -343,6 +344,7 @@ class MultiTaskAutoEncoder(nn.Module):
         self.test_target_loader = Data.DataLoader(dataset=target_dataset, batch_size=batch_size, shuffle=False)
 
 
+@stored(path_args=['trainingdatapath'])
 def preprocess(trainingdatapath, source='data6k', target='sdy67', n_samples=None, n_vtop=None):
     assert target in ['sdy67', 'GSE65133', 'donorA', 'donorC', 'data6k', 'data8k']
     pbmc = sc.read_h5ad(trainingdatapath)
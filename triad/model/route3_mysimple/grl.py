@@ -10,6 +10,7 @@ import os
 import random
 import numpy as np
 import pandas as pd
+from scipy.sparse import issparse
 from tqdm import tqdm
 from collections import defaultdict
 from sklearn.metrics import roc_auc_score
@@ -34,6 +35,8 @@ import sys
 BASE_DIR = '/workspace/mnt/cluster/HDD/azuma/TopicModel_Deconv'
 sys.path.append(BASE_DIR+'/github/GSTMDec')
 from _utils import common_utils
+from _utils.feature_store import stored
+from _utils.sparse_input import CSRDataset, csr_loader
 
 class LossFunctions:
     eps = 1e-8
@@ -192,13 +195,18 @@ class MultiTaskAutoEncoder(nn.Module):
 
         # Source dataset
         source_ratios = [source_data.obs[ctype] for ctype in source_data.uns['cell_types']]
-        self.source_data_x = source_data.X.astype(np.float32)
         self.source_data_y = np.array(source_ratios, dtype=np.float32).transpose()
-        
-        tr_data = torch.FloatTensor(self.source_data_x)
-        tr_labels = torch.FloatTensor(self.source_data_y)
-        source_dataset = Data.TensorDataset(tr_data, tr_labels)
-        self.train_source_loader = Data.DataLoader(dataset=source_dataset, batch_size=batch_size, shuffle=True)
+        if issparse(source_data.X):
+            # NOTE: X stays CSR; batches are densified per step (the reconstruction loss needs dense x)
+            source_dataset = CSRDataset(source_data.X, self.source_data_y)
+            self.source_data_x = source_dataset.X
+            self.train_source_loader = csr_loader(source_dataset, batch_size)
+        else:
+            self.source_data_x = source_data.X.astype(np.float32)
+            tr_data = torch.FloatTensor(self.source_data_x)
+            tr_labels = torch.FloatTensor(self.source_data_y)
+            source_dataset = Data.TensorDataset(tr_data, tr_labels)
+            self.train_source_loader = Data.DataLoader(dataset=source_dataset, batch_size=batch_size, shuffle=True)
 
         # Extract celltype and feature info
         self.labels = source_data.uns['cell_types']
@@ -216,6 +224,7 @@ class MultiTaskAutoEncoder(nn.Module):
         self.test_target_loader = Data.DataLoader(dataset=target_dataset, batch_size=batch_size, shuffle=False)
 
 
+@stored(path_args=['trainingdatapath'])
 def preprocess(trainingdatapath, source='data6k', target='sdy67', n_samples=None, n_vtop=None):
     assert target in ['sdy67', 'GSE65133', 'donorA', 'donorC', 'data6k', 'data8k']
     pbmc = sc.read_h5ad(trainingdatapath)
@@ -36,7 +36,8 @@ device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 # %%
 #  Load dataset
 trainingdatapath = BASE_DIR+"/datasource/scRNASeq/Scaden/pbmc_data.h5ad"
-train_data, test_data, train_y, test_y = preprocess(trainingdatapath,source='data6k',target='sdy67', n_samples=1024, n_vtop=1000)
+feature_store_dir = BASE_DIR+"/datasource/feature_store"  # NOTE: same directory as cfg.paths.feature_store_dir (TRIAD / baselines)
+train_data, test_data, train_y, test_y = preprocess(trainingdatapath,source='data6k',target='sdy67', n_samples=1024, n_vtop=1000, store_dir=feature_store_dir)
 
 #  Parameter settings
 option_list = defaultdict(list)
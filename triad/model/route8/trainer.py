@@ -28,6 +28,7 @@ import sys
 sys.path.append(BASE_DIR+'/github/TRIAD/triad')
 from model.route8.gae_grl_model import *
 from _utils.dataset import *
+from _utils.prefetch import PairPrefetcher
 
 sys.path.append(BASE_DIR+'/github/wandb-util')  
 from wandbutil import WandbLogger
@@ -77,6 +78,11 @@ class BaseTrainer():
         target_dataset = Data.TensorDataset(te_data, te_labels)
         self.train_target_loader = Data.DataLoader(dataset=target_dataset, batch_size=batch_size, shuffle=True, worker_init_fn=seed_worker, generator=g)
         self.test_target_loader = Data.DataLoader(dataset=target_dataset, batch_size=batch_size, shuffle=False)
+
+        # 3. Background prefetch of (source, target) batch pairs
+        self.train_prefetcher = PairPrefetcher(self.train_source_loader, self.train_target_loader, device=self.device,
+                                               depth=getattr(self.cfg.gaegrl, 'prefetch_depth', 2),
+                                               seed=self.seed)
     
     def set_options(self):
         # prepare option list
@@ -174,15 +180,13 @@ class BaseTrainer():
         dag_loss_epoch, pred_loss_epoch, disc_loss_epoch = 0., 0., 0.
         all_preds = []
         all_labels = []
-        for batch_idx, (source_x, source_y) in enumerate(self.train_source_loader):
-            target_x = next(iter(self.train_target_loader))[0]   # NOTE: shuffle
+        for batch_idx, (source_x, source_y, target_x) in enumerate(self.train_prefetcher):
             #target_x = torch.Tensor(test_data.X)
 
             total_steps = model.num_epochs * len(self.train_source_loader)
             p = float(batch_idx + epoch * len(self.train_source_loader)) / total_steps
             a = 2.0 / (1.0 + np.exp(-10 * p)) - 1
 
-            source_x, source_y, target_x = source_x.cuda(), source_y.cuda(), target_x.cuda()
             rec_s, _, _= model(source_x, a)
             rec_t, _, _ = model(target_x, a)
 
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+Created on 2026-10-19 (Mon) 13:21:05
+
+CPU data-parallel helpers for TRIAD training (torch.distributed over gloo).
+
+The process group is initialised from the environment set by torchrun
+(RANK, WORLD_SIZE, MASTER_ADDR, MASTER_PORT). Without it every helper is a no-op,
+so the single-process BaseTrainer path is unchanged.
+
+@author: I.Azuma
+"""
+import os
+import numpy as np
+
+import torch
+import torch.distributed as dist
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
+
+def init_distributed(backend='gloo'):
+    """
+    Initialise the process group if launched with torchrun. Returns (rank, world_size).
+    """
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if world_size <= 1:
+        return 0, 1
+    if not dist.is_initialized():
+        dist.init_process_group(backend=backend)
+    return dist.get_rank(), dist.get_world_size()
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+
+def is_main_process():
+    return not is_distributed() or dist.get_rank() == 0
+
+def barrier():
+    """
+    Synchronise all ranks; a no-op without an initialised process group.
+    """
+    if is_distributed():
+        dist.barrier()
+
+def cleanup_distributed():
+    if is_distributed():
+        dist.barrier()
+        dist.destroy_process_group()
+
+def broadcast_model(model, src=0, buffers_only=False):
+    """
+    Broadcast parameters and buffers (e.g. BatchNorm running stats) from rank src.
+    """
+    if not is_distributed():
+        return
+    tensors = list(model.buffers()) if buffers_only else list(model.parameters()) + list(model.buffers())
+    with torch.no_grad():
+        for t in tensors:
+            dist.broadcast(t.data, src=src)
+
+def _allreduce_average(tensors, bucket_bytes):
+    """
+    Average tensors across ranks (in place), flattened into buckets of about bucket_bytes
+    per dtype, so that there is one all_reduce per bucket instead of one per tensor.
+    """
+    world_size = dist.get_world_size()
+    buckets, open_buckets = [], {}  # open_buckets: dtype -> (bucket, bytes)
+    for t in tensors:
+        bucket, size = open_buckets.get(t.dtype, (None, 0))
+        nbytes = t.numel() * t.element_size()
+        if bucket is None or size + nbytes > bucket_bytes:
+            bucket, size = [], 0
+            buckets.append(bucket)
+        bucket.append(t)
+        open_buckets[t.dtype] = (bucket, size + nbytes)
+    for bucket in buckets:
+        flat = _flatten_dense_tensors(bucket)
+        dist.all_reduce(flat, op=dist.ReduceOp.SUM)
+        flat.div_(world_size)
+        for t, synced in zip(bucket, _unflatten_dense_tensors(flat, bucket)):
+            t.copy_(synced)
+
+def allreduce_grads(params, bucket_bytes=25 << 20):
+    """
+    Average gradients of params across ranks (in place), bucketed as in DDP (25 MB by default).
+    NOTE: all ranks run the same graph, so a missing grad is missing on every rank.
+    """
+    if not is_distributed():
+        return
+    grads = [p.grad for p in params if p.grad is not None]
+    if grads:
+        with torch.no_grad():
+            _allreduce_average(grads, bucket_bytes)
+
+def allreduce_buffers(model, bucket_bytes=25 << 20):
+    """
+    Average the floating-point buffers (BatchNorm running mean / var) across ranks, so the
+    running statistics reflect the batches of every rank rather than those of rank 0.
+    """
+    if not is_distributed():
+        return
+    buffers = [b for b in model.buffers() if b.is_floating_point()]
+    if buffers:
+        with torch.no_grad():
+            _allreduce_average(buffers, bucket_bytes)
+
+def allreduce_mean(values):
+    """
+    Average a dict of python scalars across ranks.
+    """
+    if not is_distributed():
+        return values
+    keys = sorted(values.keys())
+    t = torch.tensor([float(values[k]) for k in keys], dtype=torch.float64)
+    dist.all_reduce(t, op=dist.ReduceOp.SUM)
+    t /= dist.get_world_size()
+    return {k: t[i].item() for i, k in enumerate(keys)}
+
+def broadcast_lagrangian(alpha, rho, pre_h, w_stop_flag, src=0):
+    """
+    Keep the augmented Lagrangian state (alpha, rho, pre_h, w_stop_flag) identical across ranks.
+    """
+    to_float = lambda v: float(v.detach().cpu()) if torch.is_tensor(v) else float(v)
+    if not is_distributed():
+        return alpha, rho, pre_h, w_stop_flag
+    t = torch.tensor([to_float(alpha), to_float(rho), to_float(pre_h), float(w_stop_flag)], dtype=torch.float64)
+    dist.broadcast(t, src=src)
+    alpha, rho, pre_h, w_stop_flag = t.tolist()
+    return alpha, rho, pre_h, bool(w_stop_flag)
+
+def shard_indices(n, rank, world_size):
+    """
+    Indices of a dataset of size n assigned to rank (strided, as DistributedSampler without padding).
+    """
+    return np.arange(n)[rank::world_size].tolist()
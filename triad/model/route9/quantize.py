@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+Created on 2026-10-19 (Mon) 10:12:31
+
+Dynamic int8 quantisation of the TRIAD inference path.
+
+Only the encoder-mean --> embedder --> predictor path is needed to score new samples,
+so the decoder, the DAG adjacency (w) and the discriminator are dropped before
+nn.Linear layers are quantised with torch.ao.quantization.quantize_dynamic.
+The artifact is a TorchScript module with the gene list, cell types and the target-side
+TransformPipeline params (uns['transform']) attached, so inputs can be replayed exactly
+and the model can be loaded on CPU-only hosts without the TRIAD model code.
+
+@author: I.Azuma
+"""
+import os
+import json
+import numpy as np
+import pandas as pd
+
+import torch
+import torch.nn as nn
+
+from model.route9.triad_model import TRIAD
+
+class TRIADPredictor(nn.Module):
+    """
+    Encoder-mean --> embedder --> predictor path of a trained TRIAD model.
+    """
+    def __init__(self, model):
+        super(TRIADPredictor, self).__init__()
+        self.encoder = model.encoder
+        self.embedder = model.embedder
+        self.predictor = model.predictor
+
+    def forward(self, x):  # NOTE: x: (batch_size, feature_num)
+        batch_size = x.size(0)
+        out = self.encoder(x.reshape((batch_size, x.size(1), 1)))  # (batch_size, feature_num, hidden_dim)
+        out_mean = torch.mean(out, dim=2)  # (batch_size, feature_num)
+        emb = self.embedder(out_mean)
+        return self.predictor(emb)
+
+def load_predictor(option_list, model_path, seed=42):
+    """
+    Build the fp32 TRIADPredictor from a TRIAD state_dict on CPU.
+    """
+    model = TRIAD(option_list, seed=seed)
+    model.load_state_dict(torch.load(model_path, map_location='cpu'))
+    predictor = TRIADPredictor(model).to('cpu')
+    predictor.eval()
+    return predictor
+
+def artifact_transform(meta):
+    """
+    TransformPipeline params of an artifact (older artifacts only recorded log_conv).
+    """
+    if meta.get('transform') is not None:
+        return meta['transform']
+    return {'gene_names': meta['gene_names'], 'log_conv': meta['log_conv'], 'mm_scale': False, 'dtype': 'float32'}
+
+def export_quantized(option_list, model_path, out_path, gene_names, target_cells, log_conv=True, seed=42, quantize=True, transform=None):
+    """
+    Export a dynamically quantised (int8) TorchScript inference artifact from a checkpoint.
+    Metadata (gene_names, target_cells, transform) is stored in the artifact as 'meta.json'.
+    transform: TransformPipeline params of the target side (uns['transform']); log_conv is only
+    used when it is None. quantize=False exports the fp32 path in the same format.
+    """
+    predictor = load_predictor(option_list, model_path, seed=seed)
+    if quantize:
+        q_predictor = torch.ao.quantization.quantize_dynamic(predictor, {nn.Linear}, dtype=torch.qint8)
+    else:
+        q_predictor = predictor
+
+    example = torch.zeros((2, option_list['feature_num']), dtype=torch.float32)
+    with torch.no_grad():
+        traced = torch.jit.trace(q_predictor, example)
+
+    if transform is None:
+        transform = {'gene_names': [str(g) for g in gene_names], 'log_conv': bool(log_conv), 'mm_scale': False, 'dtype': 'float32'}
+    transform = json.loads(json.dumps(transform, default=str))  # NOTE: uns values may be numpy types
+    meta = {
+        'gene_names': [str(g) for g in gene_names],
+        'target_cells': list(target_cells),
+        'log_conv': bool(transform['log_conv']),
+        'transform': transform,
+        'feature_num': int(option_list['feature_num']),
+        'dtype': 'qint8' if quantize else 'float32',
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(out_path)), exist_ok=True)
+    torch.jit.save(traced, out_path, _extra_files={'meta.json': json.dumps(meta)})
+
+    fp32_size = os.path.getsize(model_path) / 1e6
+    int8_size = os.path.getsize(out_path) / 1e6
+    print(f"Inference artifact saved to {out_path} ({int8_size:.2f} MB, checkpoint: {fp32_size:.2f} MB)")
+
+    return out_path
+
+def load_quantized(artifact_path):
+    """
+    Load a quantised artifact. Returns (module, meta).
+    """
+    extra_files = {'meta.json': ''}
+    module = torch.jit.load(artifact_path, map_location='cpu', _extra_files=extra_files)
+    module.eval()
+    meta = json.loads(extra_files['meta.json'])
+    return module, meta
+
+def validate_quantized(artifact_path, option_list, model_path, target_x, batch_size=256, seed=42):
+    """
+    Compare int8 and fp32 proportions on a held-out target set.
+    Returns per cell type max/mean absolute deviation (plus 'max' over all cell types).
+    """
+    q_module, meta = load_quantized(artifact_path)
+    predictor = load_predictor(option_list, model_path, seed=seed)
+
+    target_x = np.asarray(target_x, dtype=np.float32)
+    fp32_preds, int8_preds = [], []
+    with torch.no_grad():
+        for i in range(0, target_x.shape[0], batch_size):
+            x = torch.from_numpy(target_x[i:i + batch_size])
+            fp32_preds.append(predictor(x).numpy())
+            int8_preds.append(q_module(x).numpy())
+    fp32_preds = np.concatenate(fp32_preds, axis=0)
+    int8_preds = np.concatenate(int8_preds, axis=0)
+
+    diff = np.abs(int8_preds - fp32_preds)
+    dev_df = pd.DataFrame({'max_abs_dev': diff.max(axis=0), 'mean_abs_dev': diff.mean(axis=0)},
+                          index=meta['target_cells'])
+    dev_df.loc['max'] = [diff.max(), diff.mean()]
+    print(f"Max proportion deviation (int8 vs fp32): {diff.max():.4f}")
+
+    return dev_df
@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+"""
+Created on 2026-10-19 (Mon) 14:02:18
+
+Launcher for CPU data-parallel TRIAD training.
+
+Usage (single machine, 4 processes):
+    torchrun --nproc_per_node=4 run_distributed.py --config config.yml --mode benchmark --seed 42
+
+Multi-node runs use the usual torchrun rendezvous options (--nnodes, --node_rank, --rdzv_endpoint).
+
+@author: I.Azuma
+"""
+import os
+import sys
+import yaml
+import argparse
+from types import SimpleNamespace
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
+
+def to_namespace(d):
+    if isinstance(d, dict):
+        return SimpleNamespace(**{k: to_namespace(v) for k, v in d.items()})
+    return d
+
+def main():
+    parser = argparse.ArgumentParser(description='Distributed (gloo) TRIAD training')
+    parser.add_argument('--config', required=True, help='YAML config with common/triad/wandb/paths sections')
+    parser.add_argument('--mode', default='benchmark', choices=['benchmark', 'inference'])
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        cfg = to_namespace(yaml.safe_load(f))
+
+    from model.route9.trainer import BenchmarkTrainer, InferenceTrainer
+    trainer_cls = BenchmarkTrainer if args.mode == 'benchmark' else InferenceTrainer
+    trainer = trainer_cls(cfg, seed=args.seed)
+    trainer.train_model()
+
+if __name__ == '__main__':
+    main()
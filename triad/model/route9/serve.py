@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+"""
+Created on 2026-10-19 (Mon) 11:03:47
+
+Local HTTP inference service for trained TRIAD models (stdlib only).
+
+Models are TorchScript artifacts exported with model.route9.quantize.export_quantized,
+which carry their gene list, cell types and TransformPipeline params. Incoming samples are
+aligned to the gene list (upper-cased symbols, missing genes are filled with 0), transformed
+as the training target was (log2 / min-max) and coalesced into micro-batches across
+concurrent requests.
+
+Endpoints:
+    POST /predict  {"model": name, "genes": [...], "samples": {"S1": [...], ...}}
+                   {"model": name, "csv": "<genes x samples csv>"}
+    GET  /models   loaded models and their gene/cell type counts
+    GET  /stats    latency and throughput counters
+
+Usage:
+    python serve.py --model lung=/path/to/best_model_42_int8.pt --port 8080 --max_delay_ms 5
+
+@author: I.Azuma
+"""
+import io
+import os
+import sys
+import json
+import time
+import queue
+import argparse
+import warnings
+import threading
+import numpy as np
+import pandas as pd
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import torch
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../..')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../../..')))
+from model.route9.quantize import load_quantized, artifact_transform
+from _utils.dataset import TransformPipeline
+
+class ModelEntry:
+    """
+    A loaded artifact with its gene alignment index and micro-batching worker.
+    """
+    def __init__(self, name, artifact_path, max_batch_size=256, max_delay_ms=5.0):
+        self.name = name
+        self.module, self.meta = load_quantized(artifact_path)
+        self.gene_names = self.meta['gene_names']
+        self.target_cells = self.meta['target_cells']
+        self.transform = TransformPipeline.from_params(artifact_transform(self.meta), self.gene_names)
+        self.log_conv = self.transform.log_conv
+        self.gene_index = {g.upper(): i for i, g in enumerate(self.gene_names)}
+        self._warn_lock = threading.Lock()
+        self._warned = False  # low gene overlap is reported once per artifact, not per request
+
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay_ms / 1000.
+        self.requests = queue.Queue()
+        self.stats = ServiceStats()
+        self.worker = threading.Thread(target=self._run, name=f'batcher-{name}', daemon=True)
+        self.worker.start()
+
+    def align(self, genes, values):
+        """
+        Align (n_genes, n_samples) values to the model gene list --> (n_samples, feature_num) float32.
+        """
+        values = np.asarray(values, dtype=np.float32).reshape(len(genes), -1)
+        x = np.zeros((values.shape[1], len(self.gene_names)), dtype=np.float32)
+        src_idx, dst_idx = [], []
+        for i, g in enumerate(genes):
+            j = self.gene_index.get(str(g).upper())
+            if j is not None:
+                src_idx.append(i)
+                dst_idx.append(j)
+        if len(dst_idx) < 100 and not self._warned:
+            with self._warn_lock:
+                if not self._warned:
+                    self._warned = True
+                    warnings.warn(f"Only {len(dst_idx)} genes matched for model '{self.name}'.")
+        x[:, dst_idx] = values[src_idx].T
+        return self.transform.transform(x), len(dst_idx)
+
+    def predict(self, x):
+        """
+        Submit aligned samples and block until the micro-batch containing them is scored.
+        """
+        done = threading.Event()
+        item = {'x': x, 'done': done, 'out': None, 'error': None}
+        self.requests.put(item)
+        done.wait()
+        if item['error'] is not None:
+            raise item['error']
+        return item['out']
+
+    def _run(self):
+        while True:
+            items = [self.requests.get()]
+            n = items[0]['x'].shape[0]
+            deadline = time.perf_counter() + self.max_delay
+            # coalesce concurrent requests until the batch is full or the delay expires
+            while n < self.max_batch_size:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.requests.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                items.append(item)
+                n += item['x'].shape[0]
+
+            try:
+                x = torch.from_numpy(np.concatenate([t['x'] for t in items], axis=0))
+                with torch.no_grad():
+                    out = self.module(x).numpy()
+                start = 0
+                for t in items:
+                    t['out'] = out[start:start + t['x'].shape[0]]
+                    start += t['x'].shape[0]
+                self.stats.add_batch(n)
+            except Exception as e:
+                for t in items:
+                    t['error'] = e
+            for t in items:
+                t['done'].set()
+
+class ServiceStats:
+    """
+    Thread-safe latency and throughput counters.
+    """
+    def __init__(self, window=1000):
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.n_requests = 0
+        self.n_samples = 0
+        self.n_batches = 0
+        self.n_batch_samples = 0
+        self.n_errors = 0
+        self.latencies = deque(maxlen=window)
+
+    def add_request(self, n_samples, latency):
+        with self.lock:
+            self.n_requests += 1
+            self.n_samples += n_samples
+            self.latencies.append(latency)
+
+    def add_batch(self, n_samples):
+        with self.lock:
+            self.n_batches += 1
+            self.n_batch_samples += n_samples
+
+    def add_error(self):
+        with self.lock:
+            self.n_errors += 1
+
+    def summary(self):
+        with self.lock:
+            elapsed = time.time() - self.start_time
+            lat = np.array(self.latencies) * 1000 if len(self.latencies) > 0 else np.zeros(1)
+            return {
+                'requests': self.n_requests,
+                'samples': self.n_samples,
+                'batches': self.n_batches,
+                'errors': self.n_errors,
+                'mean_batch_samples': self.n_batch_samples / max(self.n_batches, 1),
+                'latency_ms_mean': float(lat.mean()),
+                'latency_ms_p50': float(np.percentile(lat, 50)),
+                'latency_ms_p95': float(np.percentile(lat, 95)),
+                'requests_per_sec': self.n_requests / elapsed,
+                'samples_per_sec': self.n_samples / elapsed,
+            }
+
+def parse_payload(payload):
+    """
+    Returns (genes, values (n_genes, n_samples), sample_names) from a JSON payload.
+    """
+    if 'csv' in payload:
+        sep = payload.get('sep', ',')
+        df = pd.read_csv(io.StringIO(payload['csv']), index_col=0, sep=sep)
+        return df.index.tolist(), df.values, [str(c) for c in df.columns]
+    if 'samples' in payload:
+        genes = payload['genes']
+        samples = payload['samples']
+        if isinstance(samples, dict):
+            names = list(samples.keys())
+            values = np.array([samples[k] for k in names], dtype=np.float32).T
+        else:
+            values = np.array(samples, dtype=np.float32).reshape(-1, len(genes)).T
+            names = [str(i) for i in range(values.shape[1])]
+        return genes, values, names
+    raise ValueError("payload must contain 'csv' or 'genes' and 'samples'")
+
+class TRIADHandler(BaseHTTPRequestHandler):
+    models = {}
+
+    def do_GET(self):
+        if self.path == '/models':
+            self._send(200, {name: {'genes': len(m.gene_names), 'cell_types': m.target_cells, 'log_conv': m.log_conv}
+                             for name, m in self.models.items()})
+        elif self.path == '/stats':
+            self._send(200, {name: m.stats.summary() for name, m in self.models.items()})
+        else:
+            self._send(404, {'error': f'unknown path {self.path}'})
+
+    def do_POST(self):
+        if self.path != '/predict':
+            self._send(404, {'error': f'unknown path {self.path}'})
+            return
+        start = time.perf_counter()
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            payload = json.loads(self.rfile.read(length))
+            name = payload.get('model') or next(iter(self.models))
+            if name not in self.models:
+                raise KeyError(f"model '{name}' is not loaded")
+        except Exception as e:
+            self._send(400, {'error': str(e)})
+            return
+
+        entry = self.models[name]
+        try:
+            genes, values, sample_names = parse_payload(payload)
+            x, n_matched = entry.align(genes, values)
+            preds = entry.predict(x)
+        except Exception as e:
+            entry.stats.add_error()
+            self._send(400, {'error': str(e)})
+            return
+        entry.stats.add_request(x.shape[0], time.perf_counter() - start)
+
+        self._send(200, {
+            'model': name,
+            'matched_genes': n_matched,
+            'cell_types': entry.target_cells,
+            'proportions': {s: dict(zip(entry.target_cells, p.tolist())) for s, p in zip(sample_names, preds)},
+        })
+
+    def _send(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+def build_server(model_paths, host='127.0.0.1', port=8080, max_batch_size=256, max_delay_ms=5.0):
+    """
+    model_paths: {name: artifact_path}
+    """
+    models = {name: ModelEntry(name, path, max_batch_size=max_batch_size, max_delay_ms=max_delay_ms)
+              for name, path in model_paths.items()}
+    handler = type('Handler', (TRIADHandler,), {'models': models})
+    return ThreadingHTTPServer((host, port), handler)
+
+def main():
+    parser = argparse.ArgumentParser(description='Local TRIAD inference service')
+    parser.add_argument('--model', action='append', required=True, help='name=artifact_path (repeatable)')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--max_batch_size', type=int, default=256)
+    parser.add_argument('--max_delay_ms', type=float, default=5.0)
+    args = parser.parse_args()
+
+    model_paths = dict(m.split('=', 1) for m in args.model)
+    server = build_server(model_paths, host=args.host, port=args.port,
+                          max_batch_size=args.max_batch_size, max_delay_ms=args.max_delay_ms)
+    print(f"Serving {list(model_paths)} on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == '__main__':
+    main()
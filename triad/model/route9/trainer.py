@@ -12,10 +12,19 @@ using domain adaptation techniques. The module includes:
    - Training loop with DAG (Directed Acyclic Graph) constraints
    - Domain adaptation using gradient reversal layers
    - Early stopping and model checkpointing
+   - Gradient accumulation over micro-batches (cfg.triad.micro_batch_size); the GRL schedule follows
+     optimizer steps, while discriminator BatchNorm statistics remain per micro-batch
+   - Background prefetch of (source, target) batch pairs (cfg.triad.prefetch_depth, cfg.triad.input_noise_std)
+   - Sparse (CSR) source input kept sparse through batching
+   - Online pseudo-bulk simulation from a single-cell atlas (cfg.paths.online_atlas_path)
+   - Export of a dynamically quantised (int8) inference artifact
+   - CPU data-parallel training over gloo when launched with torchrun
+   - Optional mixed-precision autocast (cfg.triad.precision: 'fp32', 'bf16' or 'fp16') and throughput benchmark
 
 2. BenchmarkTrainer: Extends BaseTrainer for benchmarking purposes, including:
    - Automatic evaluation metrics calculation (R, CCC, MAE)
    - Integration with evaluation utilities for performance assessment
+   - Accuracy regression check of autocast precision against fp32
 
 3. InferenceTrainer: Extends BaseTrainer for inference-only tasks, providing:
    - Streamlined setup for making predictions on new data
@@ -26,9 +35,11 @@ using domain adaptation techniques. The module includes:
 import os
 import gc
 import sys
+import time
 import numpy as np
 import pandas as pd
 from collections import defaultdict
+from scipy.sparse import issparse
 from sklearn.metrics import roc_auc_score
 
 import torch
@@ -41,7 +52,13 @@ os.chdir(BASE_DIR)
 # Import TRIAD model and utilities
 sys.path.append(BASE_DIR + '/github/TRIAD/triad')
 from model.route9.triad_model import *
+from model.route9.quantize import export_quantized, validate_quantized
+from model.route9.distributed import *
 from _utils.dataset import *
+from _utils.mmap_dataset import write_source_memmap, source_fingerprint, memmap_matches, MemmapSourceLoader
+from _utils.prefetch import PairPrefetcher
+from _utils.sparse_input import CSRDataset, csr_loader
+from _utils.online_sim import OnlineBulkLoader
 
 # Import WandB logger
 sys.path.append(BASE_DIR + '/github/wandb-util')
@@ -60,14 +77,21 @@ class BaseTrainer:
         self.cfg = cfg
         self.target_cells = cfg.common.target_cells
         self.seed = seed
+        self.rank, self.world_size = init_distributed()
 
     def build_dataloader(self, batch_size):
         """
         Build dataloaders for training and testing.
+        batch_size is the effective batch size. If cfg.triad.micro_batch_size is set, the loaders
+        yield micro-batches and gradients are accumulated over accum_steps of them in run_epoch.
         """
         g = torch.Generator()
         g.manual_seed(self.seed)
 
+        micro_batch_size = getattr(self.cfg.triad, 'micro_batch_size', None) or batch_size
+        self.accum_steps = max(1, int(np.ceil(batch_size / micro_batch_size)))
+        batch_size = min(batch_size, micro_batch_size)
+
         source_data = self.source_data
         target_data = self.target_data
 
@@ -77,28 +101,86 @@ class BaseTrainer:
             self.target_cells = source_data.uns['cell_types']
         else:
             source_ratios = [source_data.obs[ctype] for ctype in self.target_cells]
-        self.source_data_x = source_data.X.astype(np.float32)
-        self.source_data_y = np.array(source_ratios, dtype=np.float32).transpose()
-
-        tr_data = torch.FloatTensor(self.source_data_x)
-        tr_labels = torch.FloatTensor(self.source_data_y)
-        source_dataset = Data.TensorDataset(tr_data, tr_labels)
-        self.train_source_loader = Data.DataLoader(dataset=source_dataset, batch_size=batch_size, shuffle=True)
+        mmap_dir = getattr(self.cfg.paths, 'source_mmap_dir', None)
+        online_atlas = getattr(self.cfg.paths, 'online_atlas_path', None)
+        if online_atlas is not None:
+            # Online source: fresh pseudo-bulks per batch from the atlas, with the genes and transform of source_data
+            n_batches = int(np.ceil(source_data.shape[0] / (batch_size * self.world_size)))
+            self.train_source_loader = OnlineBulkLoader.from_h5ad(online_atlas, source_data.uns['transform'], self.target_cells,
+                                                                  celltype_key=getattr(self.cfg.triad, 'online_celltype_key', 'celltype'),
+                                                                  batch_size=batch_size,
+                                                                  n_batches=getattr(self.cfg.triad, 'online_n_batches', None) or n_batches,
+                                                                  pool_size=getattr(self.cfg.triad, 'online_pool_size', 500),
+                                                                  method=getattr(self.cfg.triad, 'online_method', 'dirichlet'),
+                                                                  seed=self.seed, rank=self.rank, world_size=self.world_size)
+            self.source_sampler = self.train_source_loader
+            self.source_data_x = self.train_source_loader.X
+            self.source_data_y = None
+        elif mmap_dir is not None:
+            # Out-of-core source: block-shuffled reads from a memory-mapped X.npy (no in-memory copy)
+            # NOTE: rewritten when the stored rows / genes / target cells / transform differ from source_data
+            if not memmap_matches(mmap_dir, source_fingerprint(source_data, self.target_cells)) and is_main_process():
+                write_source_memmap(source_data, self.target_cells, mmap_dir)
+            barrier()
+            self.train_source_loader = MemmapSourceLoader(mmap_dir, batch_size=batch_size, seed=self.seed,
+                                                          block_size=getattr(self.cfg.triad, 'mmap_block_size', 8192),
+                                                          rank=self.rank, world_size=self.world_size)
+            self.source_sampler = self.train_source_loader
+            self.source_data_x = self.train_source_loader.X
+            self.source_data_y = self.train_source_loader.y
+            # free the in-memory source; only genes / uns are used from here on
+            self.source_data = source_data = source_data[:0].copy()
+            gc.collect()
+        elif issparse(source_data.X):
+            # Sparse source: X stays CSR and batches are densified per step (the per-gene encoder needs dense x)
+            self.source_data_y = np.array(source_ratios, dtype=np.float32).transpose()
+            source_dataset = CSRDataset(source_data.X, self.source_data_y)
+            self.source_data_x = source_dataset.X
+            if self.world_size > 1:
+                self.source_sampler = Data.DistributedSampler(source_dataset, num_replicas=self.world_size, rank=self.rank, shuffle=True, seed=self.seed)
+                self.train_source_loader = Data.DataLoader(dataset=source_dataset, sampler=Data.BatchSampler(self.source_sampler, batch_size, drop_last=False), batch_size=None)
+            else:
+                self.train_source_loader = csr_loader(source_dataset, batch_size)
+        else:
+            # NOTE: X is already float32 after finalize_data, so no extra copy is made here
+            self.source_data_x = np.asarray(source_data.X, dtype=np.float32)
+            self.source_data_y = np.array(source_ratios, dtype=np.float32).transpose()
+
+            tr_data = torch.from_numpy(self.source_data_x)
+            tr_labels = torch.from_numpy(self.source_data_y)
+            source_dataset = Data.TensorDataset(tr_data, tr_labels)
+            if self.world_size > 1:
+                # NOTE: DistributedSampler pads so that every rank runs the same number of steps
+                self.source_sampler = Data.DistributedSampler(source_dataset, num_replicas=self.world_size, rank=self.rank, shuffle=True, seed=self.seed)
+                self.train_source_loader = Data.DataLoader(dataset=source_dataset, batch_size=batch_size, sampler=self.source_sampler)
+            else:
+                self.train_source_loader = Data.DataLoader(dataset=source_dataset, batch_size=batch_size, shuffle=True)
 
         # Extract celltype and feature info
         self.celltype_num = len(self.target_cells)
         self.used_features = list(source_data.var_names)
 
         # 2. Target dataset
-        self.target_data_x = target_data.X.astype(np.float32)
+        self.target_data_x = np.asarray(target_data.X, dtype=np.float32)
         self.target_data_y = np.random.rand(target_data.shape[0], self.celltype_num)
 
-        te_data = torch.FloatTensor(self.target_data_x)
+        te_data = torch.from_numpy(self.target_data_x)
         te_labels = torch.FloatTensor(self.target_data_y)
         target_dataset = Data.TensorDataset(te_data, te_labels)
-        self.train_target_loader = Data.DataLoader(dataset=target_dataset, batch_size=batch_size, shuffle=True, worker_init_fn=seed_worker, generator=g)
+        if self.world_size > 1:
+            # NOTE: target batches are re-drawn every step, so shuffle within the rank's shard
+            target_sampler = Data.SubsetRandomSampler(shard_indices(len(target_dataset), self.rank, self.world_size), generator=g)
+            self.train_target_loader = Data.DataLoader(dataset=target_dataset, batch_size=batch_size, sampler=target_sampler, worker_init_fn=seed_worker)
+        else:
+            self.train_target_loader = Data.DataLoader(dataset=target_dataset, batch_size=batch_size, shuffle=True, worker_init_fn=seed_worker, generator=g)
         self.test_target_loader = Data.DataLoader(dataset=target_dataset, batch_size=batch_size, shuffle=False)
 
+        # 3. Background prefetch of (source, target) batch pairs
+        self.train_prefetcher = PairPrefetcher(self.train_source_loader, self.train_target_loader, device=self.device,
+                                               depth=getattr(self.cfg.triad, 'prefetch_depth', 2),
+                                               noise_std=getattr(self.cfg.triad, 'input_noise_std', 0.0),
+                                               seed=self.seed + self.rank)
+
     def set_options(self):
         """
         Create option list for the model and initialize parameters.
@@ -110,6 +192,7 @@ class BaseTrainer:
         option_list['celltype_num'] = len(self.target_cells)
 
         self.option_list = option_list
+        self.precision = option_list.get('precision') or 'fp32'  # 'fp32', 'bf16' or 'fp16'
 
         # parameter initialization
         self.best_loss = 1e10
@@ -124,8 +207,12 @@ class BaseTrainer:
     def train_model(self, inference_fn=None):
         """
         Main training loop for the TRIAD model.
+        When launched with torchrun, gradients (in buckets) and BatchNorm running stats are averaged across ranks,
+        and only rank 0 writes logs and checkpoints.
         """
         model = TRIAD(self.option_list, seed=self.seed).to(self.device)
+        broadcast_model(model)
+        is_main = is_main_process()
         optimizer1 = torch.optim.Adam([
             {'params': model.encoder.parameters()},
             {'params': model.decoder.parameters()},
@@ -141,21 +228,30 @@ class BaseTrainer:
         scheduler1 = torch.optim.lr_scheduler.StepLR(optimizer1, step_size=50, gamma=0.8)
         scheduler2 = torch.optim.lr_scheduler.StepLR(optimizer2, step_size=50, gamma=0.8)
         criterion_da = nn.BCELoss().to(self.device)
+        # NOTE: loss scaling is only needed for fp16 (bf16 shares the fp32 exponent range)
+        scaler = torch.amp.GradScaler('cuda', enabled=(self.precision == 'fp16'))
 
         source_label = torch.ones(model.batch_size).unsqueeze(1).to(self.device)
         target_label = torch.zeros(10000).unsqueeze(1).to(self.device)
 
         # WandB logger settings
-        logger = WandbLogger(
-            entity=self.cfg.wandb.entity,
-            project=self.cfg.wandb.project,
-            group=self.cfg.wandb.group,
-            name=self.cfg.wandb.name + f"_seed{self.seed}",
-            config=self.option_list,
-        )
+        logger = None
+        if is_main:
+            logger = WandbLogger(
+                entity=self.cfg.wandb.entity,
+                project=self.cfg.wandb.project,
+                group=self.cfg.wandb.group,
+                name=self.cfg.wandb.name + f"_seed{self.seed}",
+                config=self.option_list,
+            )
 
         for epoch in range(model.num_epochs + 1):
-            loss_dict, curr_h = self.run_epoch(model, epoch, optimizer1, optimizer2, criterion_da, source_label, target_label)
+            if self.world_size > 1 or hasattr(self.train_source_loader, 'set_epoch'):
+                self.source_sampler.set_epoch(epoch)
+            loss_dict, curr_h = self.run_epoch(model, epoch, optimizer1, optimizer2, criterion_da, source_label, target_label, scaler=scaler)
+            # NOTE: average over ranks so that early stopping is decided identically everywhere
+            loss_dict = allreduce_mean(loss_dict)
+            allreduce_buffers(model)  # BatchNorm running stats averaged over ranks
 
             # update dag restricion
             if (epoch + 1) % 10 == 0 and not self.w_stop_flag:
@@ -164,11 +260,13 @@ class BaseTrainer:
                 self.alpha += self.rho * curr_h.detach().cpu()
                 self.pre_h = curr_h
                 if curr_h <= self.h_thresh and epoch > 100:
-                    print(f"Stopped updating W at epoch {epoch+1}")
+                    if is_main:
+                        print(f"Stopped updating W at epoch {epoch+1}")
                     self.w_stop_flag = True
+                self.alpha, self.rho, self.pre_h, self.w_stop_flag = broadcast_lagrangian(self.alpha, self.rho, self.pre_h, self.w_stop_flag)
 
             # Inference
-            if inference_fn is not None:
+            if inference_fn is not None and is_main:
                 summary_df = inference_fn(model)
                 loss_dict.update({
                     'R': summary_df.loc['mean']['R'],
@@ -176,20 +274,23 @@ class BaseTrainer:
                     'MAE': summary_df.loc['mean']['MAE'],
                 })
 
-            logger(epoch=epoch, **loss_dict)
+            if is_main:
+                logger(epoch=epoch, **loss_dict)
 
             # Early stopping
             if loss_dict['pred_disc_loss'] < self.best_loss:
                 self.update_flag = 0
                 self.best_loss = loss_dict['pred_disc_loss']
-                torch.save(model.state_dict(), os.path.join(self.cfg.paths.triad_model_path, f'best_model_{self.seed}.pth'))
+                if is_main:
+                    torch.save(model.state_dict(), os.path.join(self.cfg.paths.triad_model_path, f'best_model_{self.seed}.pth'))
             else:
                 self.update_flag += 1
                 if self.update_flag == model.early_stop:
-                    print(f"Early stopping at epoch {epoch+1}")
+                    if is_main:
+                        print(f"Early stopping at epoch {epoch+1}")
                     break
 
-            if epoch % 10 == 0:
+            if epoch % 10 == 0 and is_main:
                 print(f"Epoch:{epoch}, Loss:{loss_dict['total_loss']:.3f}, dag:{loss_dict['dag_loss']:.3f}, pred:{loss_dict['pred_loss']:.3f}, disc:{loss_dict['disc_loss']:.3f}, disc_auc:{loss_dict['disc_auc']:.3f}")
 
             gc.collect()
@@ -198,26 +299,48 @@ class BaseTrainer:
             #scheduler1.step()
             #scheduler2.step()
 
-        torch.save(model.state_dict(), os.path.join(self.cfg.paths.triad_model_path, f'last_model.pth'))
+        if is_main:
+            torch.save(model.state_dict(), os.path.join(self.cfg.paths.triad_model_path, f'last_model.pth'))
+        cleanup_distributed()
 
-    def run_epoch(self, model, epoch, optimizer1, optimizer2, criterion_da, source_label, target_label):
+    def run_epoch(self, model, epoch, optimizer1, optimizer2, criterion_da, source_label, target_label, scaler=None):
         """
         Train the model for one epoch.
+        Forward passes run under autocast when `precision` is set; losses are reduced in fp32.
+        Gradients of optimizer1 (DAG) and optimizer2 (prediction/discriminator) are accumulated
+        over accum_steps micro-batches before each step. The GRL coefficient is computed from the
+        optimizer-step index; discriminator BatchNorm statistics remain per micro-batch.
         """
         model.train()
+        if scaler is None:
+            scaler = torch.amp.GradScaler('cuda', enabled=False)
+        accum_steps = getattr(self, 'accum_steps', 1)
+        n_batches = len(self.train_source_loader)
+        # NOTE: each loss only accumulates into the parameters of its own optimizer
+        params1 = [p for group in optimizer1.param_groups for p in group['params']]
+        params2 = [p for group in optimizer2.param_groups for p in group['params']]
+        optimizer1.zero_grad()
+        optimizer2.zero_grad()
+
         dag_loss_epoch, pred_loss_epoch, disc_loss_epoch = 0., 0., 0.
         all_preds = []
         all_labels = []
-        for batch_idx, (source_x, source_y) in enumerate(self.train_source_loader):
-            target_x = next(iter(self.train_target_loader))[0]  # NOTE: shuffle
+        # NOTE: batches are prepared ahead on a background thread and copied with non_blocking=True
+        for batch_idx, (source_x, source_y, target_x) in enumerate(self.train_prefetcher):
 
-            total_steps = model.num_epochs * len(self.train_source_loader)
-            p = float(batch_idx + epoch * len(self.train_source_loader)) / total_steps
+            # gradient accumulation group (the last group may be shorter)
+            group_start = (batch_idx // accum_steps) * accum_steps
+            group_size = min(accum_steps, n_batches - group_start)
+            do_step = (batch_idx + 1) == (group_start + group_size)
+
+            # NOTE: the GRL schedule follows optimizer steps, so it matches an equivalent large-batch run
+            n_steps = int(np.ceil(n_batches / accum_steps))
+            p = float(epoch * n_steps + batch_idx // accum_steps) / (model.num_epochs * n_steps)
             a = 2.0 / (1.0 + np.exp(-10 * p)) - 1
 
-            source_x, source_y, target_x = source_x.cuda(), source_y.cuda(), target_x.cuda()
-            rec_s, _, _ = model(source_x, a)
-            rec_t, _, _ = model(target_x, a)
+            with get_autocast(self.device, self.precision):
+                rec_s, _, _ = model(source_x, a)
+                rec_t, _, _ = model(target_x, a)
 
             # 1. DAG-related loss
             w_adj = model.w_adj
@@ -233,19 +356,22 @@ class BaseTrainer:
             dag_loss = model.dag_w * dag_loss
 
             if not self.w_stop_flag:
-                optimizer1.zero_grad()
-                dag_loss.backward(retain_graph=True)
-                optimizer1.step()
+                scaler.scale(dag_loss / group_size).backward(retain_graph=True, inputs=params1)
+                if do_step:
+                    allreduce_grads(params1)
+                    scaler.step(optimizer1)
+                    optimizer1.zero_grad()
 
             # NOTE: re-obtain the prediction and domain classification
-            _, pred_s, domain_s = model(source_x, a)
-            _, pred_t, domain_t = model(target_x, a)
+            with get_autocast(self.device, self.precision):
+                _, pred_s, domain_s = model(source_x, a)
+                _, pred_t, domain_t = model(target_x, a)
 
             # 2. prediction
             if model.pred_loss_type == 'L1':
-                pred_loss = model.losses.L1_loss(pred_s, source_y.cuda())
+                pred_loss = model.losses.L1_loss(pred_s, source_y)
             elif model.pred_loss_type == 'custom':
-                pred_loss = model.losses.summarize_loss(pred_s, source_y.cuda())
+                pred_loss = model.losses.summarize_loss(pred_s, source_y)
             else:
                 raise ValueError("Invalid prediction loss type.")
             pred_loss_epoch += pred_loss.data.item()
@@ -262,14 +388,17 @@ class BaseTrainer:
             # 4. pred_loss + disc_loss
             loss = model.pred_w * pred_loss + model.disc_w * disc_loss
 
-            optimizer2.zero_grad()
-            loss.backward(retain_graph=True)
-            optimizer2.step()
+            scaler.scale(loss / group_size).backward(retain_graph=True, inputs=params2)
+            if do_step:
+                allreduce_grads(params2)
+                scaler.step(optimizer2)
+                optimizer2.zero_grad()
+                scaler.update()
 
         # summarize loss
-        dag_loss_epoch = model.dag_w * dag_loss_epoch / len(self.train_source_loader)
-        pred_loss_epoch = model.pred_w * pred_loss_epoch / len(self.train_source_loader)
-        disc_loss_epoch = model.disc_w * disc_loss_epoch / len(self.train_source_loader)
+        dag_loss_epoch = model.dag_w * dag_loss_epoch / n_batches
+        pred_loss_epoch = model.pred_w * pred_loss_epoch / n_batches
+        disc_loss_epoch = model.disc_w * disc_loss_epoch / n_batches
         loss_all = dag_loss_epoch + pred_loss_epoch + disc_loss_epoch
         auc_score = roc_auc_score(all_labels, all_preds)
 
@@ -289,13 +418,14 @@ class BaseTrainer:
         Make predictions using the trained model.
         """
         model_path = os.path.join(self.cfg.paths.triad_model_path, f'best_model_{self.seed}.pth')
-        model = TRIAD(self.option_list, seed=self.seed).cuda()
-        model.load_state_dict(torch.load(model_path))
+        model = TRIAD(self.option_list, seed=self.seed).to(self.device)
+        model.load_state_dict(torch.load(model_path, map_location=self.device))
 
         model.eval()
         preds, gt = None, None
         for batch_idx, (x, y) in enumerate(self.test_target_loader):
-            rec, logits, domain = model(x.cuda(), alpha=1.0)
+            with get_autocast(self.device, self.precision):
+                rec, logits, domain = model(x.to(self.device), alpha=1.0)
             logits = logits.detach().cpu().numpy()
             frac = y.detach().cpu().numpy()
             preds = logits if preds is None else np.concatenate((preds, logits), axis=0)
@@ -309,14 +439,78 @@ class BaseTrainer:
         Retrieve the W_adj matrix from the trained model.
         """
         model_path = os.path.join(self.cfg.paths.triad_model_path, f'best_model_{self.seed}.pth')
-        model = TRIAD(self.option_list, seed=self.seed).cuda()
-        model.load_state_dict(torch.load(model_path))
+        model = TRIAD(self.option_list, seed=self.seed).to(self.device)
+        model.load_state_dict(torch.load(model_path, map_location=self.device))
 
         w_adj = model.w_adj.detach().cpu().numpy()
         gene_names = self.gene_names
         w_df = pd.DataFrame(w_adj, index=gene_names, columns=gene_names)
         return w_df
 
+    def export_quantized(self, out_path=None):
+        """
+        Export the best model as a dynamically quantised (int8) inference artifact and
+        report the proportion deviation versus fp32 on the target data.
+        The target-side transform recorded by finalize_data (uns['transform']) goes into the artifact.
+        """
+        model_path = os.path.join(self.cfg.paths.triad_model_path, f'best_model_{self.seed}.pth')
+        if out_path is None:
+            out_path = os.path.join(self.cfg.paths.triad_model_path, f'best_model_{self.seed}_int8.pt')
+        export_quantized(self.option_list, model_path, out_path,
+                         gene_names=self.gene_names, target_cells=self.target_cells,
+                         transform=self.target_data.uns['transform'], seed=self.seed)
+        dev_df = validate_quantized(out_path, self.option_list, model_path, self.target_data_x, seed=self.seed)
+        return out_path, dev_df
+
+    def benchmark_throughput(self, precisions=('fp32', 'bf16'), n_iter=20, warmup=3):
+        """
+        Measure forward (inference) and forward+backward (training) throughput for each precision.
+        Returns a DataFrame of samples/sec indexed by precision.
+        """
+        model = TRIAD(self.option_list, seed=self.seed).to(self.device)
+        x = next(iter(self.train_source_loader))[0].to(self.device)
+        default_precision = self.precision
+
+        res = {}
+        for precision in precisions:
+            self.precision = precision
+            # 1. inference
+            model.eval()
+            with torch.no_grad():
+                for i in range(warmup + n_iter):
+                    if i == warmup:
+                        self._synchronize()
+                        start = time.perf_counter()
+                    with get_autocast(self.device, precision):
+                        model(x, alpha=1.0)
+            self._synchronize()
+            infer_time = time.perf_counter() - start
+
+            # 2. training (DAG reconstruction loss)
+            model.train()
+            for i in range(warmup + n_iter):
+                if i == warmup:
+                    self._synchronize()
+                    start = time.perf_counter()
+                model.zero_grad()
+                with get_autocast(self.device, precision):
+                    rec, _, _ = model(x, alpha=1.0)
+                loss = model.losses.dag_rec_loss(x.reshape((x.size(0), x.size(1), 1)), rec)
+                loss.backward()
+            self._synchronize()
+            train_time = time.perf_counter() - start
+
+            res[precision] = {'infer_samples_per_sec': n_iter * x.size(0) / infer_time,
+                              'train_samples_per_sec': n_iter * x.size(0) / train_time}
+            print(f"{precision}: infer {res[precision]['infer_samples_per_sec']:.1f} samples/s, train {res[precision]['train_samples_per_sec']:.1f} samples/s")
+        self.precision = default_precision
+
+        return pd.DataFrame(res).T
+
+    def _synchronize(self):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize()
+
 class BenchmarkTrainer(BaseTrainer):
     """
     Trainer for benchmarking. Includes dataset preparation and evaluation metric computation.
@@ -326,6 +520,7 @@ class BenchmarkTrainer(BaseTrainer):
         self.cfg = cfg
         self.target_cells = cfg.common.target_cells
         self.seed = seed
+        self.rank, self.world_size = init_distributed()
 
         self.set_data()
         self.build_dataloader(batch_size=cfg.triad.batch_size)
@@ -342,6 +537,10 @@ class BenchmarkTrainer(BaseTrainer):
             n_vtop=self.cfg.common.n_vtop,
             seed=self.seed,
             vtop_mode=self.cfg.common.vtop_mode,
+            cache_dir=getattr(self.cfg.paths, 'feature_store_dir', None) or getattr(self.cfg.paths, 'prep_cache_dir', None),
+            backed=getattr(self.cfg.common, 'backed_h5ad', False),
+            sparse_input=getattr(self.cfg.common, 'sparse_input', False),
+            n_jobs=getattr(self.cfg.common, 'prep_n_jobs', 1),
         )
         self.source_data = train_data
         self.target_data = test_data
@@ -357,14 +556,15 @@ class BenchmarkTrainer(BaseTrainer):
     def target_inference(self, model=None, do_plot=False):
         if model is None:
             model_path = os.path.join(self.cfg.paths.triad_model_path, f'best_model_{self.seed}.pth')
-            model = TRIAD(self.option_list, seed=self.seed).cuda()
-            model.load_state_dict(torch.load(model_path))
+            model = TRIAD(self.option_list, seed=self.seed).to(self.device)
+            model.load_state_dict(torch.load(model_path, map_location=self.device))
             print("Model loaded from %s" % model_path)
 
         model.eval()
         preds, gt = None, None
         for batch_idx, (x, y) in enumerate(self.test_target_loader):
-            rec, logits, domain = model(x.cuda(), alpha=1.0)
+            with get_autocast(self.device, self.precision):
+                rec, logits, domain = model(x.to(self.device), alpha=1.0)
             logits = logits.detach().cpu().numpy()
             frac = y.detach().cpu().numpy()
             preds = logits if preds is None else np.concatenate((preds, logits), axis=0)
@@ -397,6 +597,33 @@ class BenchmarkTrainer(BaseTrainer):
 
         return summary_df, final_preds_target
 
+    def precision_check(self, precision='bf16', model=None, tol=0.01):
+        """
+        Accuracy regression check of an autocast precision against fp32.
+        Runs target_inference with the same weights in both precisions and compares mean R/CCC.
+        """
+        if model is None:
+            model_path = os.path.join(self.cfg.paths.triad_model_path, f'best_model_{self.seed}.pth')
+            model = TRIAD(self.option_list, seed=self.seed).to(self.device)
+            model.load_state_dict(torch.load(model_path, map_location=self.device))
+
+        default_precision = self.precision
+        res = {}
+        for p in ['fp32', precision]:
+            self.precision = p
+            summary_df, _ = self.target_inference(model=model, do_plot=False)
+            res[p] = summary_df.loc['mean'][['R', 'CCC']]
+        self.precision = default_precision
+
+        check_df = pd.DataFrame(res).T
+        check_df.loc['diff'] = check_df.loc[precision] - check_df.loc['fp32']
+        passed = bool((check_df.loc['diff'].abs() <= tol).all())
+        if not passed:
+            print(f"Warning: {precision} deviates from fp32 by more than {tol} (R/CCC).")
+        print(check_df)
+
+        return check_df, passed
+
 class InferenceTrainer(BaseTrainer):
     """
     Trainer for inference only. Prepares the inference dataset.
@@ -406,6 +633,7 @@ class InferenceTrainer(BaseTrainer):
         self.cfg = cfg
         self.target_cells = cfg.common.target_cells
         self.seed = seed
+        self.rank, self.world_size = init_distributed()
 
         self.set_data()
         self.build_dataloader(batch_size=cfg.triad.batch_size)
@@ -424,6 +652,10 @@ class InferenceTrainer(BaseTrainer):
             target_log_conv=self.cfg.common.target_log_conv,
             seed=self.seed,
             vtop_mode=self.cfg.common.vtop_mode,
+            cache_dir=getattr(self.cfg.paths, 'feature_store_dir', None) or getattr(self.cfg.paths, 'prep_cache_dir', None),
+            backed=getattr(self.cfg.common, 'backed_h5ad', False),
+            sparse_input=getattr(self.cfg.common, 'sparse_input', False),
+            n_jobs=getattr(self.cfg.common, 'prep_n_jobs', 1),
         )
         self.source_data = train_data
         self.target_data = test_data
@@ -7,6 +7,7 @@ Tissue-adaptive Representation via Integrated graph Autoencoder for Deconvolutio
 @author: I.Azuma
 """
 import random
+import contextlib
 
 import torch
 import torch.nn as nn
@@ -25,6 +26,23 @@ from _utils import common_utils
 
 cudnn.deterministic = True
 
+def get_autocast(device, precision='fp32'):
+    """
+    Return the autocast context for the forward passes.
+    precision: 'fp32' (no autocast), 'bf16' (CPU/CUDA) or 'fp16' (CUDA only).
+    """
+    if precision in (None, 'fp32'):
+        return contextlib.nullcontext()
+    if precision == 'bf16':
+        dtype = torch.bfloat16
+    elif precision == 'fp16':
+        if device.type != 'cuda':
+            raise ValueError("fp16 autocast requires CUDA. Use 'bf16' on CPU.")
+        dtype = torch.float16
+    else:
+        raise ValueError("precision must be one of ['fp32', 'bf16', 'fp16']")
+    return torch.autocast(device_type=device.type, dtype=dtype)
+
 class LossFunctions:
     eps = 1e-8
 
@@ -58,8 +76,11 @@ class LossFunctions:
         return loss
 
     def compute_h(self, w_adj):
-        d = w_adj.shape[0]
-        h = torch.trace(torch.matrix_exp(w_adj * w_adj)) - d
+        # NOTE: matrix_exp is sensitive to rounding, so keep it in fp32 even under autocast
+        with torch.autocast(device_type=w_adj.device.type, enabled=False):
+            w_adj = w_adj.float()
+            d = w_adj.shape[0]
+            h = torch.trace(torch.matrix_exp(w_adj * w_adj)) - d
         return h
 
     def dag_loss(self, rec_mse, w_adj, l1_penalty, alpha, rho):
@@ -211,7 +232,8 @@ class TRIAD(nn.Module):
         domain_emb = GradientReversalLayer.apply(emb, alpha)
         domain = self.discriminator(domain_emb)
 
-        return rec, pred, domain
+        # NOTE: outputs are returned in fp32 so that the loss reductions stay fp32 under autocast
+        return rec.float(), pred.float(), domain.float()
 
     def _preprocess_graph(self, w_adj):
         return (1. - torch.eye(w_adj.shape[0], device=self.device)) * w_adj